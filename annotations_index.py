@@ -0,0 +1,141 @@
+"""
+Sidecar index of COCO annotation files
+
+The index of annotations.json is kept in annotations.json.index/ next to it as a set of .npy files
+loaded with memory mapping. It is built on the first use and rebuilt when size or mtime of the json file change.
+Index columns:
+    images_ids, images_names, images_widths, images_heights            (M,)
+    categories_ids, categories_names                                   (C,)
+    id, image_id, category_id, area, iscrowd                          (K,) annotations in file order
+    bbox                                                               (K, 4) COCO boxes [left, top, width, height]
+    images_order, images_offsets   annotations of image i are images_order[images_offsets[i]:images_offsets[i + 1]]
+"""
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+
+INDEX_COLUMNS = ('images_ids', 'images_names', 'images_widths', 'images_heights', 'categories_ids', 'categories_names',
+                 'id', 'image_id', 'category_id', 'area', 'iscrowd', 'bbox', 'images_order', 'images_offsets')
+
+
+def get_index_folder(json_file):
+    return json_file + '.index'
+
+
+def get_source_info(json_file):
+    stat = os.stat(json_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class AnnotationsIndex:
+    def __init__(self, columns):
+        self.columns = columns
+        for name, array in columns.items():
+            setattr(self, name, array)
+
+    def __len__(self):
+        return len(self.id)
+
+    def get_image_annotations(self, i):
+        """
+        Indexes of annotations of the i-th image
+        """
+        return self.images_order[self.images_offsets[i]:self.images_offsets[i + 1]]
+
+    def get_class_id_to_name(self):
+        return {category_id - 1: name for category_id, name in zip(self.categories_ids.tolist(),
+                                                                  self.categories_names.tolist())}
+
+    def to_coco(self):
+        """
+        COCO dict with images, categories and annotations fields used for evaluation
+        """
+        images = [{'id': image_id, 'file_name': name, 'width': width, 'height': height}
+                  for image_id, name, width, height in zip(self.images_ids.tolist(), self.images_names.tolist(),
+                                                           self.images_widths.tolist(), self.images_heights.tolist())]
+        categories = [{'id': category_id, 'name': name}
+                      for category_id, name in zip(self.categories_ids.tolist(), self.categories_names.tolist())]
+        columns = [self.id.tolist(), self.image_id.tolist(), self.category_id.tolist(), self.bbox.tolist(),
+                   self.area.tolist(), self.iscrowd.tolist()]
+        annotations = [{'id': annotation_id, 'image_id': image_id, 'category_id': category_id, 'bbox': bbox,
+                        'area': area, 'iscrowd': iscrowd}
+                       for annotation_id, image_id, category_id, bbox, area, iscrowd in zip(*columns)]
+        return {'images': images, 'annotations': annotations, 'categories': categories}
+
+
+def build_index_columns(json_dict):
+    images = json_dict.get('images', list())
+    categories = json_dict.get('categories', list())
+    annotations = json_dict.get('annotations', list())
+    columns = dict()
+    columns['images_ids'] = np.array([image['id'] for image in images], dtype=np.int64)
+    columns['images_names'] = np.array([image['file_name'] for image in images], dtype=str)
+    columns['images_widths'] = np.array([image.get('width', -1) for image in images], dtype=np.int64)
+    columns['images_heights'] = np.array([image.get('height', -1) for image in images], dtype=np.int64)
+    columns['categories_ids'] = np.array([category['id'] for category in categories], dtype=np.int64)
+    columns['categories_names'] = np.array([category['name'] for category in categories], dtype=str)
+    columns['id'] = np.array([annotation.get('id', i + 1) for i, annotation in enumerate(annotations)],
+                             dtype=np.int64)
+    columns['image_id'] = np.array([annotation['image_id'] for annotation in annotations], dtype=np.int64)
+    columns['category_id'] = np.array([annotation['category_id'] for annotation in annotations], dtype=np.int64)
+    columns['bbox'] = np.array([annotation['bbox'] for annotation in annotations], dtype=np.float64).reshape(-1, 4)
+    columns['area'] = np.array([annotation.get('area', annotation['bbox'][2] * annotation['bbox'][3])
+                                for annotation in annotations], dtype=np.float64)
+    columns['iscrowd'] = np.array([annotation.get('iscrowd', 0) for annotation in annotations], dtype=np.int64)
+    # annotations of each image in file order
+    image_index = {image_id: i for i, image_id in enumerate(columns['images_ids'].tolist())}
+    annotations_images = np.array([image_index.get(image_id, len(images))
+                                   for image_id in columns['image_id'].tolist()], dtype=np.int64)
+    columns['images_order'] = np.argsort(annotations_images, kind='stable')
+    columns['images_offsets'] = np.searchsorted(annotations_images[columns['images_order']],
+                                                np.arange(len(images) + 1)).astype(np.int64)
+    return columns
+
+
+def save_index(json_file, columns, source_info):
+    index_folder = get_index_folder(json_file)
+    tmp_folder = tempfile.mkdtemp(prefix=os.path.basename(index_folder) + '.', dir=os.path.dirname(index_folder))
+    try:
+        for name in INDEX_COLUMNS:
+            np.save(os.path.join(tmp_folder, name + '.npy'), columns[name], allow_pickle=False)
+        # source info is written last and marks the index as complete
+        with open(os.path.join(tmp_folder, 'source.json'), 'w') as f:
+            json.dump(source_info, f)
+        if os.path.exists(index_folder):
+            shutil.rmtree(index_folder)
+        os.rename(tmp_folder, index_folder)
+    except OSError:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def read_index(json_file, source_info):
+    index_folder = get_index_folder(json_file)
+    try:
+        with open(os.path.join(index_folder, 'source.json'), 'r') as f:
+            if json.load(f) != source_info:
+                return None
+        return {name: np.load(os.path.join(index_folder, name + '.npy'), mmap_mode='r', allow_pickle=False)
+                for name in INDEX_COLUMNS}
+    except (OSError, ValueError):
+        return None
+
+
+def load_annotations_index(json_file):
+    """
+    Index of a COCO json file, built and saved next to the file if there is no valid index
+    """
+    source_info = get_source_info(json_file)
+    columns = read_index(json_file, source_info)
+    if columns is None:
+        with open(json_file, 'r') as f:
+            json_dict = json.load(f)
+        columns = build_index_columns(json_dict)
+        try:
+            save_index(json_file, columns, source_info)
+        except OSError:
+            # folder of the json file is not writable, index is used without saving
+            pass
+    return AnnotationsIndex(columns)
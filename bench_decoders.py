@@ -0,0 +1,75 @@
+"""
+Benchmark of image decoders on large images for a given network input size
+
+Every decoder runs in its own process, so peak memory of one decoder does not hide another one.
+Time is decoding of the file into an IMAGE as done by decode_image, image MB is the size of the decoded
+float IMAGE and peak MB is the growth of the process peak RSS during decoding.
+
+Example (3 JPEG images of 18-24 MP, network input 416x416):
+    decoder              images   ms/image   decoded MP   image MB    peak MB
+    darknet                   3      380.6         21.0      240.3      378.1
+    opencv                    3      304.1         21.0      240.3      345.8
+    opencv-reduced            3       33.9          0.3        3.8       11.2
+"""
+import os
+import time
+import resource
+import argparse
+import multiprocessing
+from darknet import decode_image, make_image, free_image, DECODERS
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-img-fld', '--images-folder', required=True, type=str)
+    parser.add_argument('-is', '--input-shape', type=int, nargs=2, default=[608, 608],
+                        help='Network input width and height used by reduced decoding')
+    parser.add_argument('-dec', '--decoders', type=str, nargs='+', choices=DECODERS, default=list(DECODERS))
+    parser.add_argument('-runs', '--runs', type=int, default=1)
+    return parser
+
+
+def get_peak_rss():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_decoder(images_files, decoder, target_size, runs, results):
+    # load the library and cv2 before measuring memory
+    free_image(make_image(1, 1, 3))
+    if decoder != 'darknet':
+        import cv2
+    base_rss = get_peak_rss()
+    decode_time, pixels, image_bytes = 0, 0, 0
+    for _ in range(runs):
+        for image_file in images_files:
+            start_time = time.perf_counter()
+            image = decode_image(image_file, decoder=decoder, target_size=target_size)
+            decode_time += time.perf_counter() - start_time
+            pixels += image.w * image.h
+            image_bytes += image.w * image.h * image.c * 4
+            free_image(image)
+    decodes = runs * len(images_files)
+    results.put((decode_time / decodes, pixels / decodes, image_bytes / decodes, get_peak_rss() - base_rss))
+
+
+def bench_decoders(images_folder, input_shape=(608, 608), decoders=DECODERS, runs=1):
+    images_files = [os.path.join(images_folder, image_name) for image_name in sorted(os.listdir(images_folder))]
+    context = multiprocessing.get_context('spawn')
+    print('{:<18} {:>8} {:>10} {:>12} {:>10} {:>10}'.format(
+        'decoder', 'images', 'ms/image', 'decoded MP', 'image MB', 'peak MB'))
+    for decoder in decoders:
+        results = context.Queue()
+        process = context.Process(target=bench_decoder,
+                                  args=(images_files, decoder, tuple(input_shape), runs, results))
+        process.start()
+        decode_time, pixels, image_bytes, peak_rss = results.get()
+        process.join()
+        print('{:<18} {:>8} {:>10.1f} {:>12.1f} {:>10.1f} {:>10.1f}'.format(
+            decoder, len(images_files), decode_time * 1000, pixels / 1e6, image_bytes / 2**20, peak_rss / 2**20))
+
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    bench_decoders(**vars(args))
@@ -0,0 +1,73 @@
+"""
+Benchmark of DetectorSession against detect_image_letterbox in a loop over images of several shapes
+
+Images are random HWC uint8 arrays, they are detected in turns, so the session switches between its buffers
+of every shape on each call. After the first round (warm-up) the session should not create any buffers,
+the run fails with RuntimeError if its allocations counter changes. Identical means equal predictions.
+
+Example (yolov4-tiny cfg on CPU, network input 416x416, 2 shapes, 10 rounds):
+    detector                   images   ms/image  allocations  identical
+    detect_image_letterbox         20     1324.8
+    DetectorSession                20     1277.0       4 -> 4       True
+"""
+import time
+import argparse
+import numpy as np
+from darknet import load_network, resize_network, free_network_ptr, detect_image_letterbox, DetectorSession
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-cfg', '--config-file', required=True, type=str)
+    parser.add_argument('-net', '--network-file', required=True, type=str)
+    parser.add_argument('-is', '--input-shape', type=int, nargs=2, default=[416, 416])
+    parser.add_argument('-shapes', '--images-shapes', type=int, nargs='+', default=[640, 480, 480, 640],
+                        help='Width and height pairs of images')
+    parser.add_argument('-rounds', '--rounds', type=int, default=50)
+    parser.add_argument('-seed', '--seed', type=int, default=0)
+    return parser
+
+
+def bench_session(config_file, network_file, input_shape=(416, 416), images_shapes=(640, 480, 480, 640), rounds=50,
+                  seed=0):
+    if len(images_shapes) % 2 != 0:
+        raise RuntimeError('Images shapes should be pairs of width and height')
+    rng = np.random.default_rng(seed)
+    images = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+              for width, height in zip(images_shapes[0::2], images_shapes[1::2])]
+    network = load_network(config_file, None, network_file)
+    try:
+        resize_network(network, input_shape[0], input_shape[1])
+        start_time = time.perf_counter()
+        reference = [detect_image_letterbox(network, image, as_array=True) for _ in range(rounds) for image in images]
+        reference_time = time.perf_counter() - start_time
+        session = DetectorSession(network)
+        # warm-up round creates buffers of every shape
+        for image in images:
+            session.detect(image)
+        warm_allocations = session.allocations
+        start_time = time.perf_counter()
+        predictions = list()
+        for _ in range(rounds):
+            for image in images:
+                predictions.append(session.detect(image))
+        session_time = time.perf_counter() - start_time
+        allocations = session.allocations
+        session.close()
+    finally:
+        free_network_ptr(network)
+    identical = all(np.array_equal(a, b) for a, b in zip(reference, predictions))
+    print('{:<24} {:>8} {:>10} {:>12} {:>10}'.format('detector', 'images', 'ms/image', 'allocations', 'identical'))
+    print('{:<24} {:>8} {:>10.1f}'.format('detect_image_letterbox', len(reference),
+                                          reference_time / len(reference) * 1000))
+    print('{:<24} {:>8} {:>10.1f} {:>12} {:>10}'.format(
+        'DetectorSession', len(predictions), session_time / len(predictions) * 1000,
+        '{} -> {}'.format(warm_allocations, allocations), str(identical)))
+    if allocations != warm_allocations:
+        raise RuntimeError('DetectorSession allocated {} buffers after warm-up'.format(allocations - warm_allocations))
+
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    bench_session(**vars(args))
@@ -0,0 +1,422 @@
+"""
+Vectorized COCO-style evaluation of bounding box detections
+
+Gives the same precision and recall as pycocotools COCOeval with iouType 'bbox' and default parameters:
+IoU thresholds .5:.05:.95, 101 recall thresholds, max detections 1, 10, 100 and all, small, medium, large areas.
+IoU matrix of every (image, category) pair is computed once and reused for all IoU thresholds and area ranges.
+Greedy matching is done for all pairs, thresholds and area ranges at once, going over detections ranks,
+pairs are bucketed by the number of ground truth boxes to limit padding.
+
+Usage:
+    results = evaluate_detections(annotations_dict, detections)
+    mAP = extract_mAP(results)
+    APs = extract_AP(results, get_classes(results))
+"""
+import numpy as np
+from tqdm import tqdm
+from annotations_index import build_index_columns
+
+
+IOU_THRESHOLDS = np.linspace(.5, .95, 10)
+RECALL_THRESHOLDS = np.linspace(.0, 1., 101)
+MAX_DETS = (1, 10, 100)
+AREA_RANGES = (('all', 0, 1e5 ** 2), ('small', 0, 32 ** 2), ('medium', 32 ** 2, 96 ** 2), ('large', 96 ** 2, 1e5 ** 2))
+
+
+def box_iou_matrix(dt, gt, crowd):
+    """
+    IoU of COCO boxes [left, top, width, height] dt (..., D, 4) and gt (..., G, 4), computed as bbIou
+    in pycocotools: for crowd ground truth boxes the union is the detection area
+    """
+    dt = dt[..., :, None, :]
+    gt = gt[..., None, :, :]
+    iw = np.minimum(dt[..., 0] + dt[..., 2], gt[..., 0] + gt[..., 2]) - np.maximum(dt[..., 0], gt[..., 0])
+    ih = np.minimum(dt[..., 1] + dt[..., 3], gt[..., 1] + gt[..., 3]) - np.maximum(dt[..., 1], gt[..., 1])
+    overlap = (iw > 0) & (ih > 0)
+    intersection = np.where(overlap, iw * ih, 0)
+    dt_area = dt[..., 2] * dt[..., 3]
+    union = np.where(crowd[..., None, :], dt_area, dt_area + gt[..., 2] * gt[..., 3] - intersection)
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=overlap)
+
+
+def get_detections_columns(detections):
+    """
+    Columns of a list of COCO detections dicts
+    """
+    columns = dict()
+    columns['image_id'] = np.array([detection['image_id'] for detection in detections], dtype=np.int64)
+    columns['category_id'] = np.array([detection['category_id'] for detection in detections], dtype=np.int64)
+    columns['bbox'] = np.array([detection['bbox'] for detection in detections], dtype=np.float64).reshape(-1, 4)
+    columns['score'] = np.array([detection['score'] for detection in detections], dtype=np.float64)
+    return columns
+
+
+def group_by_pair(images_indexes, categories_indexes, categories_num, order=None):
+    """
+    Sort order of items grouped by (image, category) pair keeping the order inside a pair,
+    pairs keys and start of every item's pair
+    """
+    keys = images_indexes * categories_num + categories_indexes
+    if order is None:
+        order = np.argsort(keys, kind='stable')
+    else:
+        order = order[np.argsort(keys[order], kind='stable')]
+    keys = keys[order]
+    starts = np.searchsorted(keys, keys, side='left')
+    return order, keys, starts
+
+
+def match_pairs(ious, dt_table, dt_counts, dt_outside, gt_ignore, gt_crowd, gt_valid_ids):
+    """
+    Greedy matching of padded (image, category) pairs as in COCOeval.evaluateImg for all IoU thresholds
+    and area ranges at once, going over detections ranks. Row p of dt_table has indexes of detections of pair p
+    in the order of scores, pairs should be sorted by the number of detections in descending order.
+    ious (N, G) are IoU of detections with ground truth boxes of their pairs, dt_outside (A, N) and gt_ignore (A, P, G)
+    are area ranges flags. Returns detections matches and ignore flags (A, T, N)
+    """
+    areas_num, thresholds_num = len(gt_ignore), len(IOU_THRESHOLDS)
+    thresholds = np.minimum(IOU_THRESHOLDS, 1 - 1e-10)[:, None, None]
+    gt_matched = np.zeros((areas_num, thresholds_num) + gt_crowd.shape, dtype=bool)
+    dt_matches = np.zeros((areas_num, thresholds_num, len(ious)), dtype=bool)
+    dt_ignore = np.zeros((areas_num, thresholds_num, len(ious)), dtype=bool)
+    all_valid_ids = gt_valid_ids.all()
+    a = np.arange(areas_num)[:, None, None]
+    t = np.arange(thresholds_num)[None, :, None]
+    for rank in range(dt_table.shape[1]):
+        # pairs having a detection of this rank
+        n = np.count_nonzero(dt_counts > rank)
+        p = np.arange(n)[None, None, :]
+        dets = dt_table[:n, rank]
+        iou = ious[dets]
+        candidates = (iou >= thresholds)[None] & ~(gt_matched[:, :, :n] & ~gt_crowd[:n])
+        # not ignored boxes are matched first and ties go to the last box as in COCOeval. Candidates IoU are
+        # at least .5 (and may exceed 1 by rounding for crowd boxes), so iou - 1 of ignored boxes is exact
+        # and lower than .5, the lowest key of not ignored boxes
+        keys = np.where(candidates, iou - gt_ignore[:, None, :n], -1)
+        best = keys.shape[-1] - 1 - keys[..., ::-1].argmax(axis=-1)
+        best_keys = np.take_along_axis(keys, best[..., None], axis=-1)[..., 0]
+        matched = best_keys > -1
+        gt_matched[a, t, p, best] |= matched
+        if all_valid_ids:
+            matches = matched
+        else:
+            # detections matched to a ground truth box with id 0 are counted as not matched in COCOeval
+            matches = matched & gt_valid_ids[p, best]
+        dt_matches[:, :, dets] = matches
+        dt_ignore[:, :, dets] = (matched & (best_keys < .5)) | (~matches & dt_outside[:, None, dets])
+    return dt_matches, dt_ignore
+
+
+def get_indexes(values, ids):
+    """
+    Indexes of values in sorted ids and mask of values found in ids
+    """
+    indexes = np.minimum(np.searchsorted(ids, values), max(len(ids) - 1, 0))
+    found = ids[indexes] == values if len(ids) > 0 else np.zeros(len(values), dtype=bool)
+    return indexes, found
+
+
+def match_detections(gt, gt_pairs, dt_boxes, dt_pairs, dt_ranks, pairs_num, area_ranges=AREA_RANGES):
+    """
+    Matching of all pairs, pairs are processed in buckets by the number of ground truth boxes
+    rounded up to a power of 2. Returns detections matches and ignore flags (A, T, N)
+    """
+    gt_counts = np.bincount(gt_pairs, minlength=pairs_num)
+    dt_counts = np.bincount(dt_pairs, minlength=pairs_num)
+    gt_ranks = np.arange(len(gt_pairs)) - np.searchsorted(gt_pairs, gt_pairs, side='left')
+    dt_areas = dt_boxes[:, 2] * dt_boxes[:, 3]
+    dt_outside = np.stack([(dt_areas < low) | (dt_areas > high) for _, low, high in area_ranges])
+    gt_areas, gt_crowd = gt['area'], gt['iscrowd'] != 0
+    gt_ignore = np.stack([gt_crowd | (gt_areas < low) | (gt_areas > high) for _, low, high in area_ranges])
+    # detections of pairs without ground truth boxes are not matched
+    shape = (len(area_ranges), len(IOU_THRESHOLDS), len(dt_pairs))
+    dt_matches = np.zeros(shape, dtype=bool)
+    dt_ignore = np.broadcast_to(dt_outside[:, None], shape).copy()
+    buckets = np.ceil(np.log2(np.maximum(gt_counts, 1))).astype(np.int64)
+    for bucket in np.unique(buckets[(dt_counts > 0) & (gt_counts > 0)]):
+        pairs = np.flatnonzero((buckets == bucket) & (dt_counts > 0) & (gt_counts > 0))
+        pairs = pairs[np.argsort(-dt_counts[pairs], kind='stable')]
+        local = np.full(pairs_num, -1, dtype=np.int64)
+        local[pairs] = np.arange(len(pairs))
+        shape = (len(pairs), gt_counts[pairs].max())
+        gt_mask = local[gt_pairs] >= 0
+        gt_index = (local[gt_pairs[gt_mask]], gt_ranks[gt_mask])
+        bucket_gt = dict()
+        for name, column in (('bbox', gt['bbox']), ('crowd', gt_crowd), ('valid_id', gt['id'] != 0)):
+            bucket_gt[name] = np.zeros(shape + column.shape[1:], dtype=column.dtype)
+            bucket_gt[name][gt_index] = column[gt_mask]
+        bucket_gt_ignore = np.ones((len(area_ranges),) + shape, dtype=bool)
+        bucket_gt_ignore[:, gt_index[0], gt_index[1]] = gt_ignore[:, gt_mask]
+        dets = np.flatnonzero(local[dt_pairs] >= 0)
+        dets_pairs = local[dt_pairs[dets]]
+        dt_table = np.zeros((len(pairs), dt_counts[pairs[0]]), dtype=np.int64)
+        dt_table[dets_pairs, dt_ranks[dets]] = np.arange(len(dets))
+        # padding boxes are zero and have zero IoU
+        ious = box_iou_matrix(dt_boxes[dets, None], bucket_gt['bbox'][dets_pairs],
+                              bucket_gt['crowd'][dets_pairs])[:, 0]
+        matches, ignore = match_pairs(ious, dt_table, dt_counts[pairs], dt_outside[:, dets], bucket_gt_ignore,
+                                      bucket_gt['crowd'], bucket_gt['valid_id'])
+        dt_matches[:, :, dets] = matches
+        dt_ignore[:, :, dets] = ignore
+    return dt_matches, dt_ignore
+
+
+def accumulate_category(scores, ranks, dt_matches, dt_ignore, gt_not_ignored_num, precision, recall,
+                        max_dets_list=MAX_DETS):
+    """
+    Precision (T, R, A, M) and recall (T, A, M) of one category as in COCOeval.accumulate,
+    detections are in the order of images and scores
+    """
+    for m, max_dets in enumerate(max_dets_list):
+        selected = ranks < max_dets
+        order = np.argsort(-scores[selected], kind='mergesort')
+        matches = dt_matches[:, :, selected][:, :, order]
+        ignore = dt_ignore[:, :, selected][:, :, order]
+        tp = np.cumsum(matches & ~ignore, axis=-1, dtype=np.float64)
+        fp = np.cumsum(~matches & ~ignore, axis=-1, dtype=np.float64)
+        dets_num = tp.shape[-1]
+        for a in np.flatnonzero(gt_not_ignored_num > 0):
+            rc = tp[a] / gt_not_ignored_num[a]
+            pr = tp[a] / (fp[a] + tp[a] + np.spacing(1))
+            recall[:, a, m] = rc[:, -1] if dets_num else 0
+            # precision envelope
+            pr = np.maximum.accumulate(pr[:, ::-1], axis=-1)[:, ::-1]
+            q = np.zeros((len(IOU_THRESHOLDS), len(RECALL_THRESHOLDS)))
+            for t in range(len(IOU_THRESHOLDS)):
+                indexes = np.searchsorted(rc[t], RECALL_THRESHOLDS, side='left')
+                valid = indexes < dets_num
+                q[t, valid] = pr[t, indexes[valid]]
+            precision[:, :, a, m] = q
+
+
+class GroundTruth:
+    """
+    Ground truth columns (images_ids, categories_ids, categories_names, id, image_id, category_id, bbox, area,
+    iscrowd) as loaded by annotations_index.py grouped by (image, category) pairs, prepared once
+    for evaluation of any number of detections
+    """
+    def __init__(self, gt, area_ranges=AREA_RANGES):
+        self.area_ranges = area_ranges
+        self.images_ids = np.unique(gt['images_ids'])
+        self.categories_ids, categories_order = np.unique(gt['categories_ids'], return_index=True)
+        self.categories_names = np.asarray(gt['categories_names'])[categories_order]
+        images, found_images = get_indexes(np.asarray(gt['image_id']), self.images_ids)
+        categories, found_categories = get_indexes(np.asarray(gt['category_id']), self.categories_ids)
+        mask = found_images & found_categories
+        # boxes in file order inside every pair
+        order, self.keys, _ = group_by_pair(images[mask], categories[mask], len(self.categories_ids))
+        self.columns = {name: np.asarray(gt[name])[mask][order] for name in ('id', 'bbox', 'area', 'iscrowd')}
+        crowd, areas = self.columns['iscrowd'] != 0, self.columns['area']
+        self.not_ignored = np.stack([~(crowd | (areas < low) | (areas > high)) for _, low, high in area_ranges],
+                                    axis=1)
+
+    def get_image_slice(self, i):
+        """
+        Slice of boxes of the i-th image
+        """
+        categories_num = len(self.categories_ids)
+        start, stop = np.searchsorted(self.keys, [i * categories_num, (i + 1) * categories_num])
+        return slice(int(start), int(stop))
+
+    def get_not_ignored_num(self, boxes=slice(None)):
+        """
+        Number of boxes which are not ignored (K, A) by categories and area ranges, boxes is a slice or indexes
+        """
+        categories = self.keys[boxes] % len(self.categories_ids)
+        return np.stack([np.bincount(categories, weights=not_ignored * 1., minlength=len(self.categories_ids))
+                         for not_ignored in self.not_ignored[boxes].T], axis=1)
+
+    def match(self, images, categories, boxes, scores, boxes_slice=slice(None)):
+        """
+        Matching of detections given by images and categories indexes with boxes of boxes_slice.
+        Returns pairs keys, ranks, scores and matches and ignore flags (A, T, N) of detections
+        kept in pairs, detections are in the order of pairs and scores
+        """
+        # detections in the order of scores inside every pair, at most MAX_DETS[-1] detections are kept in a pair
+        order, keys, starts = group_by_pair(images, categories, len(self.categories_ids),
+                                            order=np.argsort(-scores, kind='mergesort'))
+        ranks = np.arange(len(order)) - starts
+        kept = ranks < MAX_DETS[-1]
+        order, keys, ranks = order[kept], keys[kept], ranks[kept]
+        boxes, scores = boxes[order], scores[order]
+        pairs_keys = np.unique(keys)
+        gt_keys = self.keys[boxes_slice]
+        gt_pairs, found = get_indexes(gt_keys, pairs_keys)
+        gt = {name: column[boxes_slice][found] for name, column in self.columns.items()}
+        matches, ignore = match_detections(gt, gt_pairs[found], boxes, np.searchsorted(pairs_keys, keys), ranks,
+                                           len(pairs_keys), area_ranges=self.area_ranges)
+        return keys, ranks, scores, matches, ignore
+
+    def accumulate(self, keys, ranks, scores, matches, ignore, not_ignored_num, areas=None, max_dets_list=MAX_DETS):
+        """
+        Returns dict with precision (T, R, K, A, M) and recall (T, K, A, M) arrays of COCOeval.eval,
+        -1 for categories without ground truth boxes. Detections of a pair should be contiguous and in the order
+        of scores. areas are indexes of area ranges to accumulate, all by default
+        """
+        if areas is None:
+            areas = list(range(len(self.area_ranges)))
+        matches, ignore, not_ignored_num = matches[areas], ignore[areas], not_ignored_num[:, areas]
+        images_num, categories_num = len(self.images_ids), len(self.categories_ids)
+        precision = -np.ones((len(IOU_THRESHOLDS), len(RECALL_THRESHOLDS), categories_num, len(areas),
+                              len(max_dets_list)))
+        recall = -np.ones((len(IOU_THRESHOLDS), categories_num, len(areas), len(max_dets_list)))
+        # detections of every category in the order of images and ranks
+        categories = keys % categories_num
+        order = np.argsort(categories * images_num + keys // categories_num, kind='stable')
+        offsets = np.searchsorted(categories[order], np.arange(categories_num + 1))
+        for k in range(categories_num):
+            indexes = order[offsets[k]:offsets[k + 1]]
+            accumulate_category(scores[indexes], ranks[indexes], matches[:, :, indexes], ignore[:, :, indexes],
+                                not_ignored_num[k], precision[:, :, k], recall[:, k], max_dets_list=max_dets_list)
+        return {'precision': precision, 'recall': recall, 'categories_ids': self.categories_ids,
+                'categories_names': self.categories_names, 'areas': [self.area_ranges[a][0] for a in areas],
+                'max_dets': list(max_dets_list)}
+
+    def evaluate(self, dt):
+        """
+        Evaluation of detections columns dt (image_id, category_id, bbox, score)
+        """
+        images, found_images = get_indexes(np.asarray(dt['image_id']), self.images_ids)
+        categories, found_categories = get_indexes(np.asarray(dt['category_id']), self.categories_ids)
+        mask = found_images & found_categories
+        boxes = np.asarray(dt['bbox'], dtype=np.float64).reshape(-1, 4)[mask]
+        scores = np.asarray(dt['score'], dtype=np.float64)[mask]
+        matched = self.match(images[mask], categories[mask], boxes, scores)
+        return self.accumulate(*matched, self.get_not_ignored_num())
+
+
+def evaluate(gt, dt, area_ranges=AREA_RANGES):
+    """
+    Evaluation of detections columns dt (image_id, category_id, bbox, score) on ground truth columns gt,
+    see GroundTruth. All area ranges (name, low, high) are evaluated in one matching pass
+    """
+    return GroundTruth(gt, area_ranges=area_ranges).evaluate(dt)
+
+
+def get_coco_boxes(predictions, width, height):
+    """
+    COCO boxes of a structured array of predictions (see darknet.PREDICTION_DTYPE)
+    clipped by the image borders as by predict_writers.get_coco_annotation
+    """
+    x, y, w, h = (predictions[field].astype(np.float64) for field in ('x', 'y', 'w', 'h'))
+    left = np.maximum(x - w / 2, 0)
+    top = np.maximum(y - h / 2, 0)
+    right = np.minimum(x + w / 2, width)
+    bottom = np.minimum(y + h / 2, height)
+    return np.stack([left, top, right - left, bottom - top], axis=1)
+
+
+class CocoEvaluator:
+    """
+    Incremental evaluation of predictions added image by image as soon as they are predicted.
+    Detections of an image are matched when it is added and only their scores, ranks and matching flags are kept.
+    Results are computed on the ground truth of added images, so partial results are available at any time,
+    and when all images are added they are the same as evaluation of the predictions file.
+    Every image should be added once. With log_every partial mAP is printed every log_every images.
+    Matching results are kept per image, so results can be also computed on bootstrap samples of added images
+    """
+    def __init__(self, ground_truth, log_every=0):
+        self.ground_truth = ground_truth
+        self.log_every = log_every
+        self.images_indexes = {image_id: i for i, image_id in enumerate(ground_truth.images_ids.tolist())}
+        self.not_ignored_num = np.zeros((len(ground_truth.categories_ids), len(ground_truth.area_ranges)))
+        self.matched = list()
+        self.boxes_slices = list()
+        self.images_num = 0
+        self.detections_num = 0
+
+    def add(self, image_id, width, height, predictions):
+        """
+        predictions is a structured array of predictions of the image (see darknet.PREDICTION_DTYPE)
+        """
+        self.images_num += 1
+        self.detections_num += len(predictions)
+        i = self.images_indexes.get(image_id)
+        # images without ground truth are not evaluated as in COCOeval
+        if i is not None:
+            boxes_slice = self.ground_truth.get_image_slice(i)
+            self.not_ignored_num += self.ground_truth.get_not_ignored_num(boxes_slice)
+            categories, found = get_indexes(predictions['class_id'].astype(np.int64) + 1,
+                                            self.ground_truth.categories_ids)
+            boxes = get_coco_boxes(predictions, width, height)[found]
+            scores = predictions['score'].astype(np.float64)[found]
+            self.matched.append(self.ground_truth.match(np.full(len(boxes), i), categories[found], boxes, scores,
+                                                        boxes_slice=boxes_slice))
+            self.boxes_slices.append(boxes_slice)
+        if self.log_every and (self.images_num % self.log_every == 0):
+            area = self.ground_truth.area_ranges[0][0]
+            tqdm.write('{} images: mAP {:.4f}'.format(self.images_num, extract_mAP(self.get_results(), area=area)))
+
+    def get_results(self):
+        areas_num, thresholds_num = len(self.ground_truth.area_ranges), len(IOU_THRESHOLDS)
+        if len(self.matched) == 0:
+            flags = np.zeros((areas_num, thresholds_num, 0), dtype=bool)
+            matched = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), flags, flags)
+        else:
+            matched = [np.concatenate(columns, axis=-1) for columns in zip(*self.matched)]
+        return self.ground_truth.accumulate(*matched, self.not_ignored_num)
+
+    def get_bootstrap_mAPs(self, resamples, seed=0, area=None, max_dets=100):
+        """
+        mAPs of resamples bootstrap samples of added images with ground truth, images are drawn with replacement
+        and a repeated image counts as another image. Only the area range (the first by default) and max_dets
+        are accumulated
+        """
+        if len(self.matched) == 0:
+            return list()
+        rng = np.random.default_rng(seed)
+        names = [name for name, _, _ in self.ground_truth.area_ranges]
+        areas = [0 if area is None else names.index(area)]
+        categories_num = len(self.ground_truth.categories_ids)
+        mAPs = list()
+        for _ in range(resamples):
+            sample = rng.integers(0, len(self.matched), len(self.matched)).tolist()
+            keys = np.concatenate([position * categories_num + self.matched[i][0] % categories_num
+                                   for position, i in enumerate(sample)])
+            ranks, scores, matches, ignore = [np.concatenate([self.matched[i][j] for i in sample], axis=-1)
+                                              for j in range(1, 5)]
+            boxes = np.concatenate([np.arange(self.boxes_slices[i].start, self.boxes_slices[i].stop)
+                                    for i in sample])
+            results = self.ground_truth.accumulate(keys, ranks, scores, matches, ignore,
+                                                   self.ground_truth.get_not_ignored_num(boxes), areas=areas,
+                                                   max_dets_list=(max_dets,))
+            mAPs.append(extract_mAP(results, area=results['areas'][0], max_dets=max_dets))
+        return mAPs
+
+
+def evaluate_detections(annotations_dict, detections, area_ranges=AREA_RANGES):
+    """
+    Evaluation of a list of COCO detections dicts on COCO annotations dict
+    """
+    return evaluate(build_index_columns(annotations_dict), get_detections_columns(detections),
+                    area_ranges=area_ranges)
+
+
+def get_classes(results):
+    return results['categories_names'].tolist()
+
+
+def get_area_index(results, area):
+    return results['areas'].index(area)
+
+
+def mean_precision(precision):
+    precision = precision[precision > -1]
+    return float(np.mean(precision)) if len(precision) > 0 else -1.
+
+
+def extract_mAP(results, area='all', max_dets=100):
+    """
+    AP@[.5:.95] averaged over categories, the first number of COCOeval.summarize for area 'all'
+    """
+    return mean_precision(results['precision'][:, :, :, get_area_index(results, area),
+                                               results['max_dets'].index(max_dets)])
+
+
+def extract_AP(results, classes, area='all', max_dets=100):
+    """
+    AP@[.5:.95] of every class in classes, -1 for classes without ground truth boxes
+    """
+    names = get_classes(results)
+    precision = results['precision'][:, :, :, get_area_index(results, area), results['max_dets'].index(max_dets)]
+    return [mean_precision(precision[:, :, names.index(cl)]) for cl in classes]
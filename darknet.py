@@ -26,7 +26,15 @@ import math
 import random
 import os
 import argparse
-import cv2
+import threading
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from time import perf_counter
+import numpy as np
+from darknet_nms import NMS
+from annotations_index import load_annotations_index
 
 
 class BOX(Structure):
@@ -67,6 +75,112 @@ class METADATA(Structure):
                 ("names", POINTER(c_char_p))]
 
 
+# numpy view of the DETECTION structure (pointer fields are read as addresses)
+DETECTION_DTYPE = np.dtype({
+    'names': ['x', 'y', 'w', 'h', 'prob'],
+    'formats': [np.float32, np.float32, np.float32, np.float32, np.uintp],
+    'offsets': [DETECTION.bbox.offset + BOX.x.offset, DETECTION.bbox.offset + BOX.y.offset,
+                DETECTION.bbox.offset + BOX.w.offset, DETECTION.bbox.offset + BOX.h.offset,
+                DETECTION.prob.offset],
+    'itemsize': sizeof(DETECTION)})
+
+PREDICTION_DTYPE = np.dtype([('class_id', np.int32), ('score', np.float32),
+                             ('x', np.float32), ('y', np.float32), ('w', np.float32), ('h', np.float32)])
+
+
+class StageStats:
+    """
+    Time spent in detection pipeline stages: decode, letterbox, forward, boxes, nms, extraction.
+    Count and sum are kept for all samples, percentiles are computed over the last max_samples samples.
+    """
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.counts = OrderedDict()
+        self.sums = OrderedDict()
+        self.samples = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.add_sample(stage, seconds)
+
+    def add_sample(self, stage, seconds):
+        if stage not in self.counts:
+            self.counts[stage] = 0
+            self.sums[stage] = 0.
+            self.samples[stage] = deque(maxlen=self.max_samples)
+        self.counts[stage] += 1
+        self.sums[stage] += seconds
+        self.samples[stage].append(seconds)
+
+    def summary(self):
+        """
+        Returns dict stage -> {count, sum, mean, p50, p95, p99}, times are in seconds
+        """
+        summary = OrderedDict()
+        with self.lock:
+            samples = {stage: np.array(stage_samples) for stage, stage_samples in self.samples.items()}
+            counts = list(self.counts.items())
+        for stage, count in counts:
+            p50, p95, p99 = np.percentile(samples[stage], [50, 95, 99])
+            summary[stage] = {'count': count, 'sum': self.sums[stage], 'mean': self.sums[stage] / count,
+                              'p50': p50, 'p95': p95, 'p99': p99}
+        return summary
+
+    def report(self):
+        lines = ['{:<12} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+            'stage', 'count', 'sum s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms')]
+        for stage, stats in self.summary().items():
+            lines.append('{:<12} {:>8} {:>10.3f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                stage, stats['count'], stats['sum'], stats['mean'] * 1000, stats['p50'] * 1000,
+                stats['p95'] * 1000, stats['p99'] * 1000))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.sums.clear()
+            self.samples.clear()
+
+
+# stage timing is disabled while stage_stats is None
+stage_stats = None
+
+
+def enable_stage_timing(max_samples=10000):
+    global stage_stats
+    if stage_stats is None:
+        stage_stats = StageStats(max_samples=max_samples)
+    return stage_stats
+
+
+def disable_stage_timing():
+    global stage_stats
+    stats = stage_stats
+    stage_stats = None
+    return stats
+
+
+def stage_start():
+    """
+    Start time of a stage or None if timing is disabled
+    """
+    if stage_stats is None:
+        return None
+    return perf_counter()
+
+
+def stage_end(stage, start):
+    """
+    Record the stage started at start and return start time of the next stage
+    """
+    if start is None or stage_stats is None:
+        return None
+    end = perf_counter()
+    stage_stats.add(stage, end - start)
+    return end
+
+
 def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-cfg', '--config-file', required=True, type=str)
@@ -81,14 +195,6 @@ def build_parser():
     return parser
 
 
-def network_width(net):
-    return lib.network_width(net)
-
-
-def network_height(net):
-    return lib.network_height(net)
-
-
 def bbox2points(bbox):
     """
     From bounding box yolo format
@@ -113,6 +219,10 @@ def class_colors(names):
         random.randint(0, 255)) for name in names}
 
 
+# batch networks were allocated with, set_batch_network can not make it higher
+networks_batches = dict()
+
+
 def load_network(config_file, data_file, weights, batch_size=1):
     """
     load model description and weights from config files
@@ -120,6 +230,7 @@ def load_network(config_file, data_file, weights, batch_size=1):
         config_file (str): path to .cfg model file
         data_file (str): path to .data model file
         weights (str): path to weights
+        batch_size (int): batch the network is allocated with, the highest batch it can be run with
     returns:
         network: trained model
         class_names
@@ -128,15 +239,35 @@ def load_network(config_file, data_file, weights, batch_size=1):
     network = load_net_custom(
         config_file.encode("ascii"),
         weights.encode("ascii"), 0, batch_size)
+    networks_batches[network] = batch_size
     if data_file:
-        metadata = load_meta(data_file.encode("ascii"))
-        class_names = [metadata.names[i].decode("ascii") for i in range(metadata.classes)]
+        class_names = load_class_names(data_file)
         colors = class_colors(class_names)
     else:
         return network
     return network, class_names, colors
 
 
+def get_network_batch(network):
+    """
+    Batch the network was allocated with by load_network, 1 for networks loaded otherwise
+    """
+    return networks_batches.get(network, 1)
+
+
+def reload_network_weights(network, weights):
+    """
+    Replace weights of a network loaded with load_network by weights of another checkpoint of the same cfg,
+    the network is not parsed and allocated again
+    """
+    reload_weights(network, weights.encode("ascii"))
+
+
+def load_class_names(data_file):
+    metadata = load_meta(data_file.encode("ascii"))
+    return [metadata.names[i].decode("ascii") for i in range(metadata.classes)]
+
+
 def print_detections(detections, coordinates=False):
     print("\nObjects:")
     for label, confidence, bbox in detections:
@@ -148,6 +279,7 @@ def print_detections(detections, coordinates=False):
 
 
 def draw_boxes(detections, image, colors):
+    import cv2
     for label, confidence, bbox in detections:
         left, top, right, bottom = bbox2points(bbox)
         cv2.rectangle(image, (left, top), (right, bottom), colors[label], 1)
@@ -165,268 +297,869 @@ def decode_detection(detections):
     return decoded
 
 
+def image_as_array(image):
+    """
+    Planar (c, h, w) float view of IMAGE data, no copy is made
+    """
+    return np.ctypeslib.as_array(image.data, shape=(image.c, image.h, image.w))
+
+
+def array_to_image(array, image=None, bgr=False):
+    """
+    Fill planar float IMAGE with HWC uint8 array in a single pass.
+    If image is not given or has a different shape a new one is created,
+    it should be freed by the caller with free_image
+    """
+    height, width, channels = array.shape
+    if (image is None) or ((image.w, image.h, image.c) != (width, height, channels)):
+        image = make_image(width, height, channels)
+    if bgr:
+        array = array[..., ::-1]
+    np.divide(array.transpose(2, 0, 1), 255., out=image_as_array(image), casting='same_kind')
+    return image
+
+
+def detections_to_array(detections, num, classes_num):
+    """
+    Extract all (detection, class) pairs with positive probability
+    into a structured array with PREDICTION_DTYPE fields,
+    in the same order as the detections are stored
+    """
+    if num == 0:
+        return np.empty(0, dtype=PREDICTION_DTYPE)
+    buffer = (c_char * (num * sizeof(DETECTION))).from_address(addressof(detections.contents))
+    dets = np.frombuffer(buffer, dtype=DETECTION_DTYPE)
+    probs = np.empty((num, classes_num), dtype=np.float32)
+    row_size = classes_num * sizeof(c_float)
+    probs_address = probs.ctypes.data
+    for j, prob_address in enumerate(dets['prob'].tolist()):
+        memmove(probs_address + j * row_size, prob_address, row_size)
+    det_idx, class_idx = np.nonzero(probs > 0)
+    predictions = np.empty(len(det_idx), dtype=PREDICTION_DTYPE)
+    predictions['class_id'] = class_idx
+    predictions['score'] = probs[det_idx, class_idx]
+    for field in ('x', 'y', 'w', 'h'):
+        predictions[field] = dets[field][det_idx]
+    return predictions
+
+
+def top_k_predictions(predictions, k=None):
+    """
+    Leave k predictions with highest scores sorted by score in ascending order.
+    Gives the same result as stable sorting by score and taking the last k predictions
+    """
+    scores = predictions['score']
+    n = len(predictions)
+    if (k is None) or (n <= k):
+        return predictions[np.argsort(scores, kind='stable')]
+    if k <= 0:
+        return predictions[:0]
+    kth_score = scores[np.argpartition(scores, n - k)[n - k]]
+    above = np.flatnonzero(scores > kth_score)
+    ties = np.flatnonzero(scores == kth_score)
+    ties = ties[len(ties) - (k - len(above)):]
+    indexes = np.sort(np.concatenate((above, ties)))
+    return predictions[indexes[np.argsort(scores[indexes], kind='stable')]]
+
+
+def array_to_predictions(predictions, class_names=None):
+    """
+    Convert structured array of predictions to the list of (class, score, (x, y, w, h)) tuples.
+    Class ids are replaced with names if class_names is given
+    """
+    classes = predictions['class_id'].tolist()
+    if class_names is not None:
+        classes = [class_names[class_id] for class_id in classes]
+    bboxes = zip(predictions['x'].tolist(), predictions['y'].tolist(),
+                 predictions['w'].tolist(), predictions['h'].tolist())
+    return list(zip(classes, predictions['score'].tolist(), bboxes))
+
+
+def get_predictions(detections, num, classes_num, nms=.45):
+    """
+    Apply NMS and extract predictions array.
+    nms is either do_nms_sort threshold or NMS settings for NMS on the extracted array
+    """
+    start = stage_start()
+    if nms and not isinstance(nms, NMS):
+        do_nms_sort(detections, num, classes_num, nms)
+        start = stage_end('nms', start)
+    predictions = detections_to_array(detections, num, classes_num)
+    start = stage_end('extraction', start)
+    if isinstance(nms, NMS):
+        predictions = nms(predictions)
+        stage_end('nms', start)
+    return predictions
+
+
 def remove_negatives(detections, class_names, num):
     """
     Remove all classes with 0% confidence within the detection
     """
-    predictions = []
-    for j in range(num):
-        for idx, name in enumerate(class_names):
-            if detections[j].prob[idx] > 0:
-                bbox = detections[j].bbox
-                bbox = (bbox.x, bbox.y, bbox.w, bbox.h)
-                predictions.append((name, detections[j].prob[idx], (bbox)))
-    return predictions
+    predictions = detections_to_array(detections, num, len(class_names))
+    return array_to_predictions(predictions, class_names)
 
 
 def remove_negatives_num(detections, classes_num, num):
     """
     Remove all classes with 0% confidence within the detection
     """
-    predictions = []
-    for j in range(num):
-        for class_id in range(classes_num):
-            if detections[j].prob[class_id] > 0:
-                bbox = detections[j].bbox
-                bbox = (bbox.x, bbox.y, bbox.w, bbox.h)
-                predictions.append((class_id, detections[j].prob[class_id], (bbox)))
-    return predictions
+    predictions = detections_to_array(detections, num, classes_num)
+    return array_to_predictions(predictions)
 
 
-def detect_image_resize(network, class_names, image, thresh=.5, hier_thresh=.5, nms=.45):
+def detect_image_resize(network, class_names, image, thresh=.5, hier_thresh=.5, nms=.45, image_buffer=None, bgr=False):
     """
         Returns a list with highest confidence class and their bbox
+        image can be IMAGE or HWC uint8 numpy array, the latter is copied into image_buffer if it has the same shape
     """
+    start = stage_start()
+    b_free_image = False
+    if isinstance(image, np.ndarray):
+        image = array_to_image(image, image_buffer, bgr=bgr)
+        b_free_image = image is not image_buffer
+        start = stage_end('decode', start)
     pnum = pointer(c_int(0))
     predict_image(network, image)
+    start = stage_end('forward', start)
     detections = get_network_boxes(network, image.w, image.h,
                                    thresh, hier_thresh, None, 0, pnum, 0)
     num = pnum[0]
-    if nms:
-        do_nms_sort(detections, num, len(class_names), nms)
-    predictions = remove_negatives(detections, class_names, num)
-    predictions = decode_detection(predictions)
+    stage_end('boxes', start)
+    predictions = get_predictions(detections, num, len(class_names), nms=nms)
     free_detections(detections, num)
-    return sorted(predictions, key=lambda x: x[1])
+    if b_free_image:
+        free_image(image)
+    start = stage_start()
+    predictions = top_k_predictions(predictions)
+    stage_end('extraction', start)
+    predictions = decode_detection(array_to_predictions(predictions, class_names))
+    return predictions
 
 
-def detect_image_letterbox(network, image, thresh=.001, hier_thresh=.5, nms=.45, max_dets=1000):
+def detect_image_letterbox(network, image, thresh=.001, hier_thresh=.5, nms=.45, max_dets=1000, as_array=False,
+                           image_buffer=None, bgr=False):
     """
         Returns a list with highest confidence class and their bbox
+        or a structured array with PREDICTION_DTYPE fields if as_array is set
+        image can be a path, IMAGE or HWC uint8 numpy array, the latter is copied into image_buffer if it has the same shape
     """
+    start = stage_start()
     b_free_image = False
     if isinstance(image, str):
         b_free_image = True
         image = load_image(image.encode(), 0, 0)
+        start = stage_end('decode', start)
+    elif isinstance(image, np.ndarray):
+        image = array_to_image(image, image_buffer, bgr=bgr)
+        b_free_image = image is not image_buffer
+        start = stage_end('decode', start)
+    width = network_width(network)
+    height = network_height(network)
+    if (image.w, image.h) == (width, height):
+        predict_image_letterbox(network, image)
+    else:
+        boxed = letterbox_image(image, width, height)
+        start = stage_end('letterbox', start)
+        predict_image_letterbox(network, boxed)
+        free_image(boxed)
+    start = stage_end('forward', start)
     pnum = pointer(c_int(0))
-    predict_image_letterbox(network, image)
     detections = get_network_boxes(network, image.w, image.h,
                                    thresh, hier_thresh, None, 0, pnum, 1)
     num = pnum[0]
+    stage_end('boxes', start)
     classes_num = get_network_classes_num_ptr(network)
-    if nms:
-        do_nms_sort(detections, num, classes_num, nms)
-    predictions = remove_negatives_num(detections, classes_num, num)
-    # predictions = decode_detection(predictions)
+    predictions = scale_to_original_size(get_predictions(detections, num, classes_num, nms=nms), image)
     free_detections(detections, num)
     if b_free_image:
         free_image(image)
-    predictions = sorted(predictions, key=lambda x: x[1])
-    if len(predictions) > max_dets:
-        predictions = predictions[len(predictions)-max_dets:]
-    return predictions
+    start = stage_start()
+    predictions = top_k_predictions(predictions, max_dets)
+    stage_end('extraction', start)
+    if as_array:
+        return predictions
+    return array_to_predictions(predictions)
 
 
-def get_class_id_to_name(classes_file=None):
-    if classes_file is None:
-        return None
-    if classes_file.endswith('.json'):
-        return get_class_id_to_name_from_json(classes_file)
-    if classes_file.endswith('.names'):
-        return get_class_id_to_name_from_list(classes_file)
-    return None
+def letterbox_shape(width, height, net_width, net_height):
+    """
+    Size of the image inside the letterbox, computed as in letterbox_image
+    """
+    if (np.float32(net_width) / np.float32(width)) < (np.float32(net_height) / np.float32(height)):
+        return net_width, (height * net_width) // width
+    return (width * net_height) // height, net_height
 
 
-def get_class_id_to_name_from_json(json_file):
-    with open(json_file, 'r') as f:
-        json_dict = json.load(f)
-    categories = json_dict['categories']
-    class_id_to_name = dict()
-    for category in categories:
-        class_id_to_name[category['id']-1] = category['name']
-    return class_id_to_name
+def correct_letterbox_boxes(detections, num, width, height, net_width, net_height):
+    """
+    Map boxes relative to the letterboxed network input to the image coordinates in place,
+    computed as in correct_yolo_boxes
+    """
+    if num == 0:
+        return
+    buffer = (c_char * (num * sizeof(DETECTION))).from_address(addressof(detections.contents))
+    dets = np.frombuffer(buffer, dtype=DETECTION_DTYPE)
+    new_w, new_h = letterbox_shape(width, height, net_width, net_height)
+    ratio_w = np.float32(new_w) / np.float32(net_width)
+    ratio_h = np.float32(new_h) / np.float32(net_height)
+    x = ((dets['x'] - (net_width - new_w) / 2. / net_width) / ratio_w).astype(np.float32)
+    y = ((dets['y'] - (net_height - new_h) / 2. / net_height) / ratio_h).astype(np.float32)
+    dets['x'] = x * np.float32(width)
+    dets['y'] = y * np.float32(height)
+    dets['w'] = dets['w'] * (np.float32(1) / ratio_w) * np.float32(width)
+    dets['h'] = dets['h'] * (np.float32(1) / ratio_h) * np.float32(height)
+
+
+def detect_batch_letterbox(network, images, thresh=.001, hier_thresh=.5, nms=.45, max_dets=1000, as_array=False,
+                           batch_size=None, bgr=False):
+    """
+        Letterbox detection of images of any sizes in one forward pass
+        images can be paths, IMAGEs or HWC uint8 numpy arrays
+        Network should be loaded with batch not less than batch_size (len(images) by default),
+        otherwise ValueError is raised
+        Returns a list of predictions for each image in its own coordinates
+    """
+    if batch_size is None:
+        batch_size = len(images)
+    if len(images) > batch_size:
+        raise ValueError("Number of images is higher than batch size")
+    width = network_width(network)
+    height = network_height(network)
+    batch = np.full((batch_size, 3, height, width), .5, dtype=np.float32)
+    shapes = list()
+    for i, image in enumerate(images):
+        start = stage_start()
+        b_free_image = False
+        if isinstance(image, str):
+            b_free_image = True
+            image = load_image(image.encode(), 0, 0)
+            start = stage_end('decode', start)
+        elif isinstance(image, np.ndarray):
+            b_free_image = True
+            image = array_to_image(image, bgr=bgr)
+            start = stage_end('decode', start)
+        if (image.w, image.h) == (width, height):
+            batch[i] = image_as_array(image)
+        else:
+            boxed = IMAGE(width, height, 3, batch[i].ctypes.data_as(POINTER(c_float)))
+            letterbox_image_into(image, width, height, boxed)
+        stage_end('letterbox', start)
+        shapes.append((image.w, image.h, getattr(image, 'original_size', None)))
+        if b_free_image:
+            free_image(image)
+    return detect_batch_input(network, batch, shapes, thresh=thresh, hier_thresh=hier_thresh, nms=nms,
+                              max_dets=max_dets, as_array=as_array)
 
 
-def get_class_id_to_name_from_list(list_file):
-    class_id_to_name = dict()
-    class_id = 0
-    with open(list_file, 'r') as f:
-        classes_names = f.readlines()
-    for class_name in classes_names:
-        if class_name[-1] == '\n':
-            class_name = class_name[:-1]
-        class_id_to_name[class_id] = class_name
-        class_id += 1
-    return class_id_to_name
+def detect_batch_input(network, batch, shapes, thresh=.001, hier_thresh=.5, nms=.45, max_dets=1000, as_array=False):
+    """
+        Forward pass of a letterboxed (batch_size, 3, height, width) float32 batch of the network input size
+        shapes are (width, height, original_size) of images in the batch, original_size is None
+        or the size boxes are scaled to from width x height
+        Returns a list of predictions for each image in its own coordinates
+    """
+    batch_size, _, height, width = batch.shape
+    # layers buffers are allocated for the batch of load_network, a higher batch overflows them
+    if batch_size > get_network_batch(network):
+        raise ValueError("Batch size {} is higher than batch {} the network was loaded with".format(
+            batch_size, get_network_batch(network)))
+    classes_num = get_network_classes_num_ptr(network)
+    start = stage_start()
+    set_batch_network(network, batch_size)
+    batch_image = IMAGE(width, height, 3, batch.ctypes.data_as(POINTER(c_float)))
+    # forward pass and boxes extraction are done in one call
+    batch_detections = network_predict_batch(network, batch_image, batch_size, width, height,
+                                             thresh, hier_thresh, None, 1, 0)
+    stage_end('forward', start)
+    batch_predictions = list()
+    for i, (image_width, image_height, original_size) in enumerate(shapes):
+        num = batch_detections[i].num
+        detections = batch_detections[i].dets
+        start = stage_start()
+        correct_letterbox_boxes(detections, num, image_width, image_height, width, height)
+        stage_end('boxes', start)
+        predictions = get_predictions(detections, num, classes_num, nms=nms)
+        predictions = scale_predictions(predictions, (image_width, image_height), original_size)
+        start = stage_start()
+        predictions = top_k_predictions(predictions, max_dets)
+        stage_end('extraction', start)
+        batch_predictions.append(predictions if as_array else array_to_predictions(predictions))
+    free_batch_detections(batch_detections, batch_size)
+    return batch_predictions
+
+
+def detect_letterboxed(network, tensors, sizes, thresh=.001, hier_thresh=.5, nms=.45, max_dets=1000, as_array=False,
+                       batch_size=None, batch=None):
+    """
+        Detection of images already letterboxed to the network input size, e.g. kept in a tensor cache
+        tensors are planar (3, height, width) uint8 arrays and sizes are (width, height) of the original images
+        Network should be loaded with batch not less than batch_size (len(tensors) by default),
+        otherwise ValueError is raised. batch is an optional float32 buffer of shape (batch_size, 3, height, width) reused between calls
+        Returns a list of predictions for each image in its original coordinates
+    """
+    if batch_size is None:
+        batch_size = len(tensors)
+    if len(tensors) > batch_size:
+        raise ValueError("Number of images is higher than batch size")
+    width = network_width(network)
+    height = network_height(network)
+    if (batch is None) or (batch.shape != (batch_size, 3, height, width)):
+        batch = np.empty((batch_size, 3, height, width), dtype=np.float32)
+    start = stage_start()
+    for i, tensor in enumerate(tensors):
+        if tensor.shape != (3, height, width):
+            raise ValueError("Letterboxed image shape {} differs from the network input".format(tensor.shape))
+        np.divide(tensor, 255., out=batch[i], casting='same_kind')
+    batch[len(tensors):] = .5
+    stage_end('letterbox', start)
+    # letterbox geometry is restored from the original sizes as in correct_yolo_boxes
+    shapes = [(image_width, image_height, None) for image_width, image_height in sizes]
+    return detect_batch_input(network, batch, shapes, thresh=thresh, hier_thresh=hier_thresh, nms=nms,
+                              max_dets=max_dets, as_array=as_array)
+
+
+class DetectorSession:
+    """
+    Network with cached parameters and reusable image buffers for detection in a loop.
+    Input and letterbox buffers are kept per image shape, so in steady state
+    no images are allocated on Python side. allocations counts created buffers.
+    """
+    def __init__(self, network, thresh=.001, hier_thresh=.5, nms=.45, max_dets=1000, max_shapes=4):
+        self.network = network
+        self.thresh = thresh
+        self.hier_thresh = hier_thresh
+        self.nms = nms
+        self.max_dets = max_dets
+        self.max_shapes = max_shapes
+        self.width = network_width(network)
+        self.height = network_height(network)
+        self.classes_num = get_network_classes_num_ptr(network)
+        self.input_buffers = dict()
+        self.letterbox_buffers = dict()
+        self.pnum = pointer(c_int(0))
+        self.allocations = 0
+
+    def resize(self, width, height):
+        if (width, height) == (self.width, self.height):
+            return
+        resize_network(self.network, width, height)
+        self.width = network_width(self.network)
+        self.height = network_height(self.network)
+        self.free_buffers(self.letterbox_buffers)
+
+    def get_buffer(self, buffers, shape, width, height, channels, fill=None):
+        buffer = buffers.get(shape)
+        if buffer is not None:
+            return buffer
+        if len(buffers) >= self.max_shapes:
+            free_image(buffers.pop(next(iter(buffers))))
+        buffer = make_image(width, height, channels)
+        if fill is not None:
+            fill_image(buffer, fill)
+        self.allocations += 1
+        buffers[shape] = buffer
+        return buffer
+
+    def get_input_buffer(self, shape):
+        height, width, channels = shape
+        return self.get_buffer(self.input_buffers, shape, width, height, channels)
+
+    def get_letterbox_buffer(self, image):
+        shape = (image.w, image.h, image.c)
+        return self.get_buffer(self.letterbox_buffers, shape, self.width, self.height, image.c, fill=.5)
+
+    def detect(self, image, bgr=False, as_array=True):
+        """
+            Letterbox detection of a path, IMAGE or HWC uint8 numpy array
+            Returns a structured array with PREDICTION_DTYPE fields
+            or a list of (class_id, score, bbox) if as_array is False
+        """
+        start = stage_start()
+        b_free_image = False
+        if isinstance(image, str):
+            b_free_image = True
+            image = load_image(image.encode(), 0, 0)
+            start = stage_end('decode', start)
+        elif isinstance(image, np.ndarray):
+            image = array_to_image(image, self.get_input_buffer(image.shape), bgr=bgr)
+            start = stage_end('decode', start)
+        if (image.w, image.h) == (self.width, self.height):
+            predict_image_letterbox(self.network, image)
+        else:
+            boxed = self.get_letterbox_buffer(image)
+            letterbox_image_into(image, self.width, self.height, boxed)
+            start = stage_end('letterbox', start)
+            predict_image_letterbox(self.network, boxed)
+        start = stage_end('forward', start)
+        detections = get_network_boxes(self.network, image.w, image.h,
+                                       self.thresh, self.hier_thresh, None, 0, self.pnum, 1)
+        num = self.pnum[0]
+        stage_end('boxes', start)
+        predictions = scale_to_original_size(get_predictions(detections, num, self.classes_num, nms=self.nms),
+                                             image)
+        free_detections(detections, num)
+        if b_free_image:
+            free_image(image)
+        start = stage_start()
+        predictions = top_k_predictions(predictions, self.max_dets)
+        stage_end('extraction', start)
+        if as_array:
+            return predictions
+        return array_to_predictions(predictions)
+
+    __call__ = detect
+
+    def free_buffers(self, buffers):
+        for buffer in buffers.values():
+            free_image(buffer)
+        buffers.clear()
+
+    def close(self, free_network=False):
+        self.free_buffers(self.input_buffers)
+        self.free_buffers(self.letterbox_buffers)
+        if free_network and (self.network is not None):
+            free_network_ptr(self.network)
+            self.network = None
+
+
+DECODERS = ('darknet', 'opencv', 'opencv-reduced')
+REDUCTION_FACTORS = (8, 4, 2)
+
+
+def read_image_size(image_file):
+    """
+    (width, height) of an image file read from its header without decoding
+    """
+    from PIL import Image
+    with Image.open(image_file) as image:
+        return image.size
 
 
-#  lib = CDLL("/home/pjreddie/documents/darknet/libdarknet.so", RTLD_GLOBAL)
-#  lib = CDLL("libdarknet.so", RTLD_GLOBAL)
-hasGPU = True
-if os.name == "nt":
-    cwd = os.path.dirname(__file__)
-    os.environ['PATH'] = cwd + ';' + os.environ['PATH']
-    winGPUdll = os.path.join(cwd, "yolo_cpp_dll.dll")
-    winNoGPUdll = os.path.join(cwd, "yolo_cpp_dll_nogpu.dll")
-    envKeys = list()
-    for k, v in os.environ.items():
-        envKeys.append(k)
-    try:
-        try:
-            tmp = os.environ["FORCE_CPU"].lower()
-            if tmp in ["1", "true", "yes", "on"]:
-                raise ValueError("ForceCPU")
-            else:
-                print("Flag value {} not forcing CPU mode".format(tmp))
-        except KeyError:
-            # We never set the flag
-            if 'CUDA_VISIBLE_DEVICES' in envKeys:
-                if int(os.environ['CUDA_VISIBLE_DEVICES']) < 0:
-                    raise ValueError("ForceCPU")
-            try:
-                global DARKNET_FORCE_CPU
-                if DARKNET_FORCE_CPU:
-                    raise ValueError("ForceCPU")
-            except NameError as cpu_error:
-                print(cpu_error)
-        if not os.path.exists(winGPUdll):
-            raise ValueError("NoDLL")
-        lib = CDLL(winGPUdll, RTLD_GLOBAL)
-    except (KeyError, ValueError):
-        hasGPU = False
-        if os.path.exists(winNoGPUdll):
-            lib = CDLL(winNoGPUdll, RTLD_GLOBAL)
-            print("Notice: CPU-only mode")
-        else:
-            # Try the other way, in case no_gpu was compile but not renamed
-            lib = CDLL(winGPUdll, RTLD_GLOBAL)
-            print("Environment variables indicated a CPU run, but we didn't find {}. Trying a GPU run anyway.".format(winNoGPUdll))
-else:
-    lib = CDLL(os.path.join('./', os.path.dirname(__file__), 'libdarknet.so'), RTLD_GLOBAL)
-lib.network_width.argtypes = [c_void_p]
-lib.network_width.restype = c_int
-lib.network_height.argtypes = [c_void_p]
-lib.network_height.restype = c_int
+def get_reduction_factor(width, height, target_size):
+    """
+    Largest of REDUCTION_FACTORS for which the reduced image is not smaller than its letterbox
+    in the network input of target_size, 1 if there is no such factor
+    """
+    new_w, new_h = letterbox_shape(width, height, target_size[0], target_size[1])
+    for factor in REDUCTION_FACTORS:
+        # reduced JPEG decoding rounds the size up
+        if (-(-width // factor) >= new_w) and (-(-height // factor) >= new_h):
+            return factor
+    return 1
+
+
+def decode_image(image_file, decoder='darknet', target_size=None):
+    """
+    Decode image file to IMAGE with one of DECODERS:
+        darknet          load_image_color of the library
+        opencv           cv2.imread
+        opencv-reduced   cv2.imread with IMREAD_REDUCED_* at the largest factor keeping the image
+                         not smaller than the letterbox in the network input of target_size (width, height)
+    Size of a reduced image file is kept in original_size attribute of the IMAGE, detection functions
+    return boxes of such images in the original image coordinates
+    """
+    start = stage_start()
+    if decoder == 'darknet':
+        image = load_image(image_file.encode(), 0, 0)
+    elif decoder in ('opencv', 'opencv-reduced'):
+        import cv2
+        # EXIF orientation is ignored as in load_image_color
+        flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+        factor = 1
+        if (decoder == 'opencv-reduced') and (target_size is not None):
+            width, height = read_image_size(image_file)
+            factor = get_reduction_factor(width, height, target_size)
+            if factor > 1:
+                flags = getattr(cv2, 'IMREAD_REDUCED_COLOR_{}'.format(factor)) | cv2.IMREAD_IGNORE_ORIENTATION
+        array = cv2.imread(image_file, flags)
+        if array is None:
+            raise RuntimeError('Can not decode {}'.format(image_file))
+        image = array_to_image(array, bgr=True)
+        if factor > 1:
+            image.original_size = (width, height)
+    else:
+        raise RuntimeError('Unknown decoder {}'.format(decoder))
+    stage_end('decode', start)
+    return image
 
-copy_image_from_bytes = lib.copy_image_from_bytes
-copy_image_from_bytes.argtypes = [IMAGE,c_char_p]
 
-predict = lib.network_predict_ptr
-predict.argtypes = [c_void_p, POINTER(c_float)]
-predict.restype = POINTER(c_float)
+def get_image_size(image):
+    """
+    Size of the image file of IMAGE, differs from (w, h) for reduced decoding
+    """
+    return getattr(image, 'original_size', (int(image.w), int(image.h)))
 
-if hasGPU:
-    set_gpu = lib.cuda_set_device
-    set_gpu.argtypes = [c_int]
 
-init_cpu = lib.init_cpu
+def scale_to_original_size(predictions, image):
+    """
+    Map boxes of predictions on a reduced IMAGE to its original size in place
+    """
+    return scale_predictions(predictions, (image.w, image.h), getattr(image, 'original_size', None))
 
-make_image = lib.make_image
-make_image.argtypes = [c_int, c_int, c_int]
-make_image.restype = IMAGE
 
-get_network_boxes = lib.get_network_boxes
-get_network_boxes.argtypes = [c_void_p, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, POINTER(c_int), c_int]
-get_network_boxes.restype = POINTER(DETECTION)
+def scale_predictions(predictions, size, original_size=None):
+    """
+    Map boxes of predictions on an image of size (width, height) to original_size in place
+    """
+    if (original_size is None) or (len(predictions) == 0):
+        return predictions
+    scale_x = np.float32(original_size[0] / size[0])
+    scale_y = np.float32(original_size[1] / size[1])
+    predictions['x'] *= scale_x
+    predictions['w'] *= scale_x
+    predictions['y'] *= scale_y
+    predictions['h'] *= scale_y
+    return predictions
 
-make_network_boxes = lib.make_network_boxes
-make_network_boxes.argtypes = [c_void_p]
-make_network_boxes.restype = POINTER(DETECTION)
 
-free_detections = lib.free_detections
-free_detections.argtypes = [POINTER(DETECTION), c_int]
+def map_ahead(submit, iterable, depth=8, discard=None):
+    """
+    Yields results of futures returned by submit(item) in the order of iterable.
+    Items are submitted from a background thread with up to depth futures waiting for the consumer,
+    so results are yielded as soon as they are ready even if iterable blocks on the next item
+    (e.g. reads a pipe) and taking new items from iterable blocks while depth futures are waiting.
+    discard is called for results which were not taken when iteration stops early
+    """
+    def discard_future(future):
+        if (discard is not None) and not future.cancel() and (future.exception() is None):
+            discard(future.result())
 
-free_batch_detections = lib.free_batch_detections
-free_batch_detections.argtypes = [POINTER(DETNUMPAIR), c_int]
+    futures = background_iter(map(submit, iterable), depth=depth, discard=discard_future)
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        futures.close()
 
-free_ptrs = lib.free_ptrs
-free_ptrs.argtypes = [POINTER(c_void_p), c_int]
 
-network_predict = lib.network_predict_ptr
-network_predict.argtypes = [c_void_p, POINTER(c_float)]
+def prefetch_images(images_files, threads=2, depth=8, decoder='darknet', target_size=None):
+    """
+    Yields IMAGEs of the files in order, decoded in threads with up to depth images decoded ahead.
+    Yielded images should be freed by the caller
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        yield from map_ahead(lambda image_file: executor.submit(decode_image, image_file, decoder, target_size),
+                             images_files, depth=depth, discard=free_image)
 
-reset_rnn = lib.reset_rnn
-reset_rnn.argtypes = [c_void_p]
 
-load_net = lib.load_network
-load_net.argtypes = [c_char_p, c_char_p, c_int]
-load_net.restype = c_void_p
+def background_iter(iterable, depth=8, discard=None):
+    """
+    Runs iteration over iterable in a background thread with up to depth items ready in a queue.
+    Exceptions are raised in the consumer thread. discard is called for items left in the queue
+    when iteration stops early
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
 
-load_net_custom = lib.load_network_custom
-load_net_custom.argtypes = [c_char_p, c_char_p, c_int, c_int]
-load_net_custom.restype = c_void_p
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    if discard is not None:
+                        discard(item)
+                    break
+            else:
+                put((end, None))
+        except BaseException as e:
+            put((end, e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                break
+            yield item
+    finally:
+        stop.set()
+        # producer may be blocked on reading its input, it is left as a daemon thread then
+        thread.join(timeout=1)
+        while not items.empty():
+            item, error = items.get_nowait()
+            if (discard is not None) and (item is not end):
+                discard(item)
+
+
+def split_cpus(parts):
+    """
+    Split CPUs available to the process into parts of nearly equal size
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count()))
+    if parts >= len(cpus):
+        return [{cpus[i % len(cpus)]} for i in range(parts)]
+    return [set(cpus[i::parts]) for i in range(parts)]
 
-free_network_ptr = lib.free_network_ptr
-free_network_ptr.argtypes = [c_void_p]
-free_network_ptr.restype = c_void_p
 
-do_nms_obj = lib.do_nms_obj
-do_nms_obj.argtypes = [POINTER(DETECTION), c_int, c_int, c_float]
+class NetworkPool:
+    """
+    Several instances of the same network shared by worker threads.
+    Library calls release the GIL, so instances run in parallel.
+    Work is given with submit(fn, *args) or imap(fn, iterable), fn is called with DetectorSession as the first argument.
+    A session can also be taken for use in the calling thread with checkout().
+    affinity is a list of CPU sets, the i-th worker thread is pinned to affinity[i].
+    """
+    def __init__(self, config_file, weights, size=None, affinity=None, batch_size=1, **session_kwargs):
+        if size is None:
+            size = len(affinity) if affinity is not None else os.cpu_count()
+        if (affinity is not None) and (len(affinity) != size):
+            raise ValueError("Affinity should be given for each of {} instances".format(size))
+        self.size = size
+        self.sessions = list()
+        self.free_sessions = queue.Queue()
+        for _ in range(size):
+            network = load_network(config_file, None, weights, batch_size=batch_size)
+            session = DetectorSession(network, **session_kwargs)
+            self.sessions.append(session)
+            self.free_sessions.put(session)
+        self.tasks = queue.Queue()
+        self.threads = list()
+        for i in range(size):
+            cpus = affinity[i] if affinity is not None else None
+            thread = threading.Thread(target=self.worker, args=(cpus,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def worker(self, cpus):
+        if (cpus is not None) and hasattr(os, 'sched_setaffinity'):
+            # pid 0 is the calling thread on Linux
+            os.sched_setaffinity(0, cpus)
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self.checkout() as session:
+                try:
+                    future.set_result(fn(session, *args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self.tasks.put((future, fn, args, kwargs))
+        return future
+
+    def imap(self, fn, iterable, max_in_flight=None):
+        """
+        Returns results of fn(session, item) in the order of iterable
+        keeping at most max_in_flight results waiting, iterable may be a blocking stream
+        """
+        if max_in_flight is None:
+            max_in_flight = 2 * self.size
+        return map_ahead(lambda item: self.submit(fn, item), iterable, depth=max_in_flight)
+
+    @contextmanager
+    def checkout(self):
+        """
+        Take a free session, it is returned to the pool on exit
+        """
+        session = self.free_sessions.get()
+        try:
+            yield session
+        finally:
+            self.free_sessions.put(session)
 
-do_nms_sort = lib.do_nms_sort
-do_nms_sort.argtypes = [POINTER(DETECTION), c_int, c_int, c_float]
+    def close(self):
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        for session in self.sessions:
+            session.close(free_network=True)
+        self.sessions = list()
 
-free_image = lib.free_image
-free_image.argtypes = [IMAGE]
 
-letterbox_image = lib.letterbox_image
-letterbox_image.argtypes = [IMAGE, c_int, c_int]
-letterbox_image.restype = IMAGE
+def get_class_id_to_name(classes_file=None):
+    if classes_file is None:
+        return None
+    if classes_file.endswith('.json'):
+        return get_class_id_to_name_from_json(classes_file)
+    if classes_file.endswith('.names'):
+        return get_class_id_to_name_from_list(classes_file)
+    return None
 
-load_meta = lib.get_metadata
-lib.get_metadata.argtypes = [c_char_p]
-lib.get_metadata.restype = METADATA
 
-load_image = lib.load_image_color
-load_image.argtypes = [c_char_p, c_int, c_int]
-load_image.restype = IMAGE
+def get_class_id_to_name_from_json(json_file):
+    return load_annotations_index(json_file).get_class_id_to_name()
 
-rgbgr_image = lib.rgbgr_image
-rgbgr_image.argtypes = [IMAGE]
 
-predict_image = lib.network_predict_image
-predict_image.argtypes = [c_void_p, IMAGE]
-predict_image.restype = POINTER(c_float)
+def get_class_id_to_name_from_list(list_file):
+    class_id_to_name = dict()
+    class_id = 0
+    with open(list_file, 'r') as f:
+        classes_names = f.readlines()
+    for class_name in classes_names:
+        if class_name[-1] == '\n':
+            class_name = class_name[:-1]
+        class_id_to_name[class_id] = class_name
+        class_id += 1
+    return class_id_to_name
 
-predict_image_letterbox = lib.network_predict_image_letterbox
-predict_image_letterbox.argtypes = [c_void_p, IMAGE]
-predict_image_letterbox.restype = POINTER(c_float)
 
-network_predict_batch = lib.network_predict_batch
-network_predict_batch.argtypes = [c_void_p, IMAGE, c_int, c_int, c_int,
-                                   c_float, c_float, POINTER(c_int), c_int, c_int]
-network_predict_batch.restype = POINTER(DETNUMPAIR)
+def load_library():
+    """
+    Load darknet library on the first use, so that importing this module stays cheap
+    """
+    global library, hasGPU
+    if library is not None:
+        return library
+    #  lib = CDLL("/home/pjreddie/documents/darknet/libdarknet.so", RTLD_GLOBAL)
+    #  lib = CDLL("libdarknet.so", RTLD_GLOBAL)
+    hasGPU = True
+    if os.name == "nt":
+        cwd = os.path.dirname(__file__)
+        os.environ['PATH'] = cwd + ';' + os.environ['PATH']
+        winGPUdll = os.path.join(cwd, "yolo_cpp_dll.dll")
+        winNoGPUdll = os.path.join(cwd, "yolo_cpp_dll_nogpu.dll")
+        envKeys = list()
+        for k, v in os.environ.items():
+            envKeys.append(k)
+        try:
+            try:
+                tmp = os.environ["FORCE_CPU"].lower()
+                if tmp in ["1", "true", "yes", "on"]:
+                    raise ValueError("ForceCPU")
+                else:
+                    print("Flag value {} not forcing CPU mode".format(tmp))
+            except KeyError:
+                # We never set the flag
+                if 'CUDA_VISIBLE_DEVICES' in envKeys:
+                    if int(os.environ['CUDA_VISIBLE_DEVICES']) < 0:
+                        raise ValueError("ForceCPU")
+                try:
+                    global DARKNET_FORCE_CPU
+                    if DARKNET_FORCE_CPU:
+                        raise ValueError("ForceCPU")
+                except NameError as cpu_error:
+                    print(cpu_error)
+            if not os.path.exists(winGPUdll):
+                raise ValueError("NoDLL")
+            lib = CDLL(winGPUdll, RTLD_GLOBAL)
+        except (KeyError, ValueError):
+            hasGPU = False
+            if os.path.exists(winNoGPUdll):
+                lib = CDLL(winNoGPUdll, RTLD_GLOBAL)
+                print("Notice: CPU-only mode")
+            else:
+                # Try the other way, in case no_gpu was compile but not renamed
+                lib = CDLL(winGPUdll, RTLD_GLOBAL)
+                print("Environment variables indicated a CPU run, but we didn't find {}. Trying a GPU run anyway.".format(winNoGPUdll))
+    else:
+        lib = CDLL(os.path.join('./', os.path.dirname(__file__), 'libdarknet.so'), RTLD_GLOBAL)
+    library = lib
+    return library
 
-resize_network = lib.resize_network
-resize_network.restype = c_int
-resize_network.argtypes = [c_void_p, c_int, c_int]
 
-get_network_classes_num_ptr = lib.get_network_classes_num_ptr
-get_network_classes_num_ptr.restype = c_int
-get_network_classes_num_ptr.argtypes = [c_void_p]
+def __getattr__(name):
+    if name == 'lib':
+        return load_library()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-resize_image = lib.resize_image
-resize_image.restype = IMAGE
-resize_image.argtypes = [IMAGE, c_int, c_int]
 
-fill_image = lib.fill_image
-fill_image.argtypes = [IMAGE, c_float]
+class LazyFunction:
+    """
+    Library function which is bound on the first call.
+    After binding it replaces itself in the module namespace with the ctypes function,
+    so only references imported from other modules go through this wrapper.
+    """
+    def __init__(self, name, symbol, argtypes=None, restype=None):
+        self.name = name
+        self.symbol = symbol
+        self.argtypes = argtypes
+        self.restype = restype
+        self.function = None
+
+    def bind(self):
+        if self.function is None:
+            function = load_library()[self.symbol]
+            if self.argtypes is not None:
+                function.argtypes = self.argtypes
+            if self.restype is not None:
+                function.restype = self.restype
+            self.function = function
+            if globals().get(self.name) is self:
+                globals()[self.name] = function
+        return self.function
+
+    def __call__(self, *args):
+        return self.bind()(*args)
+
+
+def bind_function(name, symbol, argtypes=None, restype=None):
+    function = LazyFunction(name, symbol, argtypes, restype)
+    globals()[name] = function
+    return function
+
+
+library = None
+hasGPU = True
 
-embed_image = lib.embed_image
-lib.embed_image.argtypes = [IMAGE, IMAGE, c_int, c_int]
+bind_function('network_width', 'network_width', [c_void_p], c_int)
+bind_function('network_height', 'network_height', [c_void_p], c_int)
+bind_function('copy_image_from_bytes', 'copy_image_from_bytes', [IMAGE, c_char_p])
+bind_function('predict', 'network_predict_ptr', [c_void_p, POINTER(c_float)], POINTER(c_float))
+bind_function('set_gpu', 'cuda_set_device', [c_int])
+bind_function('init_cpu', 'init_cpu')
+bind_function('make_image', 'make_image', [c_int, c_int, c_int], IMAGE)
+bind_function('get_network_boxes', 'get_network_boxes',
+              [c_void_p, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, POINTER(c_int), c_int],
+              POINTER(DETECTION))
+bind_function('make_network_boxes', 'make_network_boxes', [c_void_p], POINTER(DETECTION))
+bind_function('free_detections', 'free_detections', [POINTER(DETECTION), c_int])
+bind_function('free_batch_detections', 'free_batch_detections', [POINTER(DETNUMPAIR), c_int])
+bind_function('free_ptrs', 'free_ptrs', [POINTER(c_void_p), c_int])
+bind_function('network_predict', 'network_predict_ptr', [c_void_p, POINTER(c_float)], POINTER(c_float))
+bind_function('reset_rnn', 'reset_rnn', [c_void_p])
+bind_function('load_net', 'load_network', [c_char_p, c_char_p, c_int], c_void_p)
+bind_function('load_net_custom', 'load_network_custom', [c_char_p, c_char_p, c_int, c_int], c_void_p)
+bind_function('free_network_ptr', 'free_network_ptr', [c_void_p], c_void_p)
+bind_function('reload_weights', 'reload_weights', [c_void_p, c_char_p])
+bind_function('do_nms_obj', 'do_nms_obj', [POINTER(DETECTION), c_int, c_int, c_float])
+bind_function('do_nms_sort', 'do_nms_sort', [POINTER(DETECTION), c_int, c_int, c_float])
+bind_function('free_image', 'free_image', [IMAGE])
+bind_function('letterbox_image', 'letterbox_image', [IMAGE, c_int, c_int], IMAGE)
+bind_function('letterbox_image_into', 'letterbox_image_into', [IMAGE, c_int, c_int, IMAGE])
+bind_function('load_meta', 'get_metadata', [c_char_p], METADATA)
+bind_function('load_image', 'load_image_color', [c_char_p, c_int, c_int], IMAGE)
+bind_function('rgbgr_image', 'rgbgr_image', [IMAGE])
+bind_function('predict_image', 'network_predict_image', [c_void_p, IMAGE], POINTER(c_float))
+bind_function('predict_image_letterbox', 'network_predict_image_letterbox', [c_void_p, IMAGE], POINTER(c_float))
+bind_function('network_predict_batch', 'network_predict_batch',
+              [c_void_p, IMAGE, c_int, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, c_int],
+              POINTER(DETNUMPAIR))
+bind_function('resize_network', 'resize_network', [c_void_p, c_int, c_int], c_int)
+bind_function('set_batch_network', 'set_batch_network', [c_void_p, c_int])
+bind_function('get_network_classes_num_ptr', 'get_network_classes_num_ptr', [c_void_p], c_int)
+bind_function('resize_image', 'resize_image', [IMAGE, c_int, c_int], IMAGE)
+bind_function('fill_image', 'fill_image', [IMAGE, c_float])
+bind_function('embed_image', 'embed_image', [IMAGE, IMAGE, c_int, c_int])
 
 
 if __name__ == '__main__':
+    import cv2
     parser = build_parser()
     args = parser.parse_args()
     class_id_to_name = get_class_id_to_name(args.classes_file)
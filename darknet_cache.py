@@ -0,0 +1,204 @@
+"""
+Content-addressed on-disk cache of per-image detection results
+
+Results are stored under a key made of content hashes of cfg and weights files and inference parameters,
+every image is addressed by the hash of its bytes, so renamed or copied images and checkpoints are still found
+in the cache. File hashes are remembered together with file mtime and size and are recomputed only when
+one of them changes. Cache size is bounded, least recently used results are evicted first.
+
+Layout:
+    cache_folder/files.json                      path -> [mtime_ns, size, hash]
+    cache_folder/files.json.lock                 lock of merging of files.json by processes using the cache
+    cache_folder/results/<key>/<image_hash>.npz  predictions (PREDICTION_DTYPE array) and image size
+"""
+import os
+import json
+import hashlib
+import zipfile
+import tempfile
+import contextlib
+import numpy as np
+
+
+def hash_file(file, chunk_size=2**20):
+    hasher = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+@contextlib.contextmanager
+def locked_file(lock_file):
+    """
+    Exclusive lock of lock_file with fcntl on POSIX and msvcrt on Windows, without locking if neither is available
+    """
+    with open(lock_file, 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            while True:
+                # LK_LOCK gives up after 10 attempts with OSError
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if (fcntl is None) and (msvcrt is not None):
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ResultCache:
+    def __init__(self, cache_folder, max_size=2**30):
+        self.cache_folder = cache_folder
+        self.results_folder = os.path.join(cache_folder, 'results')
+        self.files_index_file = os.path.join(cache_folder, 'files.json')
+        self.max_size = max_size
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.results_folder, exist_ok=True)
+        self.files_index = self.read_files_index()
+        self.files_index_changed = False
+
+    def file_hash(self, file):
+        """
+        Content hash of the file, taken from the index if file mtime and size did not change
+        """
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        entry = self.files_index.get(file)
+        if (entry is not None) and (entry[0] == stat.st_mtime_ns) and (entry[1] == stat.st_size):
+            return entry[2]
+        file_hash = hash_file(file)
+        self.files_index[file] = [stat.st_mtime_ns, stat.st_size, file_hash]
+        self.files_index_changed = True
+        return file_hash
+
+    def get_key(self, config_file, weights_file, **params):
+        """
+        Key of results of the network with the given inference parameters, parameters values should have stable repr
+        """
+        key_data = {'cfg': self.file_hash(config_file), 'weights': self.file_hash(weights_file),
+                    'params': {name: repr(value) for name, value in params.items()}}
+        return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    def get_result_file(self, key, image_file):
+        return os.path.join(self.results_folder, key, self.file_hash(image_file) + '.npz')
+
+    def contains(self, key, image_file):
+        return os.path.exists(self.get_result_file(key, image_file))
+
+    def get(self, key, image_file):
+        """
+        Returns (width, height, predictions) or None if the image is not in the cache
+        """
+        result_file = self.get_result_file(key, image_file)
+        try:
+            with np.load(result_file) as result:
+                predictions = result['predictions']
+                width, height = result['size'].tolist()
+            os.utime(result_file)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return width, height, predictions
+
+    def put(self, key, image_file, width, height, predictions):
+        result_file = self.get_result_file(key, image_file)
+        os.makedirs(os.path.dirname(result_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(result_file))
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, predictions=predictions, size=np.array([width, height]))
+        os.replace(tmp_file, result_file)
+        if self.size is None:
+            self.size = self.get_size()
+        else:
+            self.size += os.path.getsize(result_file)
+        if self.size > self.max_size:
+            # evict a bit more to not rescan the cache on every next put
+            self.evict(self.max_size * 0.9)
+
+    def get_results_files(self):
+        results_files = list()
+        for key_entry in os.scandir(self.results_folder):
+            if not key_entry.is_dir():
+                continue
+            for entry in os.scandir(key_entry.path):
+                if entry.name.endswith('.npz'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    results_files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return results_files
+
+    def get_size(self):
+        return sum(size for _, size, _ in self.get_results_files())
+
+    def evict(self, max_size=None):
+        """
+        Remove least recently used results until cache size is not higher than max_size
+        """
+        if max_size is None:
+            max_size = self.max_size
+        results_files = sorted(self.get_results_files())
+        self.size = sum(size for _, size, _ in results_files)
+        for _, size, result_file in results_files:
+            if self.size <= max_size:
+                break
+            # results may be removed by another process using the same cache
+            try:
+                os.remove(result_file)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            key_folder = os.path.dirname(result_file)
+            try:
+                os.rmdir(key_folder)
+            except OSError:
+                pass
+
+    def read_files_index(self):
+        try:
+            with open(self.files_index_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def close(self):
+        """
+        Saves file hashes merged with the index on disk, so several processes using the same cache
+        (e.g. predict workers) do not lose hashes of each other
+        """
+        if not self.files_index_changed:
+            return
+        with locked_file(self.files_index_file + '.lock'):
+            files_index = self.read_files_index()
+            files_index.update(self.files_index)
+            fd, tmp_file = tempfile.mkstemp(prefix='files.json.', suffix='.tmp', dir=self.cache_folder)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(files_index, f)
+                os.replace(tmp_file, self.files_index_file)
+            except OSError:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                raise
+        self.files_index = files_index
+        self.files_index_changed = False
@@ -18,6 +18,8 @@ def parser():
                         "If no input is given, ")
     parser.add_argument("--batch_size", default=1, type=int,
                         help="number of images to be processed at the same time")
+    parser.add_argument("--threads", default=1, type=int,
+                        help="number of network instances run in parallel threads when input is given")
     parser.add_argument("--weights", default="yolov4.weights",
                         help="yolo weights path")
     parser.add_argument("--dont_show", action='store_true',
@@ -97,21 +99,18 @@ def prepare_batch(images, network, channels=3):
     return darknet.IMAGE(width, height, channels, darknet_images)
 
 
-def image_detection(image_path, network, class_names, class_colors, thresh):
-    # Darknet doesn't accept numpy images.
-    # Create one with image we reuse for each detect
-    width = darknet.network_width(network)
-    height = darknet.network_height(network)
-    darknet_image = darknet.make_image(width, height, 3)
-
+def image_detection(image_path, session, class_names, class_colors, thresh):
+    # Numpy image is copied into session buffer of the network size
+    width = session.width
+    height = session.height
     image = cv2.imread(image_path)
     image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     image_resized = cv2.resize(image_rgb, (width, height),
                                interpolation=cv2.INTER_LINEAR)
 
-    darknet.copy_image_from_bytes(darknet_image, image_resized.tobytes())
-    detections = darknet.detect_image(network, class_names, darknet_image, thresh=thresh)
-    darknet.free_image(darknet_image)
+    darknet_image = session.get_input_buffer(image_resized.shape)
+    detections = darknet.detect_image_resize(session.network, class_names, image_resized, thresh=thresh,
+                                             image_buffer=darknet_image)
     image = darknet.draw_boxes(detections, image_resized, class_colors)
     return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), detections
 
@@ -176,9 +175,35 @@ def batch_detection_example():
     print(detections)
 
 
+def pool_detection(args, images):
+    random.seed(3)  # deterministic bbox colors
+    class_names = darknet.load_class_names(args.data_file)
+    class_colors = darknet.class_colors(class_names)
+    pool = darknet.NetworkPool(args.config_file, args.weights, size=args.threads)
+
+    def detection(session, image_name):
+        return image_detection(image_name, session, class_names, class_colors, args.thresh)
+
+    prev_time = time.time()
+    for image_name, (image, detections) in zip(images, pool.imap(detection, images)):
+        if args.save_labels:
+            save_annotations(image_name, image, detections, class_names)
+        darknet.print_detections(detections, args.ext_output)
+        if not args.dont_show:
+            cv2.imshow('Inference', image)
+            if cv2.waitKey() & 0xFF == ord('q'):
+                break
+    fps = len(images) / (time.time() - prev_time)
+    print("FPS: {:.1f}".format(fps))
+    pool.close()
+
+
 def main():
     args = parser()
     check_arguments_errors(args)
+    if args.input and args.threads > 1:
+        pool_detection(args, load_images(args.input))
+        return
 
     random.seed(3)  # deterministic bbox colors
     network, class_names, class_colors = darknet.load_network(
@@ -188,6 +213,7 @@ def main():
         batch_size=args.batch_size
     )
 
+    session = darknet.DetectorSession(network)
     images = load_images(args.input)
 
     index = 0
@@ -201,7 +227,7 @@ def main():
             image_name = input("Enter Image Path: ")
         prev_time = time.time()
         image, detections = image_detection(
-            image_name, network, class_names, class_colors, args.thresh
+            image_name, session, class_names, class_colors, args.thresh
             )
         if args.save_labels:
             save_annotations(image_name, image, detections, class_names)
@@ -213,6 +239,7 @@ def main():
             if cv2.waitKey() & 0xFF == ord('q'):
                 break
         index += 1
+    session.close()
 
 
 if __name__ == "__main__":
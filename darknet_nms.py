@@ -0,0 +1,162 @@
+"""
+NumPy NMS on predictions arrays with PREDICTION_DTYPE fields (class_id, score, x, y, w, h)
+
+Boxes are (x, y, w, h) with the center point as in darknet. Greedy suppression gives the same result
+as do_nms_sort when all candidates are kept, DIoU suppression follows diounms_sort with DIOU_NMS kind.
+"""
+import numpy as np
+
+
+NMS_KINDS = ('greedy', 'batched', 'diou')
+
+
+def box_iou(a, b):
+    """
+    IoU of boxes broadcast along the last axis, computed as box_iou in box.c
+    """
+    left = np.maximum(a[..., 0] - a[..., 2] / 2, b[..., 0] - b[..., 2] / 2)
+    right = np.minimum(a[..., 0] + a[..., 2] / 2, b[..., 0] + b[..., 2] / 2)
+    top = np.maximum(a[..., 1] - a[..., 3] / 2, b[..., 1] - b[..., 3] / 2)
+    bottom = np.minimum(a[..., 1] + a[..., 3] / 2, b[..., 1] + b[..., 3] / 2)
+    w = right - left
+    h = bottom - top
+    intersection = np.where((w < 0) | (h < 0), 0, w * h)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = intersection / union
+    return np.where((intersection == 0) | (union == 0), 0, iou)
+
+
+def box_diou(a, b, beta=.6):
+    """
+    IoU minus normalized center distance term of boxes broadcast along the last axis,
+    computed as box_diounms in box.c
+    """
+    iou = box_iou(a, b)
+    left = np.minimum(a[..., 0] - a[..., 2] / 2, b[..., 0] - b[..., 2] / 2)
+    right = np.maximum(a[..., 0] + a[..., 2] / 2, b[..., 0] + b[..., 2] / 2)
+    top = np.minimum(a[..., 1] - a[..., 3] / 2, b[..., 1] - b[..., 3] / 2)
+    bottom = np.maximum(a[..., 1] + a[..., 3] / 2, b[..., 1] + b[..., 3] / 2)
+    c = (right - left) ** 2 + (bottom - top) ** 2
+    d = (a[..., 0] - b[..., 0]) ** 2 + (a[..., 1] - b[..., 1]) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diou = iou - np.power(d / c, beta)
+    return np.where(c == 0, iou, diou)
+
+
+def greedy_nms(boxes, scores, thresh, overlap=box_iou, classes=None, block_size=64):
+    """
+    Indexes of boxes left by greedy suppression in order of decreasing score.
+    Candidates are taken in blocks: suppression inside a block is resolved with a small overlap matrix,
+    then kept boxes of the block suppress all remaining candidates at once.
+    If classes are given only boxes of the same class suppress each other.
+    """
+    thresh = np.float32(thresh)
+    order = np.argsort(-scores, kind='stable')
+    boxes = boxes[order]
+    if classes is not None:
+        classes = classes[order]
+    keep = list()
+    remaining = np.arange(len(order))
+    while len(remaining) > 0:
+        block, remaining = remaining[:block_size], remaining[block_size:]
+        overlapped = overlap(boxes[block][:, None], boxes[block][None, :]) > thresh
+        if classes is not None:
+            overlapped &= classes[block][:, None] == classes[block][None, :]
+        suppressed = np.zeros(len(block), dtype=bool)
+        block_keep = list()
+        for i in range(len(block)):
+            if suppressed[i]:
+                continue
+            block_keep.append(i)
+            suppressed |= overlapped[i]
+        kept = block[block_keep]
+        keep.append(kept)
+        if len(remaining) == 0:
+            break
+        if classes is None:
+            overlapped = overlap(boxes[kept][:, None], boxes[remaining][None, :]) > thresh
+            remaining = remaining[~overlapped.any(axis=0)]
+        else:
+            # overlaps are computed only for pairs of the same class
+            kept_idx, remaining_idx = np.nonzero(classes[kept][:, None] == classes[remaining][None, :])
+            overlapped = overlap(boxes[kept[kept_idx]], boxes[remaining[remaining_idx]]) > thresh
+            suppressed = np.zeros(len(remaining), dtype=bool)
+            suppressed[remaining_idx[overlapped]] = True
+            remaining = remaining[~suppressed]
+    if len(keep) == 0:
+        return np.empty(0, dtype=np.intp)
+    return order[np.concatenate(keep)]
+
+
+def get_boxes(predictions):
+    return np.stack((predictions['x'], predictions['y'], predictions['w'], predictions['h']), axis=1)
+
+
+def cap_per_class(predictions, top_k):
+    """
+    Indexes of at most top_k highest score predictions of each class
+    """
+    indexes = list()
+    for class_id in np.unique(predictions['class_id']):
+        class_indexes = np.flatnonzero(predictions['class_id'] == class_id)
+        if len(class_indexes) > top_k:
+            scores = predictions['score'][class_indexes]
+            class_indexes = class_indexes[np.argpartition(-scores, top_k - 1)[:top_k]]
+        indexes.append(class_indexes)
+    if len(indexes) == 0:
+        return np.empty(0, dtype=np.intp)
+    return np.sort(np.concatenate(indexes))
+
+
+def nms_per_class(predictions, thresh, overlap=box_iou):
+    boxes = get_boxes(predictions)
+    keep = list()
+    for class_id in np.unique(predictions['class_id']):
+        class_indexes = np.flatnonzero(predictions['class_id'] == class_id)
+        class_keep = greedy_nms(boxes[class_indexes], predictions['score'][class_indexes], thresh, overlap=overlap)
+        keep.append(class_indexes[class_keep])
+    if len(keep) == 0:
+        return np.empty(0, dtype=np.intp)
+    return np.concatenate(keep)
+
+
+def nms_batched(predictions, thresh):
+    """
+    Greedy NMS of all classes in one pass. Classes are separated as with class coordinate offsets,
+    but by masking overlaps of different classes, so IoU stays the same as in per class NMS
+    """
+    return greedy_nms(get_boxes(predictions), predictions['score'], thresh, classes=predictions['class_id'])
+
+
+class NMS:
+    """
+    NMS settings used by detection functions in place of the do_nms_sort threshold
+    kind: 'greedy' - per class greedy NMS, 'batched' - greedy NMS of all classes at once with class offsets,
+          'diou' - per class DIoU NMS with beta
+    top_k: number of highest score candidates of each class left before NMS, all candidates if None
+    """
+    def __init__(self, thresh=.45, kind='greedy', top_k=None, beta=.6):
+        if kind not in NMS_KINDS:
+            raise ValueError("Unknown NMS kind {}, should be one of {}".format(kind, NMS_KINDS))
+        self.thresh = thresh
+        self.kind = kind
+        self.top_k = top_k
+        self.beta = beta
+
+    def __call__(self, predictions):
+        """
+        Returns predictions left after NMS in their original order
+        """
+        if self.top_k is not None:
+            predictions = predictions[cap_per_class(predictions, self.top_k)]
+        if self.kind == 'greedy':
+            keep = nms_per_class(predictions, self.thresh)
+        elif self.kind == 'batched':
+            keep = nms_batched(predictions, self.thresh)
+        else:
+            keep = nms_per_class(predictions, self.thresh, overlap=lambda box, boxes: box_diou(box, boxes, self.beta))
+        return predictions[np.sort(keep)]
+
+    def __repr__(self):
+        return "NMS(thresh={}, kind='{}', top_k={}, beta={})".format(self.thresh, self.kind, self.top_k, self.beta)
@@ -0,0 +1,104 @@
+"""
+Cache of letterboxed images for repeated evaluation on a fixed set of images
+
+Images are decoded and letterboxed to the network input size once and kept in a memory-mapped uint8 array,
+so prediction of every next checkpoint on the same images only converts them to float and runs the network.
+A set of letterboxed images is addressed by the input size, the decoder and the list of images files
+with their mtime and size, and is rebuilt when any of them changes.
+
+Layout:
+    cache_folder/<key>/tensors.npy   (N, 3, height, width) uint8 letterboxed images
+    cache_folder/<key>/sizes.npy     (N, 2) int64 original images sizes, letterbox geometry is computed from them
+    cache_folder/<key>/info.json     input size, decoder and images files, written last and marks the set as complete
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from tqdm import tqdm
+from darknet import prefetch_images, decode_image, letterbox_image, image_as_array, free_image, get_image_size
+
+
+def get_images_info(images_files):
+    images_info = list()
+    for image_file in images_files:
+        stat = os.stat(image_file)
+        images_info.append([os.path.abspath(image_file), stat.st_mtime_ns, stat.st_size])
+    return images_info
+
+
+def get_tensors_key(images_info, input_shape, decoder='darknet'):
+    key_data = {'images': images_info, 'input_shape': list(input_shape), 'decoder': decoder}
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+class LetterboxedImages:
+    def __init__(self, folder):
+        with open(os.path.join(folder, 'info.json'), 'r') as f:
+            self.info = json.load(f)
+        self.tensors = np.load(os.path.join(folder, 'tensors.npy'), mmap_mode='r', allow_pickle=False)
+        self.sizes = np.load(os.path.join(folder, 'sizes.npy'), allow_pickle=False)
+        self.images_indexes = {image_file: i for i, (image_file, _, _) in enumerate(self.info['images'])}
+
+    def __len__(self):
+        return len(self.tensors)
+
+    def get_indexes(self, images_files):
+        return [self.images_indexes[os.path.abspath(image_file)] for image_file in images_files]
+
+
+def letterbox_to_uint8(image, width, height, out):
+    boxed = image if (image.w, image.h) == (width, height) else letterbox_image(image, width, height)
+    np.clip(np.rint(image_as_array(boxed) * 255.), 0, 255, out=out, casting='unsafe')
+    if boxed is not image:
+        free_image(boxed)
+
+
+def build_letterboxed_images(folder, images_info, input_shape, decoder='darknet', decoder_threads=2,
+                             prefetch_depth=8):
+    width, height = input_shape
+    images_files = [image_file for image_file, _, _ in images_info]
+    tensors = np.lib.format.open_memmap(os.path.join(folder, 'tensors.npy'), mode='w+', dtype=np.uint8,
+                                        shape=(len(images_files), 3, height, width))
+    sizes = np.empty((len(images_files), 2), dtype=np.int64)
+    if prefetch_depth > 0:
+        images = prefetch_images(images_files, threads=decoder_threads, depth=prefetch_depth, decoder=decoder,
+                                 target_size=input_shape)
+    else:
+        images = (decode_image(image_file, decoder=decoder, target_size=input_shape) for image_file in images_files)
+    for i, image in enumerate(tqdm(images, total=len(images_files), desc='Letterboxing')):
+        letterbox_to_uint8(image, width, height, tensors[i])
+        sizes[i] = get_image_size(image)
+        free_image(image)
+    tensors.flush()
+    del tensors
+    np.save(os.path.join(folder, 'sizes.npy'), sizes, allow_pickle=False)
+    with open(os.path.join(folder, 'info.json'), 'w') as f:
+        json.dump({'images': images_info, 'input_shape': list(input_shape), 'decoder': decoder}, f)
+
+
+def load_letterboxed_images(cache_folder, images_files, input_shape, decoder='darknet', decoder_threads=2,
+                            prefetch_depth=8):
+    """
+    Letterboxed images of images_files at input_shape (width, height), built and saved in cache_folder
+    if there is no complete set for them
+    """
+    images_info = get_images_info(images_files)
+    folder = os.path.join(cache_folder, get_tensors_key(images_info, input_shape, decoder=decoder))
+    if os.path.exists(os.path.join(folder, 'info.json')):
+        return LetterboxedImages(folder)
+    os.makedirs(cache_folder, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(prefix=os.path.basename(folder) + '.', dir=cache_folder)
+    try:
+        build_letterboxed_images(tmp_folder, images_info, tuple(input_shape), decoder=decoder,
+                                 decoder_threads=decoder_threads, prefetch_depth=prefetch_depth)
+        os.rename(tmp_folder, folder)
+    except OSError:
+        # the same set was built by another process in the meantime
+        if not os.path.exists(os.path.join(folder, 'info.json')):
+            raise
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+    return LetterboxedImages(folder)
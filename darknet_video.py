@@ -27,6 +27,8 @@ def parser():
                         help="path to data file")
     parser.add_argument("--thresh", type=float, default=.25,
                         help="remove detections with confidence below this value")
+    parser.add_argument("--timing", action='store_true',
+                        help="print time spent in detection stages when inference ends")
     return parser.parse_args()
 
 
@@ -69,7 +71,9 @@ def video_capture(frame_queue, darknet_image_queue):
         frame_resized = cv2.resize(frame_rgb, (width, height),
                                    interpolation=cv2.INTER_LINEAR)
         frame_queue.put(frame_resized)
-        darknet.copy_image_from_bytes(darknet_image, frame_resized.tobytes())
+        start = darknet.stage_start()
+        darknet.array_to_image(frame_resized, darknet_image)
+        darknet.stage_end('decode', start)
         darknet_image_queue.put(darknet_image)
     cap.release()
 
@@ -78,14 +82,15 @@ def inference(darknet_image_queue, detections_queue, fps_queue):
     while cap.isOpened():
         darknet_image = darknet_image_queue.get()
         prev_time = time.time()
-        detections = darknet.detect_image(network, class_names, darknet_image, thresh=args.thresh)
+        detections = darknet.detect_image_resize(network, class_names, darknet_image, thresh=args.thresh)
         detections_queue.put(detections)
         fps = int(1/(time.time() - prev_time))
         fps_queue.put(fps)
         print("FPS: {}".format(fps))
         darknet.print_detections(detections, args.ext_output)
-        darknet.free_image(darknet_image)
     cap.release()
+    if args.timing:
+        print(darknet.disable_stage_timing().report())
 
 
 def drawing(frame_queue, detections_queue, fps_queue):
@@ -117,14 +122,15 @@ if __name__ == '__main__':
 
     args = parser()
     check_arguments_errors(args)
+    if args.timing:
+        darknet.enable_stage_timing()
     network, class_names, class_colors = darknet.load_network(
             args.config_file,
             args.data_file,
             args.weights,
             batch_size=1
         )
-    # Darknet doesn't accept numpy images.
-    # Create one with image we reuse for each detect
+    # Frames are copied into darknet image we reuse for each detect
     width = darknet.network_width(network)
     height = darknet.network_height(network)
     darknet_image = darknet.make_image(width, height, 3)
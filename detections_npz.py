@@ -0,0 +1,227 @@
+"""
+Columnar binary format of detections and converters to and from COCO JSON
+
+Detections are stored in an uncompressed .npz file with one array per column:
+    id, image_id, category_id, score, area    (N,)
+    bbox                                      (N, 4) COCO boxes [left, top, width, height]
+    bbox_int                                  (N, 4) bool, box values that are int in COCO JSON
+Detections of an image are contiguous, images index has one entry per image:
+    images_ids, images_widths, images_heights (M,), images_names (M,) str
+    images_offsets                            (M + 1,) detections of image i are in [offsets[i], offsets[i + 1])
+and categories are kept in categories_ids, categories_names.
+Values are kept in float64, so converting to COCO JSON gives the same file as predict.py writes.
+
+Usage:
+    python detections_npz.py -in epoch_1000.json -out epoch_1000.npz
+    python detections_npz.py -in epoch_1000.npz -out epoch_1000.json -dets-only
+"""
+import os
+import json
+import shutil
+import zipfile
+import tempfile
+import argparse
+import numpy as np
+from predict_writers import get_coco_image, get_coco_annotation, get_coco_categories, CocoWriter
+
+
+DETECTIONS_COLUMNS = (('id', np.int64, ()), ('image_id', np.int64, ()), ('category_id', np.int64, ()),
+                      ('score', np.float64, ()), ('bbox', np.float64, (4,)), ('area', np.float64, ()),
+                      ('bbox_int', np.bool_, (4,)))
+
+
+def get_column_value(annotation, name):
+    if name == 'bbox_int':
+        # boxes clipped by the image borders have int coordinates in COCO JSON
+        return [isinstance(value, int) for value in annotation['bbox']]
+    return annotation[name]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-in', '--in-file', required=True, type=str)
+    parser.add_argument('-out', '--out-file', required=True, type=str)
+    parser.add_argument('-dets-only', '--detections-only', action='store_true',
+                        help='Write only the list of annotations when converting to COCO JSON')
+    return parser
+
+
+def write_npy_from_file(zip_file, name, dtype, shape, data_file):
+    """
+    Write raw data_file as name.npy entry of zip_file without loading it into memory
+    """
+    with zip_file.open(name + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array_header_2_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                 'fortran_order': False, 'shape': shape})
+        data_file.seek(0)
+        shutil.copyfileobj(data_file, f)
+
+
+def write_npy(zip_file, name, array):
+    with zip_file.open(name + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+
+class NpzWriter:
+    """
+    Streaming writer of predictions to the columnar format, detection columns are spooled to temporary files.
+    Takes the same predictions as other writers: lists of (class_id, score, (x, y, w, h))
+    """
+    def __init__(self, out_file, class_id_to_name):
+        self.out_file = out_file
+        folder = os.path.dirname(os.path.abspath(out_file))
+        self.columns = [(name, dtype, shape, tempfile.TemporaryFile(dir=folder))
+                        for name, dtype, shape in DETECTIONS_COLUMNS]
+        self.categories = get_coco_categories(class_id_to_name)
+        self.images_ids, self.images_names, self.images_widths, self.images_heights = list(), list(), list(), list()
+        self.images_offsets = [0]
+
+    def add(self, image_name, image_id, width, height, predictions):
+        annotations = [get_coco_annotation(self.images_offsets[-1] + i + 1, image_id, width, height, cl, score, bbox)
+                       for i, (cl, score, bbox) in enumerate(predictions)]
+        self.add_annotations(image_id, image_name, width, height, annotations)
+
+    def add_annotations(self, image_id, image_name, width, height, annotations):
+        for name, dtype, shape, f in self.columns:
+            values = np.array([get_column_value(annotation, name) for annotation in annotations], dtype=dtype)
+            f.write(values.reshape((len(annotations),) + shape).tobytes())
+        self.images_ids.append(image_id)
+        self.images_names.append(image_name)
+        self.images_widths.append(width)
+        self.images_heights.append(height)
+        self.images_offsets.append(self.images_offsets[-1] + len(annotations))
+
+    def close(self):
+        tmp_file = self.out_file + '.tmp'
+        detections_num = self.images_offsets[-1]
+        with zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+            for name, dtype, shape, f in self.columns:
+                write_npy_from_file(zip_file, name, dtype, (detections_num,) + shape, f)
+            write_npy(zip_file, 'images_ids', np.array(self.images_ids, dtype=np.int64))
+            write_npy(zip_file, 'images_names', np.array(self.images_names, dtype=str))
+            write_npy(zip_file, 'images_widths', np.array(self.images_widths, dtype=np.int64))
+            write_npy(zip_file, 'images_heights', np.array(self.images_heights, dtype=np.int64))
+            write_npy(zip_file, 'images_offsets', np.array(self.images_offsets, dtype=np.int64))
+            write_npy(zip_file, 'categories_ids', np.array([c['id'] for c in self.categories], dtype=np.int64))
+            write_npy(zip_file, 'categories_names', np.array([c['name'] for c in self.categories], dtype=str))
+        os.replace(tmp_file, self.out_file)
+        for _, _, _, f in self.columns:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for _, _, _, f in self.columns:
+                f.close()
+
+
+class Detections:
+    """
+    Columns of a detections file, loaded at once
+    """
+    def __init__(self, detections_file):
+        with np.load(detections_file, allow_pickle=False) as data:
+            self.columns = {name: data[name] for name in data.files}
+        for name, array in self.columns.items():
+            setattr(self, name, array)
+
+    def __len__(self):
+        return len(self.id)
+
+    def get_image_slice(self, i):
+        return slice(int(self.images_offsets[i]), int(self.images_offsets[i + 1]))
+
+    def to_coco_annotations(self):
+        """
+        List of COCO annotation dicts in the order of detections
+        """
+        bboxes, areas = self.bbox.tolist(), self.area.tolist()
+        for i, j in zip(*np.nonzero(self.bbox_int)):
+            bboxes[i][j] = int(bboxes[i][j])
+        for i in np.flatnonzero(self.bbox_int[:, 2] & self.bbox_int[:, 3]):
+            areas[i] = int(areas[i])
+        columns = [self.id.tolist(), self.image_id.tolist(), self.category_id.tolist(), bboxes, areas,
+                   self.score.tolist()]
+        return [{'id': annotation_id, 'iscrowd': 0, 'image_id': image_id, 'category_id': category_id,
+                 'bbox': bbox, 'area': area, 'score': score}
+                for annotation_id, image_id, category_id, bbox, area, score in zip(*columns)]
+
+    def to_coco(self):
+        images = [get_coco_image(name, image_id, width, height) for image_id, name, width, height in zip(
+            self.images_ids.tolist(), self.images_names.tolist(), self.images_widths.tolist(),
+            self.images_heights.tolist())]
+        categories = [{'name': name, 'id': category_id}
+                      for category_id, name in zip(self.categories_ids.tolist(), self.categories_names.tolist())]
+        return {'images': images, 'annotations': self.to_coco_annotations(), 'categories': categories}
+
+
+def load_detections(detections_file):
+    return Detections(detections_file)
+
+
+def load_coco_annotations(detections_file):
+    """
+    COCO annotations list from a COCO JSON file (list of annotations or full dict) or a detections .npz file
+    """
+    if detections_file.endswith('.npz'):
+        return load_detections(detections_file).to_coco_annotations()
+    with open(detections_file, 'r') as f:
+        detections = json.load(f)
+    if isinstance(detections, dict):
+        detections = detections['annotations']
+    return detections
+
+
+def coco_to_npz(coco_file, out_file):
+    """
+    Convert COCO JSON with predictions (list of annotations or full dict) to the columnar format.
+    For a list of annotations images sizes and names are not known and are set to -1 and ''
+    """
+    with open(coco_file, 'r') as f:
+        coco = json.load(f)
+    if isinstance(coco, dict):
+        images = coco['images']
+        annotations = coco['annotations']
+        categories = coco.get('categories', list())
+    else:
+        annotations = coco
+        images_ids = list(dict.fromkeys(annotation['image_id'] for annotation in annotations))
+        images = [get_coco_image('', image_id, -1, -1) for image_id in images_ids]
+        categories = list()
+    images_annotations = {image['id']: list() for image in images}
+    for annotation in annotations:
+        images_annotations[annotation['image_id']].append(annotation)
+    writer = NpzWriter(out_file, dict())
+    writer.categories = categories
+    for image in images:
+        writer.add_annotations(image['id'], image['file_name'], image['width'], image['height'],
+                               images_annotations[image['id']])
+    writer.close()
+
+
+def npz_to_coco(detections_file, out_file, detections_only=False):
+    """
+    Convert the columnar format to COCO JSON in the same layout as predict.py writes
+    """
+    detections = load_detections(detections_file)
+    class_id_to_name = {category_id - 1: name for category_id, name in zip(
+        detections.categories_ids.tolist(), detections.categories_names.tolist())}
+    annotations = detections.to_coco_annotations()
+    with CocoWriter(out_file, class_id_to_name, detections_only=detections_only) as writer:
+        for i, (image_id, name, width, height) in enumerate(zip(
+                detections.images_ids.tolist(), detections.images_names.tolist(),
+                detections.images_widths.tolist(), detections.images_heights.tolist())):
+            writer.add_annotations(image_id, name, width, height, annotations[detections.get_image_slice(i)])
+
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.in_file.endswith('.npz'):
+        npz_to_coco(args.in_file, args.out_file, detections_only=args.detections_only)
+    else:
+        coco_to_npz(args.in_file, args.out_file)
@@ -229,6 +229,7 @@ struct layer {
     int train;
     int avgpool;
     int batch_normalize;
+    int fused_batch_normalize;
     int shortcut;
     int batch;
     int dynamic_minibatch;
@@ -384,6 +385,7 @@ struct layer {
     float **layers_delta;
     WEIGHTS_TYPE_T weights_type;
     WEIGHTS_NORMALIZATION_T weights_normalization;
+    WEIGHTS_NORMALIZATION_T fused_weights_normalization;
     int   * map;
     int   * counts;
     float ** sums;
@@ -1000,6 +1002,8 @@ typedef struct box_label {
 LIB_API network *load_network(char *cfg, char *weights, int clear);
 LIB_API network *load_network_custom(char *cfg, char *weights, int clear, int batch);
 LIB_API network *load_network(char *cfg, char *weights, int clear);
+LIB_API void load_weights(network *net, char *filename);
+LIB_API void reload_weights(network *net, char *filename);
 LIB_API void free_network(network net);
 LIB_API void free_network_ptr(network* net);
 
@@ -1043,6 +1047,7 @@ LIB_API image resize_image(image im, int w, int h);
 LIB_API void quantize_image(image im);
 LIB_API void copy_image_from_bytes(image im, char *pdata);
 LIB_API image letterbox_image(image im, int w, int h);
+LIB_API void letterbox_image_into(image im, int w, int h, image boxed);
 LIB_API void rgbgr_image(image im);
 LIB_API image make_image(int w, int h, int c);
 LIB_API image load_image_color(char *filename, int w, int h);
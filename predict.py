@@ -1,6 +1,29 @@
 import argparse
 import os
-from darknet import load_network, detect_image_letterbox, free_network_ptr, resize_network, get_class_id_to_name, load_image, free_image
+import contextlib
+import sys
+import shutil
+import tempfile
+import hashlib
+import multiprocessing
+import numpy as np
+import time
+import math
+from bisect import bisect_right
+from collections import deque
+from statistics import median
+from darknet import load_network, detect_image_letterbox, free_network_ptr, resize_network, get_class_id_to_name, load_image, free_image, \
+    NetworkPool, split_cpus, detect_batch_letterbox, network_width, network_height, letterbox_shape, \
+    enable_stage_timing, disable_stage_timing, array_to_predictions, detect_letterboxed, prefetch_images, background_iter, \
+    decode_image, get_image_size, DECODERS
+from darknet_nms import NMS, NMS_KINDS
+from darknet_cache import ResultCache
+from darknet_tensors import load_letterboxed_images
+from predict_journal import PredictionJournal
+from annotations_index import load_annotations_index
+from coco_eval import GroundTruth, CocoEvaluator, extract_mAP, extract_AP, get_classes
+from predict_writers import get_coco_image, get_coco_annotation, get_coco_categories, open_writer, \
+    JsonLinesWriter
 import json
 import xml.etree.ElementTree as xml
 from xml.dom import minidom
@@ -19,16 +42,63 @@ def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-cfg', '--config-file', required=True, type=str)
     parser.add_argument('-net', '--network-file', required=True, type=str)
-    parser.add_argument('-img-fld', '--images-folder', required=True, type=str)
+    parser.add_argument('-img-fld', '--images-folder', type=str,
+                        help='Folder of images, with --stream-input relative paths are taken from this folder')
     parser.add_argument('-out', '--out-file', required=True, type=str)
-    parser.add_argument('-to', '--predict-to', type=str, choices=['cvat', 'coco'], default='coco')
+    parser.add_argument('-to', '--predict-to', type=str, choices=['cvat', 'coco', 'jsonl', 'npz'],
+                        help='npz - columnar binary detections, see detections_npz.py. '
+                             'Default is jsonl for streaming input and coco otherwise')
     parser.add_argument('-dets-only', '--detections-only', action='store_true')
     parser.add_argument('-img', '--images-file', type=str)
     parser.add_argument('-cls', '--classes-file', type=str)
     parser.add_argument('-thr', '--threshold', type=float, default=0.001)
     parser.add_argument('-max-dets', '--max-dets', type=int, default=1000, help='Maximum detections per image')
     parser.add_argument('-nms', '--nms', type=float, default=0.45)
+    parser.add_argument('-nms-kind', '--nms-kind', type=str, choices=('sort',) + NMS_KINDS, default='sort',
+                        help='sort - do_nms_sort in darknet, others - NumPy NMS on extracted predictions')
+    parser.add_argument('-pre-nms-top-k', '--pre-nms-top-k', type=int,
+                        help='Number of highest score candidates of each class left before NumPy NMS')
     parser.add_argument('-is', '--input-shape', type=int, nargs=2, default=[None, None])
+    parser.add_argument('-bs', '--batch-size', type=int, default=1, help='Number of images letterboxed into one batch')
+    parser.add_argument('-buckets', '--aspect-buckets', type=float, nargs='+',
+                        help='Aspect ratio (width / height) boundaries of buckets, e.g. 0.8 1.2 1.55. '
+                             'Each bucket is predicted with its own rectangular input shape of the same area. '
+                             'Results are spooled to temporary files and written in the order of images '
+                             'as soon as all previous images are predicted')
+    parser.add_argument('-threads', '--threads', type=int, default=1, help='Number of network instances run in threads')
+    parser.add_argument('-pin', '--pin-threads', action='store_true',
+                        help='Pin each thread or worker process to its own set of CPUs')
+    parser.add_argument('-workers', '--workers', type=int, default=1,
+                        help='Number of worker processes predicting contiguous shards of images')
+    parser.add_argument('-decoders', '--decoder-threads', type=int, default=2,
+                        help='Number of threads decoding images ahead of the network')
+    parser.add_argument('-decoder', '--decoder', type=str, choices=DECODERS, default='darknet',
+                        help='Image decoder, opencv-reduced decodes large JPEG images at reduced resolution '
+                             'that still covers the network input')
+    parser.add_argument('-prefetch', '--prefetch-depth', type=int, default=8,
+                        help='Number of images decoded ahead and results waiting for writing, '
+                             '0 to decode, predict and write serially')
+    parser.add_argument('-cache', '--cache-folder', type=str,
+                        help='Folder of the results cache, images predicted before with the same network '
+                             'and parameters are taken from the cache')
+    parser.add_argument('-cache-size', '--cache-size', type=float, default=1024, help='Cache size limit in MB')
+    parser.add_argument('-tensors', '--tensor-cache', type=str,
+                        help='Folder of letterboxed images kept as memory-mapped uint8 arrays per input shape, '
+                             'images are decoded and letterboxed once and reused by next runs on the same images')
+    parser.add_argument('-journal', '--journal-file', type=str,
+                        help='Journal of predicted images, an interrupted run restarted with the same journal '
+                             'continues where it stopped')
+    parser.add_argument('-journal-sync', '--journal-sync-every', type=int, default=100,
+                        help='Number of images between journal syncs to disk')
+    parser.add_argument('-timing', '--timing', action='store_true', help='Print time spent in detection stages')
+    parser.add_argument('-eval', '--evaluate', action='store_true',
+                        help='Evaluate predictions on ground truth of --images-file COCO json as images are predicted '
+                             'and print mAP and APs at the end')
+    parser.add_argument('-eval-log', '--evaluate-log-every', type=int, default=0,
+                        help='Print mAP of predicted images every given number of images')
+    parser.add_argument('-stream', '--stream-input', type=str,
+                        help='Read images paths line by line from a file or named pipe (- for stdin) and write '
+                             'JSON lines as soon as images are predicted. Use -out - to write to stdout')
     parser.add_argument('-gpu', '--gpu', type=int, default=0)
     return parser
 
@@ -55,14 +125,10 @@ def get_images_from_folder(images_folder):
 
 
 def get_images_from_json(images_folder, json_file):
-    with open(json_file, 'r') as f:
-        json_dict = json.load(f)
-    images = json_dict['images']
-    images_names, images_ids, images_files = list(), list(), list()
-    for image in images:
-        images_names.append(image['file_name'])
-        images_ids.append(image['id'])
-        images_files.append(os.path.join(images_folder, image['file_name']))
+    index = load_annotations_index(json_file)
+    images_names = index.images_names.tolist()
+    images_ids = index.images_ids.tolist()
+    images_files = [os.path.join(images_folder, image_name) for image_name in images_names]
     return images_names, images_ids, images_files
 
 
@@ -105,11 +171,7 @@ def init_cvat(images_num, class_id_to_name):
 
 
 def init_coco(class_id_to_name):
-    json_dict = {'images': list(), 'annotations': list(), 'categories': list()}
-    for class_id, class_name in class_id_to_name.items():
-        category = {'name': class_name, 'id': class_id+1}
-        json_dict['categories'].append(category)
-    return json_dict
+    return {'images': list(), 'annotations': list(), 'categories': get_coco_categories(class_id_to_name)}
 
 
 def add_predictions_to_out_data(image_name, image_id, width, height, predictions, out_data, class_id_to_name, predict_to='coco'):
@@ -135,54 +197,326 @@ def add_predictions_to_cvat(image_name, image_id, width, height, predictions, cl
         top = max(bbox[1] - bbox[3] / 2, 0)
         right = min(bbox[0] + bbox[2] / 2, width)
         bottom = min(bbox[1] + bbox[3] / 2, height)
-        image_bbox['xtl'] = left
-        image_bbox['ytl'] = top
-        image_bbox['xbr'] = right
-        image_bbox['ybr'] = bottom
+        image_bbox['xtl'] = str(left)
+        image_bbox['ytl'] = str(top)
+        image_bbox['xbr'] = str(right)
+        image_bbox['ybr'] = str(bottom)
         image_bbox['score'] = str(score)
         xml.SubElement(xml_image, "box", image_bbox)
 
 
 def add_predictions_to_coco(image_name, image_id, width, height, predictions, out_data):
-    image = dict()
-    image['id'] = image_id
-    image['file_name'] = image_name
-    image['width'] = width
-    image['height'] = height
-    out_data['images'].append(image)
-
+    out_data['images'].append(get_coco_image(image_name, image_id, width, height))
     for cl, score, bbox in predictions:
-        annotation = dict()
         if len(out_data['annotations']) == 0:
-            annotation['id'] = 1
+            annotation_id = 1
         else:
-            annotation['id'] = out_data['annotations'][-1]['id'] + 1
-        annotation['iscrowd'] = 0
-        annotation['image_id'] = image_id
-        annotation['category_id'] = cl + 1
-        left = max(bbox[0] - bbox[2] / 2, 0)
-        top = max(bbox[1] - bbox[3] / 2, 0)
-        right = min(bbox[0] + bbox[2] / 2, width)
-        bottom = min(bbox[1] + bbox[3] / 2, height)
-        annotation['bbox'] = [left, top, right - left, bottom - top]
-        annotation['area'] = annotation['bbox'][2] * annotation['bbox'][3]
-        annotation['score'] = score
-        out_data['annotations'].append(annotation)
+            annotation_id = out_data['annotations'][-1]['id'] + 1
+        out_data['annotations'].append(get_coco_annotation(annotation_id, image_id, width, height, cl, score, bbox))
+
+
+def detect_image_file(session, image_file, decoder='darknet'):
+    image = decode_image(image_file, decoder=decoder, target_size=(session.width, session.height))
+    predictions = session.detect(image)
+    width, height = get_image_size(image)
+    free_image(image)
+    return width, height, predictions
 
 
 def do_predictions(network, images_names, images_ids, images_files, class_id_to_name, threshold=0.001, max_dets=1000,
-                   nms=0.45, predict_to='cvat'):
-    out_data = init_out_data(len(images_files), class_id_to_name, predict_to=predict_to)
-    for image_name, image_id, image_file in tqdm(list(zip(images_names, images_ids, images_files))):
-        image = load_image(image_file.encode(), 0, 0)
-        predictions = detect_image_letterbox(network, image_file, max_dets=max_dets, thresh=threshold, nms=nms)
-        width, height = int(image.w), int(image.h)
-        free_image(image)
-        add_predictions_to_out_data(image_name, image_id, width, height, predictions, out_data, class_id_to_name,
-                                    predict_to=predict_to)
+                   nms=0.45, predict_to='cvat', batch_size=1, aspect_buckets=None, cache=None, cache_key=None,
+                   decoder_threads=2, prefetch_depth=8, decoder='darknet', writer=None, evaluator=None):
+    """
+    Images are decoded in decoder threads, predicted in a background thread and written to out_data
+    in the calling thread, every stage keeps up to prefetch_depth items ready for the next one.
+    With prefetch_depth 0 all stages are done serially in the calling thread.
+    If writer is given predictions are passed to it instead of out_data and None is returned.
+    If evaluator is given (see coco_eval.CocoEvaluator) predictions of every image are also added to it
+    """
+    with tqdm(total=len(images_files)) as progress:
+        results = get_results(network, images_files, progress, threshold=threshold, max_dets=max_dets, nms=nms,
+                              batch_size=batch_size, aspect_buckets=aspect_buckets, cache=cache, cache_key=cache_key,
+                              decoder_threads=decoder_threads, prefetch_depth=prefetch_depth, decoder=decoder)
+        if prefetch_depth > 0:
+            results = background_iter(results, depth=prefetch_depth)
+        return write_predictions(images_names, images_ids, results, class_id_to_name, predict_to=predict_to,
+                                 writer=writer, evaluator=evaluator)
+
+
+def write_predictions(images_names, images_ids, results, class_id_to_name, predict_to='cvat', writer=None,
+                      evaluator=None, collect=True):
+    """
+    Pass (width, height, predictions) results to writer or collect them in out_data if writer is None,
+    and to evaluator if it is given. With collect False and no writer results are only passed to evaluator
+    and None is returned
+    """
+    out_data = None
+    if (writer is None) and collect:
+        out_data = init_out_data(len(images_names), class_id_to_name, predict_to=predict_to)
+    for image_name, image_id, (width, height, predictions) in zip(images_names, images_ids, results):
+        if evaluator is not None:
+            evaluator.add(image_id, width, height, predictions)
+        if (writer is None) and not collect:
+            continue
+        predictions = array_to_predictions(predictions)
+        if writer is None:
+            add_predictions_to_out_data(image_name, image_id, width, height, predictions, out_data,
+                                        class_id_to_name, predict_to=predict_to)
+        else:
+            writer.add(image_name, image_id, width, height, predictions)
     return out_data
 
 
+def get_results(network, images_files, progress, threshold=0.001, max_dets=1000, nms=0.45, batch_size=1,
+                aspect_buckets=None, cache=None, cache_key=None, decoder_threads=2, prefetch_depth=8,
+                decoder='darknet', tensors=None, get_network=None):
+    """
+    Yields (width, height, predictions) for each image in order, predictions are structured arrays.
+    Images found in the cache are not predicted, new results are put to the cache.
+    Cached results are read as they are yielded, so only results of images being predicted are kept in memory.
+    With tensors images are taken from the letterboxed images instead of decoding.
+    get_network returns (network, tensors), it is called if network is None and a cached result is removed
+    before it is read
+    """
+    predict_kwargs = dict(threshold=threshold, max_dets=max_dets, nms=nms, batch_size=batch_size,
+                          aspect_buckets=aspect_buckets, decoder_threads=decoder_threads,
+                          prefetch_depth=prefetch_depth, decoder=decoder, tensors=tensors)
+    if cache is None:
+        yield from predict_images(network, images_files, progress, **predict_kwargs)
+        return
+    in_cache = [cache.contains(cache_key, image_file) for image_file in images_files]
+    missing_files = [image_file for image_file, found in zip(images_files, in_cache) if not found]
+    new_results = predict_images(network, missing_files, progress, **predict_kwargs)
+    for image_file, found in zip(images_files, in_cache):
+        result = cache.get(cache_key, image_file) if found else None
+        if result is not None:
+            progress.update()
+        elif found:
+            # result was evicted or is broken, e.g. it was removed by another process using the same cache
+            if network is None:
+                if get_network is None:
+                    raise RuntimeError('Result of {} was removed from the cache during prediction'.format(image_file))
+                network, predict_kwargs['tensors'] = get_network()
+            result = next(predict_images(network, [image_file], progress, **predict_kwargs))
+            cache.put(cache_key, image_file, *result)
+        else:
+            result = next(new_results)
+            cache.put(cache_key, image_file, *result)
+        yield result
+
+
+def predict_images(network, images_files, progress, threshold=0.001, max_dets=1000, nms=0.45, batch_size=1,
+                   aspect_buckets=None, decoder_threads=2, prefetch_depth=8, decoder='darknet', tensors=None):
+    if len(images_files) == 0:
+        return iter(())
+    if tensors is not None:
+        return predict_letterboxed_images(network, tensors, images_files, progress, threshold=threshold,
+                                          max_dets=max_dets, nms=nms, batch_size=batch_size,
+                                          prefetch_depth=prefetch_depth)
+    if isinstance(network, NetworkPool):
+        return predict_images_in_pool(network, images_files, progress, threshold=threshold, max_dets=max_dets,
+                                      nms=nms, decoder=decoder)
+    if aspect_buckets:
+        return predict_images_in_buckets(network, images_files, progress, aspect_buckets, threshold=threshold,
+                                         max_dets=max_dets, nms=nms, batch_size=batch_size,
+                                         decoder_threads=decoder_threads, prefetch_depth=prefetch_depth,
+                                         decoder=decoder)
+    if batch_size > 1:
+        return predict_images_in_batches(network, images_files, progress, threshold=threshold, max_dets=max_dets,
+                                         nms=nms, batch_size=batch_size, decoder_threads=decoder_threads,
+                                         prefetch_depth=prefetch_depth, decoder=decoder)
+    return predict_images_one_by_one(network, images_files, progress, threshold=threshold, max_dets=max_dets,
+                                     nms=nms, decoder_threads=decoder_threads, prefetch_depth=prefetch_depth,
+                                     decoder=decoder)
+
+
+def load_images(images_files, decoder_threads=2, prefetch_depth=8, decoder='darknet', target_size=None):
+    """
+    Yields decoded images in order, images should be freed by the caller.
+    target_size is the network input size used by reduced decoders
+    """
+    if prefetch_depth > 0:
+        return prefetch_images(images_files, threads=decoder_threads, depth=prefetch_depth, decoder=decoder,
+                               target_size=target_size)
+    return (decode_image(image_file, decoder=decoder, target_size=target_size) for image_file in images_files)
+
+
+def load_batches(images_files, batch_size, decoder_threads=2, prefetch_depth=8, decoder='darknet', target_size=None):
+    images = load_images(images_files, decoder_threads=decoder_threads,
+                         prefetch_depth=max(prefetch_depth, batch_size) if prefetch_depth > 0 else 0,
+                         decoder=decoder, target_size=target_size)
+    batch = list()
+    for image in images:
+        batch.append(image)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if len(batch) > 0:
+        yield batch
+
+
+def predict_images_one_by_one(network, images_files, progress, threshold=0.001, max_dets=1000, nms=0.45,
+                              decoder_threads=2, prefetch_depth=8, decoder='darknet'):
+    target_size = (network_width(network), network_height(network))
+    for image in load_images(images_files, decoder_threads=decoder_threads, prefetch_depth=prefetch_depth,
+                             decoder=decoder, target_size=target_size):
+        predictions = detect_image_letterbox(network, image, max_dets=max_dets, thresh=threshold, nms=nms,
+                                             as_array=True)
+        width, height = get_image_size(image)
+        free_image(image)
+        progress.update()
+        yield width, height, predictions
+
+
+def predict_images_in_pool(pool, images_files, progress, threshold=0.001, max_dets=1000, nms=0.45, decoder='darknet'):
+    for session in pool.sessions:
+        session.thresh, session.max_dets, session.nms = threshold, max_dets, nms
+    for result in pool.imap(lambda session, image_file: detect_image_file(session, image_file, decoder=decoder),
+                            images_files):
+        progress.update()
+        yield result
+
+
+def predict_images_in_batches(network, images_files, progress, threshold=0.001, max_dets=1000, nms=0.45, batch_size=1,
+                              decoder_threads=2, prefetch_depth=8, decoder='darknet'):
+    target_size = (network_width(network), network_height(network))
+    for images in load_batches(images_files, batch_size, decoder_threads=decoder_threads,
+                               prefetch_depth=prefetch_depth, decoder=decoder, target_size=target_size):
+        batch_predictions = detect_batch_letterbox(network, images, max_dets=max_dets, thresh=threshold, nms=nms,
+                                                   as_array=True, batch_size=batch_size)
+        results = list()
+        for image, predictions in zip(images, batch_predictions):
+            results.append((*get_image_size(image), predictions))
+            free_image(image)
+        progress.update(len(images))
+        yield from results
+
+
+def predict_letterboxed_images(network, tensors, images_files, progress, threshold=0.001, max_dets=1000, nms=0.45,
+                               batch_size=1, prefetch_depth=8):
+    indexes = tensors.get_indexes(images_files)
+    batches = ([(tensors.tensors[i], tensors.sizes[i].tolist()) for i in indexes[start:start + batch_size]]
+               for start in range(0, len(indexes), batch_size))
+    if prefetch_depth > 0:
+        # letterboxed images are read from disk in a background thread
+        batches = background_iter(([(np.array(tensor), size) for tensor, size in batch] for batch in batches),
+                                  depth=max(prefetch_depth // batch_size, 1))
+    batch = np.empty((batch_size, 3, network_height(network), network_width(network)), dtype=np.float32)
+    for images in batches:
+        batch_tensors, sizes = zip(*images)
+        batch_predictions = detect_letterboxed(network, batch_tensors, sizes, max_dets=max_dets, thresh=threshold,
+                                               nms=nms, as_array=True, batch_size=batch_size, batch=batch)
+        progress.update(len(images))
+        for (width, height), predictions in zip(sizes, batch_predictions):
+            yield width, height, predictions
+
+
+def get_images_sizes(images_files):
+    sizes = list()
+    for image_file in images_files:
+        with Image.open(image_file) as image:
+            sizes.append(image.size)
+    return sizes
+
+
+def split_to_buckets(sizes, boundaries):
+    buckets = [list() for _ in range(len(boundaries) + 1)]
+    for i, (width, height) in enumerate(sizes):
+        buckets[bisect_right(boundaries, width / height)].append(i)
+    return [bucket for bucket in buckets if len(bucket) > 0]
+
+
+def get_bucket_shape(aspect, base_shape):
+    """
+    Multiple-of-32 shape with the given aspect ratio and area close to the base shape area
+    """
+    area = base_shape[0] * base_shape[1]
+    width = max(round(math.sqrt(area * aspect) / 32) * 32, 32)
+    height = max(round(math.sqrt(area / aspect) / 32) * 32, 32)
+    return width, height
+
+
+def get_padding(width, height, shape):
+    new_w, new_h = letterbox_shape(width, height, shape[0], shape[1])
+    return 1 - (new_w * new_h) / (shape[0] * shape[1])
+
+
+def detect_images(network, images, threshold=0.001, max_dets=1000, nms=0.45, batch_size=1):
+    if batch_size > 1:
+        return detect_batch_letterbox(network, images, max_dets=max_dets, thresh=threshold, nms=nms, as_array=True,
+                                      batch_size=batch_size)
+    return [detect_image_letterbox(network, image, max_dets=max_dets, thresh=threshold, nms=nms, as_array=True)
+            for image in images]
+
+
+def predict_images_in_buckets(network, images_files, progress, boundaries, threshold=0.001, max_dets=1000, nms=0.45,
+                              batch_size=1, decoder_threads=2, prefetch_depth=8, decoder='darknet'):
+    """
+    Results of every bucket are spooled to a temporary file in the order of images of the bucket,
+    and are yielded in the order of images as soon as all previous images are predicted,
+    so only results of one batch are kept in memory
+    """
+    base_shape = (network_width(network), network_height(network))
+    sizes = get_images_sizes(images_files)
+    buckets = split_to_buckets(sizes, sorted(boundaries))
+    images_buckets = [0] * len(images_files)
+    for b, bucket in enumerate(buckets):
+        for i in bucket:
+            images_buckets[i] = b
+    buckets_stats = list()
+    readers = dict()
+    next_image = 0
+    with tempfile.TemporaryDirectory(prefix='buckets.') as spool_folder:
+        try:
+            for b, bucket in enumerate(buckets):
+                aspect = median(sizes[i][0] / sizes[i][1] for i in bucket)
+                shape = get_bucket_shape(aspect, base_shape)
+                resize_network(network, shape[0], shape[1])
+                start_time = time.time()
+                spool = PredictionJournal(os.path.join(spool_folder, '{}.journal'.format(b)), {'bucket': b})
+                spool.open()
+                batches = load_batches([images_files[i] for i in bucket], batch_size, decoder_threads=decoder_threads,
+                                       prefetch_depth=prefetch_depth, decoder=decoder, target_size=shape)
+                for start, images in zip(range(0, len(bucket), batch_size), batches):
+                    batch_predictions = detect_images(network, images, threshold=threshold, max_dets=max_dets,
+                                                      nms=nms, batch_size=batch_size)
+                    for image, predictions in zip(images, batch_predictions):
+                        spool.add(*get_image_size(image), predictions)
+                        free_image(image)
+                    progress.update(len(images))
+                spool.close()
+                elapsed = time.time() - start_time
+                buckets_stats.append({
+                    'aspect': aspect, 'shape': shape, 'images': len(bucket),
+                    'base_padding': sum(get_padding(*sizes[i], base_shape) for i in bucket) / len(bucket),
+                    'padding': sum(get_padding(*sizes[i], shape) for i in bucket) / len(bucket),
+                    'images_per_second': len(bucket) / elapsed if elapsed > 0 else float('inf')})
+                # reopened only to count its records for reading
+                spool.open()
+                spool.close()
+                readers[b] = spool.read()
+                # images of a bucket are in increasing order, so results are merged by taking the next one
+                # of the bucket of the next image
+                while (next_image < len(images_files)) and (images_buckets[next_image] in readers):
+                    yield next(readers[images_buckets[next_image]])
+                    next_image += 1
+        finally:
+            resize_network(network, base_shape[0], base_shape[1])
+            for reader in readers.values():
+                reader.close()
+    print_buckets_stats(buckets_stats, base_shape)
+
+
+def print_buckets_stats(buckets_stats, base_shape):
+    print('Aspect buckets (base shape {}x{}):'.format(*base_shape))
+    print('{:>8} {:>10} {:>8} {:>14} {:>11} {:>12}'.format(
+        'aspect', 'shape', 'images', 'base padding', 'padding', 'images/sec'))
+    for stats in buckets_stats:
+        print('{:>8.3f} {:>10} {:>8} {:>13.1f}% {:>10.1f}% {:>12.2f}'.format(
+            stats['aspect'], '{}x{}'.format(*stats['shape']), stats['images'], stats['base_padding'] * 100,
+            stats['padding'] * 100, stats['images_per_second']))
+
+
 def save_predictions(out_file, out_data, predict_to='coco'):
     if predict_to == 'cvat':
         save_predictions_to_cvat(out_file, out_data)
@@ -202,32 +536,425 @@ def save_predictions_to_coco(out_file, out_data):
         json.dump(out_data, f, indent=2)
 
 
-def predict(config_file, network_file, images_folder, out_file=None, predict_to='coco', detections_only=False,
-            images_file=None, classes_file=None, threshold=0.001, max_dets=1000, nms=0.45, input_shape=(None, None)):
-    if predict_to not in ('coco', 'cvat'):
+def predict(config_file, network_file, images_folder=None, out_file=None, predict_to=None, detections_only=False,
+            images_file=None, classes_file=None, threshold=0.001, max_dets=1000, nms=0.45, nms_kind='sort',
+            pre_nms_top_k=None, input_shape=(None, None), batch_size=1, aspect_buckets=None, threads=1, pin_threads=False,
+            decoder_threads=2, prefetch_depth=8, decoder='darknet', cache_folder=None, cache_size=1024,
+            tensor_cache=None, workers=1, journal_file=None, journal_sync_every=100, timing=False, stream_input=None,
+            network=None, evaluator=None, return_predictions=True):
+    """
+    Predictions are streamed to out_file if it is given and None is returned, so they are not kept in memory.
+    Otherwise they are collected and returned: COCO dict (its annotations list with detections_only)
+    or CVAT xml tree. With return_predictions False they are not collected and None is returned,
+    e.g. when they are only passed to evaluator.
+    With workers > 1 images are split into contiguous shards predicted in worker processes,
+    output is the same as of a single process run.
+    With journal_file results are journaled as they are predicted, a run restarted with the same arguments
+    continues from the first image not in the journal. The journal is removed when the run is finished.
+    With stream_input images paths are read from it until it is closed, see predict_stream.
+    predict_to is jsonl by default with stream_input and coco otherwise.
+    With tensor_cache images are letterboxed once into uint8 arrays kept in it, runs of other checkpoints
+    on the same images only run the network.
+    network is an already loaded network of config_file with network_file weights (see reload_network_weights),
+    or a function returning it which is called only if some images are to be predicted, e.g. are not in the cache.
+    It is used instead of loading the network and is not freed.
+    With evaluator (see coco_eval.CocoEvaluator) predictions are evaluated as images are predicted,
+    images ids should be ids of its ground truth
+    """
+    if predict_to is None:
+        predict_to = 'jsonl' if stream_input else 'coco'
+    if stream_input and (evaluator is not None):
+        raise RuntimeError('Evaluator can not be used with stream input')
+    if stream_input:
+        return predict_stream(config_file, network_file, stream_input, out_file, images_folder=images_folder,
+                              predict_to=predict_to, detections_only=detections_only,
+                              threshold=threshold, max_dets=max_dets, nms=nms, nms_kind=nms_kind,
+                              pre_nms_top_k=pre_nms_top_k, input_shape=input_shape, batch_size=batch_size,
+                              aspect_buckets=aspect_buckets, threads=threads, pin_threads=pin_threads,
+                              decoder_threads=decoder_threads, prefetch_depth=prefetch_depth, decoder=decoder,
+                              cache_folder=cache_folder, tensor_cache=tensor_cache, workers=workers,
+                              journal_file=journal_file, timing=timing)
+    if not images_folder:
+        raise RuntimeError('Images folder is required')
+    if predict_to not in ('coco', 'cvat', 'jsonl', 'npz'):
         raise RuntimeError()
+    if (predict_to in ('jsonl', 'npz')) and not out_file:
+        raise RuntimeError('JSON lines and npz predictions can only be written to a file')
     if len(input_shape) != 2:
         raise RuntimeError()
-    network = load_network(config_file, None, network_file)
+    if ((batch_size > 1) or aspect_buckets) and (threads > 1):
+        raise RuntimeError('Batch size and aspect buckets can not be used with threads')
+    if aspect_buckets and cache_folder:
+        raise RuntimeError('Aspect buckets can not be used with cache')
+    if tensor_cache and (aspect_buckets or (threads > 1)):
+        raise RuntimeError('Tensor cache can not be used with aspect buckets and threads')
+    if (network is not None) and ((threads > 1) or (workers > 1)):
+        raise RuntimeError('Loaded network can not be used with threads and workers')
+    if (workers > 1) and (aspect_buckets or timing):
+        raise RuntimeError('Aspect buckets and timing can not be used with workers')
     if input_shape[0] is not None:
         input_shape = tuple(map(lambda x: max(round(x/32) * 32, 32), input_shape))
-        resize_network(network, input_shape[0], input_shape[1])
+    if nms and (nms_kind != 'sort'):
+        nms = NMS(nms, kind=nms_kind, top_k=pre_nms_top_k)
+    if timing:
+        enable_stage_timing()
     images_names, images_ids, images_files = get_images(images_folder, images_file=images_file)
     class_id_to_name = get_class_id_to_name(classes_file=classes_file)
-    out_data = do_predictions(network, images_names, images_ids, images_files, class_id_to_name, threshold=threshold,
-                              max_dets=max_dets, nms=nms, predict_to=predict_to)
-    free_network_ptr(network)
-    if (predict_to == 'coco') and detections_only:
-        out_data = out_data['annotations']
+    writer = None
     if out_file:
-        save_predictions(out_file, out_data, predict_to=predict_to)
+        writer = open_writer(out_file, class_id_to_name, len(images_files), predict_to=predict_to,
+                             detections_only=detections_only)
+    # the writer is finished on success and its temporary files are removed on failure
+    with writer if writer is not None else contextlib.nullcontext():
+        network_kwargs = {'input_shape': input_shape, 'batch_size': batch_size, 'threads': threads,
+                          'pin_threads': pin_threads, 'cache_folder': cache_folder, 'cache_size': cache_size,
+                          'tensor_cache': tensor_cache, 'network': network}
+        predict_kwargs = {'threshold': threshold, 'max_dets': max_dets, 'nms': nms, 'batch_size': batch_size,
+                          'aspect_buckets': aspect_buckets, 'decoder_threads': decoder_threads,
+                          'prefetch_depth': prefetch_depth, 'decoder': decoder}
+        journal = None
+        if workers > 1:
+            out_data = predict_in_workers(config_file, network_file, images_names, images_ids, images_files,
+                                          class_id_to_name, workers, predict_to=predict_to, writer=writer,
+                                          pin_workers=pin_threads, journal_file=journal_file,
+                                          journal_sync_every=journal_sync_every, network_kwargs=network_kwargs,
+                                          predict_kwargs=predict_kwargs, evaluator=evaluator,
+                                          collect=return_predictions)
+        else:
+            if journal_file:
+                run_info = get_run_info(config_file, network_file, images_files, network_kwargs, predict_kwargs)
+                journal = PredictionJournal(journal_file, run_info, sync_every=journal_sync_every)
+            with tqdm(total=len(images_files)) as progress:
+                results = predict_results(config_file, network_file, images_files, progress, journal=journal,
+                                          network_kwargs=network_kwargs, predict_kwargs=predict_kwargs)
+                if prefetch_depth > 0:
+                    results = background_iter(results, depth=prefetch_depth)
+                out_data = write_predictions(images_names, images_ids, results, class_id_to_name, predict_to=predict_to,
+                                             writer=writer, evaluator=evaluator, collect=return_predictions)
+    if journal is not None:
+        journal.close(remove=True)
+    if timing:
+        print(disable_stage_timing().report())
+    if (out_data is not None) and (predict_to == 'coco') and detections_only:
+        out_data = out_data['annotations']
     return out_data
 
 
+def print_metrics(results):
+    classes = get_classes(results)
+    print('mAP {:.4f}'.format(extract_mAP(results)))
+    for cl, AP in zip(classes, extract_AP(results, classes)):
+        print('{} {:.4f}'.format(cl, AP))
+
+
+def predict_stream(config_file, network_file, stream_input, out_file, images_folder=None, predict_to='jsonl',
+                   detections_only=False, threshold=0.001, max_dets=1000, nms=0.45, nms_kind='sort',
+                   pre_nms_top_k=None, input_shape=(None, None), batch_size=1, aspect_buckets=None,
+                   threads=1, pin_threads=False, decoder_threads=2, prefetch_depth=8, decoder='darknet',
+                   cache_folder=None, tensor_cache=None, workers=1, journal_file=None, timing=False):
+    """
+    Read images paths line by line from stream_input (file, named pipe or - for stdin) with the network kept loaded
+    and write a JSON line for every image as soon as it is predicted. Images ids are numbers of images in the stream.
+    Up to prefetch_depth images are decoded ahead, when the output is not consumed reading of the input stops.
+    Missing files are skipped with a warning. With out_file - lines are written to stdout
+    and everything else printed to stdout goes to stderr
+    """
+    if predict_to != 'jsonl':
+        raise RuntimeError('Streaming input is written only to JSON lines')
+    if not out_file:
+        raise RuntimeError('Output file is required for streaming input')
+    if (batch_size > 1) or aspect_buckets or cache_folder or tensor_cache or (workers > 1) or journal_file:
+        raise RuntimeError('Batch size, aspect buckets, caches, workers and journal can not be used '
+                           'with streaming input')
+    if len(input_shape) != 2:
+        raise RuntimeError()
+    if input_shape[0] is not None:
+        input_shape = tuple(map(lambda x: max(round(x/32) * 32, 32), input_shape))
+    if nms and (nms_kind != 'sort'):
+        nms = NMS(nms, kind=nms_kind, top_k=pre_nms_top_k)
+    if timing:
+        enable_stage_timing()
+    if out_file == '-':
+        # darknet prints to stdout when the network is loaded
+        out = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        sys.stdout.flush()
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    else:
+        out = open(out_file, 'w')
+    stream = sys.stdin if stream_input == '-' else open(stream_input, 'r')
+    writer = JsonLinesWriter(out, detections_only=detections_only)
+    network = load_predict_network(config_file, network_file, input_shape=input_shape, threads=threads,
+                                   pin_threads=pin_threads)
+    names = deque()
+    try:
+        images_files = read_stream(stream, names, images_folder=images_folder)
+        results = predict_stream_images(network, images_files, threshold=threshold, max_dets=max_dets, nms=nms,
+                                        decoder_threads=decoder_threads, prefetch_depth=prefetch_depth,
+                                        decoder=decoder)
+        with tqdm(unit='img') as progress:
+            for image_id, (width, height, predictions) in enumerate(results):
+                writer.add(names.popleft(), image_id, width, height, array_to_predictions(predictions))
+                writer.flush()
+                progress.update()
+    finally:
+        free_predict_network(network)
+        writer.close()
+        if stream is not sys.stdin:
+            stream.close()
+    if timing:
+        print(disable_stage_timing().report())
+
+
+def read_stream(stream, names, images_folder=None):
+    """
+    Yields files of images paths read from stream, names of yielded images are appended to names
+    """
+    for line in stream:
+        image_name = line.strip()
+        if len(image_name) == 0:
+            continue
+        image_file = os.path.join(images_folder, image_name) if images_folder else image_name
+        if not os.path.isfile(image_file):
+            print('Skipping {}: file not found'.format(image_file), file=sys.stderr)
+            continue
+        names.append(image_name)
+        yield image_file
+
+
+def predict_stream_images(network, images_files, threshold=0.001, max_dets=1000, nms=0.45, decoder_threads=2,
+                          prefetch_depth=8, decoder='darknet'):
+    if isinstance(network, NetworkPool):
+        for session in network.sessions:
+            session.thresh, session.max_dets, session.nms = threshold, max_dets, nms
+        yield from network.imap(lambda session, image_file: detect_image_file(session, image_file, decoder=decoder),
+                                images_files, max_in_flight=max(prefetch_depth, network.size))
+        return
+    target_size = (network_width(network), network_height(network))
+    for image in load_images(images_files, decoder_threads=decoder_threads, prefetch_depth=prefetch_depth,
+                             decoder=decoder, target_size=target_size):
+        predictions = detect_image_letterbox(network, image, max_dets=max_dets, thresh=threshold, nms=nms,
+                                             as_array=True)
+        width, height = get_image_size(image)
+        free_image(image)
+        yield width, height, predictions
+
+
+def load_predict_network(config_file, network_file, input_shape=(None, None), batch_size=1, threads=1,
+                         pin_threads=False):
+    if threads > 1:
+        affinity = split_cpus(threads) if pin_threads else None
+        network = NetworkPool(config_file, network_file, size=threads, affinity=affinity)
+        if input_shape[0] is not None:
+            for session in network.sessions:
+                session.resize(input_shape[0], input_shape[1])
+    else:
+        network = load_network(config_file, None, network_file, batch_size=batch_size)
+        if input_shape[0] is not None:
+            resize_network(network, input_shape[0], input_shape[1])
+    return network
+
+
+def free_predict_network(network):
+    if isinstance(network, NetworkPool):
+        network.close()
+    elif network is not None:
+        free_network_ptr(network)
+
+
+def open_cache(config_file, network_file, cache_folder=None, cache_size=1024, input_shape=(None, None),
+               threshold=0.001, max_dets=1000, nms=0.45, decoder='darknet', letterboxed=False):
+    if not cache_folder:
+        return None, None
+    cache = ResultCache(cache_folder, max_size=cache_size * 2**20)
+    cache_key = cache.get_key(config_file, network_file, input_shape=tuple(input_shape), threshold=threshold,
+                              max_dets=max_dets, nms=nms, decoder=decoder, letterboxed=letterboxed)
+    return cache, cache_key
+
+
+def get_run_info(config_file, network_file, images_files, network_kwargs, predict_kwargs):
+    """
+    Description of a prediction run checked when a journal is resumed
+    """
+    files_info = dict()
+    for name, file in (('cfg', config_file), ('weights', network_file)):
+        stat = os.stat(file)
+        files_info[name] = [os.path.abspath(file), stat.st_mtime_ns, stat.st_size]
+    params = {'input_shape': tuple(network_kwargs['input_shape']), 'batch_size': network_kwargs['batch_size'],
+              'letterboxed': bool(network_kwargs['tensor_cache'])}
+    for name in ('threshold', 'max_dets', 'nms', 'aspect_buckets', 'decoder'):
+        params[name] = predict_kwargs[name]
+    images_hash = hashlib.sha1('\n'.join(map(os.path.abspath, images_files)).encode()).hexdigest()
+    return {'files': files_info, 'images': [len(images_files), images_hash],
+            'params': {name: repr(value) for name, value in params.items()}}
+
+
+def predict_results(config_file, network_file, images_files, progress, journal=None, network_kwargs=None,
+                    predict_kwargs=None):
+    """
+    Yields (width, height, predictions) of images in order. Images already in the journal are read from it,
+    others are taken from the cache or predicted and appended to the journal.
+    Network is loaded (or taken from a given network function) only if some images are neither in the journal
+    nor in the cache
+    """
+    network_kwargs = dict(network_kwargs)
+    given_network = network_kwargs.pop('network', None)
+    tensor_cache = network_kwargs.pop('tensor_cache')
+    cache, cache_key = open_cache(config_file, network_file, cache_folder=network_kwargs.pop('cache_folder'),
+                                  cache_size=network_kwargs.pop('cache_size'),
+                                  input_shape=network_kwargs['input_shape'], threshold=predict_kwargs['threshold'],
+                                  max_dets=predict_kwargs['max_dets'], nms=predict_kwargs['nms'],
+                                  decoder=predict_kwargs['decoder'], letterboxed=bool(tensor_cache))
+    all_images_files = images_files
+    done = 0
+    if journal is not None:
+        done = journal.open()
+        progress.update(done)
+        yield from journal.read()
+    images_files = images_files[done:]
+    loaded = list()
+
+    def get_network():
+        if not loaded:
+            if given_network is None:
+                network = load_predict_network(config_file, network_file, **network_kwargs)
+            else:
+                network = given_network() if callable(given_network) else given_network
+            loaded.append(network)
+            tensors = None
+            if tensor_cache:
+                # letterboxed images are kept for all images to be reused by runs of other checkpoints
+                tensors = load_letterboxed_images(tensor_cache, all_images_files,
+                                                  (network_width(network), network_height(network)),
+                                                  decoder=predict_kwargs['decoder'],
+                                                  decoder_threads=predict_kwargs['decoder_threads'],
+                                                  prefetch_depth=predict_kwargs['prefetch_depth'])
+            loaded.append(tensors)
+        return loaded[0], loaded[1]
+
+    try:
+        network, tensors = None, None
+        if (len(images_files) > 0) and \
+                ((cache is None) or not all(cache.contains(cache_key, image_file) for image_file in images_files)):
+            network, tensors = get_network()
+        results = get_results(network, images_files, progress, cache=cache, cache_key=cache_key, tensors=tensors,
+                              get_network=get_network, **predict_kwargs)
+        if journal is not None:
+            results = journal.record(results)
+        yield from results
+    finally:
+        if loaded and (given_network is None):
+            free_predict_network(loaded[0])
+        if cache is not None:
+            cache.close()
+        if journal is not None:
+            journal.close()
+
+
+class SharedProgress:
+    """
+    Progress of a worker process kept in a shared counter
+    """
+    def __init__(self, counter):
+        self.counter = counter
+
+    def update(self, n=1):
+        with self.counter.get_lock():
+            self.counter.value += n
+
+
+def predict_shard(config_file, network_file, images_files, shard_file, run_info, counter, cpus=None,
+                  journal_sync_every=100, network_kwargs=None, predict_kwargs=None):
+    """
+    Worker process: results of the shard images are written to the shard journal
+    """
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    journal = PredictionJournal(shard_file, run_info, sync_every=journal_sync_every)
+    results = predict_results(config_file, network_file, images_files, SharedProgress(counter), journal=journal,
+                              network_kwargs=network_kwargs, predict_kwargs=predict_kwargs)
+    if predict_kwargs['prefetch_depth'] > 0:
+        results = background_iter(results, depth=predict_kwargs['prefetch_depth'])
+    for _ in results:
+        pass
+
+
+def read_shard(shard_file, run_info, images_num):
+    """
+    Yields (width, height, predictions) of images of the shard in order
+    """
+    journal = PredictionJournal(shard_file, run_info)
+    if journal.open() != images_num:
+        raise RuntimeError('Shard {} is incomplete'.format(shard_file))
+    journal.close()
+    yield from journal.read()
+
+
+def predict_in_workers(config_file, network_file, images_names, images_ids, images_files, class_id_to_name, workers,
+                       predict_to='cvat', writer=None, pin_workers=False, journal_file=None, journal_sync_every=100,
+                       network_kwargs=None, predict_kwargs=None, evaluator=None, collect=True):
+    """
+    Predict contiguous shards of images in worker processes, then merge shards in order.
+    Shards are journals, they are kept next to journal_file if it is given to resume the run after a failure
+    """
+    context = multiprocessing.get_context('spawn')
+    counter = context.Value('q', 0)
+    bounds = np.linspace(0, len(images_files), workers + 1).round().astype(int).tolist()
+    cpus = split_cpus(workers) if pin_workers else [None] * workers
+    shards_folder = None
+    if journal_file is None:
+        shards_folder = tempfile.mkdtemp(prefix='predict_shards_')
+    processes, shards = list(), list()
+    try:
+        for i in range(workers):
+            if shards_folder is None:
+                shard_file = '{}.{}'.format(journal_file, i)
+            else:
+                shard_file = os.path.join(shards_folder, 'shard_{}'.format(i))
+            shard_images_files = images_files[bounds[i]:bounds[i+1]]
+            run_info = get_run_info(config_file, network_file, shard_images_files, network_kwargs, predict_kwargs)
+            run_info['shard'] = [i, workers]
+            process = context.Process(target=predict_shard, args=(
+                config_file, network_file, shard_images_files, shard_file, run_info, counter, cpus[i],
+                journal_sync_every, network_kwargs, predict_kwargs))
+            process.start()
+            processes.append(process)
+            shards.append((shard_file, run_info, len(shard_images_files)))
+        with tqdm(total=len(images_files)) as progress:
+            while any(process.is_alive() for process in processes):
+                time.sleep(0.5)
+                progress.update(counter.value - progress.n)
+            progress.update(counter.value - progress.n)
+        for process in processes:
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError('Worker process failed with exit code {}'.format(process.exitcode))
+        results = (result for shard in shards for result in read_shard(*shard))
+        out_data = write_predictions(images_names, images_ids, results, class_id_to_name, predict_to=predict_to,
+                                     writer=writer, evaluator=evaluator, collect=collect)
+        if shards_folder is None:
+            for shard_file, _, _ in shards:
+                os.remove(shard_file)
+        return out_data
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        if shards_folder is not None:
+            shutil.rmtree(shards_folder)
+
+
 if __name__ == '__main__':
     parser = build_parser()
     args = parser.parse_args()
     os.environ["CUDA_VISIBLE_DEVICES"] = str(args.gpu)
     kwargs = vars(args)
     kwargs.pop('gpu')
+    evaluate, log_every = kwargs.pop('evaluate'), kwargs.pop('evaluate_log_every')
+    if evaluate:
+        if not args.images_file or not args.images_file.endswith('.json'):
+            raise RuntimeError('Evaluation requires COCO json images file with ground truth')
+        kwargs['evaluator'] = CocoEvaluator(GroundTruth(load_annotations_index(args.images_file).columns),
+                                            log_every=log_every)
     predict(**kwargs)
+    if evaluate:
+        print_metrics(kwargs['evaluator'].get_results())
@@ -0,0 +1,99 @@
+"""
+Journal of a prediction run
+
+Results of images are appended to the journal as they are predicted, so a run that was interrupted
+can be restarted from the first image that is not in the journal. The journal starts with a JSON header line
+describing the run, a journal of another run is not resumed. Every record is image width, height and
+predictions number (int64 each) followed by predictions with PREDICTION_DTYPE. A record cut by a crash
+is removed when the journal is opened.
+"""
+import os
+import json
+import numpy as np
+from darknet import PREDICTION_DTYPE
+
+
+JOURNAL_RECORD_DTYPE = np.dtype([('width', '<i8'), ('height', '<i8'), ('count', '<i8')])
+
+
+class PredictionJournal:
+    def __init__(self, journal_file, run_info, sync_every=100):
+        self.journal_file = journal_file
+        self.header = (json.dumps(run_info, sort_keys=True) + '\n').encode()
+        self.sync_every = sync_every
+        self.file = None
+        self.done = 0
+
+    def open(self):
+        """
+        Open the journal for appending, returns number of images already in the journal
+        """
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'rb') as f:
+                header = f.readline()
+                if header != self.header:
+                    raise RuntimeError('Journal {} belongs to another run'.format(self.journal_file))
+                self.done, end = self.scan(f)
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(end)
+        else:
+            with open(self.journal_file, 'wb') as f:
+                f.write(self.header)
+            self.done = 0
+        self.file = open(self.journal_file, 'ab')
+        return self.done
+
+    @staticmethod
+    def scan(f):
+        """
+        Number of complete records and the end of the last one
+        """
+        done, end = 0, f.tell()
+        file_size = os.fstat(f.fileno()).st_size
+        while end + JOURNAL_RECORD_DTYPE.itemsize <= file_size:
+            record = np.frombuffer(f.read(JOURNAL_RECORD_DTYPE.itemsize), dtype=JOURNAL_RECORD_DTYPE)[0]
+            record_end = end + JOURNAL_RECORD_DTYPE.itemsize + int(record['count']) * PREDICTION_DTYPE.itemsize
+            if record_end > file_size:
+                break
+            f.seek(record_end)
+            done, end = done + 1, record_end
+        return done, end
+
+    def read(self):
+        """
+        Yields (width, height, predictions) of images in the journal when it was opened
+        """
+        with open(self.journal_file, 'rb') as f:
+            f.readline()
+            for _ in range(self.done):
+                record = np.frombuffer(f.read(JOURNAL_RECORD_DTYPE.itemsize), dtype=JOURNAL_RECORD_DTYPE)[0]
+                count = int(record['count'])
+                predictions = np.frombuffer(f.read(count * PREDICTION_DTYPE.itemsize), dtype=PREDICTION_DTYPE)
+                yield int(record['width']), int(record['height']), predictions
+
+    def add(self, width, height, predictions):
+        record = np.array([(width, height, len(predictions))], dtype=JOURNAL_RECORD_DTYPE)
+        self.file.write(record.tobytes())
+        self.file.write(np.ascontiguousarray(predictions, dtype=PREDICTION_DTYPE).tobytes())
+
+    def record(self, results):
+        """
+        Append results to the journal as they pass through, the journal is synced to disk every sync_every images
+        """
+        for i, result in enumerate(results, 1):
+            self.add(*result)
+            if i % self.sync_every == 0:
+                self.sync()
+            yield result
+        self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, remove=False):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if remove:
+            os.remove(self.journal_file)
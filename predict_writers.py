@@ -0,0 +1,235 @@
+"""
+Streaming writers of predictions
+
+Writers take predictions of images one by one and keep only a constant amount of data in memory.
+COCO and CVAT files are the same byte for byte as files saved by save_predictions:
+COCO images and annotations are spooled to temporary files and joined into json.dump(indent=2) layout on close,
+CVAT XML is written in minidom toprettyxml(indent='  ') layout.
+
+JSON lines files have one image per line: {"image": {...}, "annotations": [...]},
+or one annotation per line if detections_only is set.
+"""
+import os
+import json
+import shutil
+import tempfile
+
+
+def get_coco_image(image_name, image_id, width, height):
+    image = dict()
+    image['id'] = image_id
+    image['file_name'] = image_name
+    image['width'] = width
+    image['height'] = height
+    return image
+
+
+def get_coco_annotation(annotation_id, image_id, width, height, cl, score, bbox):
+    annotation = dict()
+    annotation['id'] = annotation_id
+    annotation['iscrowd'] = 0
+    annotation['image_id'] = image_id
+    annotation['category_id'] = cl + 1
+    left = max(bbox[0] - bbox[2] / 2, 0)
+    top = max(bbox[1] - bbox[3] / 2, 0)
+    right = min(bbox[0] + bbox[2] / 2, width)
+    bottom = min(bbox[1] + bbox[3] / 2, height)
+    annotation['bbox'] = [left, top, right - left, bottom - top]
+    annotation['area'] = annotation['bbox'][2] * annotation['bbox'][3]
+    annotation['score'] = score
+    return annotation
+
+
+def get_coco_categories(class_id_to_name):
+    return [{'name': class_name, 'id': class_id+1} for class_id, class_name in class_id_to_name.items()]
+
+
+class JsonListSpool:
+    """
+    Items of a JSON list written to a temporary file in json.dump(indent=2) layout at the given nesting level
+    """
+    def __init__(self, level, folder=None):
+        self.file = tempfile.TemporaryFile('w+', dir=folder)
+        self.indent = '  ' * (level + 1)
+        self.empty = True
+
+    def add(self, item):
+        if not self.empty:
+            self.file.write(',')
+        self.file.write('\n' + self.indent)
+        self.file.write(json.dumps(item, indent=2).replace('\n', '\n' + self.indent))
+        self.empty = False
+
+    def write_to(self, f):
+        """
+        Write the list closed at its nesting level
+        """
+        if self.empty:
+            f.write('[]')
+            return
+        f.write('[')
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, f)
+        f.write('\n' + self.indent[2:] + ']')
+
+    def close(self):
+        self.file.close()
+
+
+class CocoWriter:
+    def __init__(self, out_file, class_id_to_name, detections_only=False):
+        self.out_file = out_file
+        self.categories = get_coco_categories(class_id_to_name)
+        self.detections_only = detections_only
+        folder = os.path.dirname(os.path.abspath(out_file))
+        level = 0 if detections_only else 1
+        self.images = None if detections_only else JsonListSpool(level, folder=folder)
+        self.annotations = JsonListSpool(level, folder=folder)
+        self.annotations_num = 0
+
+    def add(self, image_name, image_id, width, height, predictions):
+        annotations = [get_coco_annotation(self.annotations_num + i + 1, image_id, width, height, cl, score, bbox)
+                       for i, (cl, score, bbox) in enumerate(predictions)]
+        self.add_annotations(image_id, image_name, width, height, annotations)
+
+    def add_annotations(self, image_id, image_name, width, height, annotations):
+        if self.images is not None:
+            self.images.add(get_coco_image(image_name, image_id, width, height))
+        for annotation in annotations:
+            self.annotations.add(annotation)
+        self.annotations_num += len(annotations)
+
+    def close(self):
+        tmp_file = self.out_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            if self.detections_only:
+                self.annotations.write_to(f)
+            else:
+                f.write('{\n  "images": ')
+                self.images.write_to(f)
+                f.write(',\n  "annotations": ')
+                self.annotations.write_to(f)
+                f.write(',\n  "categories": ')
+                f.write(json.dumps(self.categories, indent=2).replace('\n', '\n  '))
+                f.write('\n}')
+        os.replace(tmp_file, self.out_file)
+        if self.images is not None:
+            self.images.close()
+        self.annotations.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            if self.images is not None:
+                self.images.close()
+            self.annotations.close()
+
+
+class JsonLinesWriter:
+    def __init__(self, out_file, class_id_to_name=None, detections_only=False):
+        self.file = open(out_file, 'w') if isinstance(out_file, str) else out_file
+        self.detections_only = detections_only
+        self.annotations_num = 0
+
+    def add(self, image_name, image_id, width, height, predictions):
+        annotations = list()
+        for cl, score, bbox in predictions:
+            self.annotations_num += 1
+            annotations.append(get_coco_annotation(self.annotations_num, image_id, width, height, cl, score, bbox))
+        if self.detections_only:
+            for annotation in annotations:
+                self.file.write(json.dumps(annotation) + '\n')
+        else:
+            image = get_coco_image(image_name, image_id, width, height)
+            self.file.write(json.dumps({'image': image, 'annotations': annotations}) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def escape_xml(data):
+    # same escaping as minidom uses for text and attributes
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def format_xml_element(tag, attributes, indent):
+    attributes = ''.join(' {}="{}"'.format(name, escape_xml(value)) for name, value in attributes.items())
+    return '{}<{}{}'.format(indent, tag, attributes)
+
+
+class CvatWriter:
+    def __init__(self, out_file, class_id_to_name, images_num):
+        self.out_file = out_file
+        self.tmp_file = out_file + '.tmp'
+        self.file = open(self.tmp_file, 'w')
+        self.file.write('<?xml version="1.0" ?>\n<annotations>\n  <meta>\n    <task>\n')
+        for tag, text in (('size', str(images_num)), ('mode', 'annotation'), ('overlap', '0'), ('flipped', 'False')):
+            self.file.write('      <{0}>{1}</{0}>\n'.format(tag, escape_xml(text)))
+        classes = [class_name for _, class_name in sorted(class_id_to_name.items())]
+        if len(classes) == 0:
+            self.file.write('      <labels/>\n')
+        else:
+            self.file.write('      <labels>\n')
+            for cl in classes:
+                self.file.write('        <label>\n          <name>{}</name>\n        </label>\n'.format(escape_xml(cl)))
+            self.file.write('      </labels>\n')
+        self.file.write('    </task>\n  </meta>\n')
+        self.class_id_to_name = class_id_to_name
+
+    def add(self, image_name, image_id, width, height, predictions):
+        image = {'id': str(image_id), 'name': image_name, 'width': str(width), 'height': str(height)}
+        self.file.write(format_xml_element('image', image, '  '))
+        if len(predictions) == 0:
+            self.file.write('/>\n')
+            return
+        self.file.write('>\n')
+        for cl, score, bbox in predictions:
+            left = max(bbox[0] - bbox[2] / 2, 0)
+            top = max(bbox[1] - bbox[3] / 2, 0)
+            right = min(bbox[0] + bbox[2] / 2, width)
+            bottom = min(bbox[1] + bbox[3] / 2, height)
+            box = {'label': self.class_id_to_name[cl], 'occluded': '0', 'xtl': str(left), 'ytl': str(top),
+                   'xbr': str(right), 'ybr': str(bottom), 'score': str(score)}
+            self.file.write(format_xml_element('box', box, '    ') + '/>\n')
+        self.file.write('  </image>\n')
+
+    def close(self):
+        self.file.write('</annotations>\n')
+        self.file.close()
+        os.replace(self.tmp_file, self.out_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.tmp_file)
+
+
+def open_writer(out_file, class_id_to_name, images_num, predict_to='coco', detections_only=False):
+    if predict_to == 'coco':
+        return CocoWriter(out_file, class_id_to_name, detections_only=detections_only)
+    if predict_to == 'jsonl':
+        return JsonLinesWriter(out_file, detections_only=detections_only)
+    if predict_to == 'cvat':
+        return CvatWriter(out_file, class_id_to_name, images_num)
+    if predict_to == 'npz':
+        from detections_npz import NpzWriter
+        return NpzWriter(out_file, class_id_to_name)
+    return None
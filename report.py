@@ -1,13 +1,23 @@
 import os
+import json
+import functools
+import math
+import numpy as np
 import matplotlib.pyplot as plt
 from predict import predict
+from darknet import load_network, reload_network_weights, free_network_ptr
 from tqdm import tqdm
 import argparse
 import csv
-from dataset_scripts.metrics_eval import evaluate_detections, extract_mAP, extract_AP, get_classes
-import json
+import multiprocessing
+from coco_eval import GroundTruth, CocoEvaluator, get_detections_columns, extract_mAP, extract_AP, get_classes
 import sys
 from dataset_scripts.utils.coco_tools import leave_boxes
+from detections_npz import load_coco_annotations, load_detections
+from annotations_index import load_annotations_index, build_index_columns
+
+
+DEFAULT_AREA_RANGES = [('all', 0**2, 1e5**2)]
 
 
 def build_parser():
@@ -25,16 +35,64 @@ def build_parser():
         parser.add_argument('-img-fld', '--images-folder', required=True, type=str)
         parser.add_argument('-ann', '--annotations-file', required=True, type=str)
     parser.add_argument('-area', '--area', nargs=2, type=str, default=['0**2', '1e5**2'])
+    parser.add_argument('-areas', '--area-ranges', nargs='+', type=str,
+                        help='Named area ranges evaluated in one pass as triples of name, min and max area, '
+                             'e.g. small 0**2 32**2 medium 32**2 96**2 large 96**2 1e5**2. '
+                             'One metrics table is written for every range')
     parser.add_argument('-shape', '--shape', nargs=2, type=int, default=(None, None))
     parser.add_argument('-add', '--add', action='store_true')
     parser.add_argument('-dont-repredict', '--dont-repredict', dest='repredict', action='store_false')
+    parser.add_argument('-fmt', '--predictions-format', type=str, choices=['json', 'npz'], default='json',
+                        help='Format of epochs predictions files, npz is columnar binary format of detections_npz.py')
+    parser.add_argument('-proc', '--processes', type=int, default=1,
+                        help='Number of processes evaluating epochs in parallel')
+    parser.add_argument('-cache', '--cache-folder', type=str,
+                        help='Folder of the results cache shared by all checkpoints, '
+                             'only new checkpoints and new images are predicted')
+    parser.add_argument('-cache-size', '--cache-size', type=float, default=1024, help='Cache size limit in MB')
+    parser.add_argument('-tensors', '--tensor-cache', type=str,
+                        help='Folder of letterboxed images shared by all checkpoints, '
+                             'images are decoded and letterboxed only once')
+    parser.add_argument('-screen', '--screening', action='store_true',
+                        help='Successive halving of checkpoints: all checkpoints are evaluated on a small stratified '
+                             'subset of images, the best of them on larger subsets and the best few on all images. '
+                             'mAPs on subsets with bootstrap confidence intervals are saved to screening.csv')
+    parser.add_argument('-screen-start', '--screening-start', type=float, default=0.1,
+                        help='Fraction of images of the first screening subset')
+    parser.add_argument('-screen-keep', '--screening-keep', type=float, default=0.5,
+                        help='Fraction of checkpoints kept for the next subset, it is also the ratio of subset sizes')
+    parser.add_argument('-screen-final', '--screening-final', type=int, default=3,
+                        help='Number of best checkpoints evaluated on all images, it is also the lowest number '
+                             'of checkpoints kept for the next subset')
+    parser.add_argument('-screen-boot', '--screening-bootstrap', type=int, default=30,
+                        help='Number of bootstrap samples of confidence intervals')
+    parser.add_argument('-screen-seed', '--screening-seed', type=int, default=0)
     parser.add_argument('-gpu', '--gpu', type=int, default=0)
     return parser
 
 
-def get_existing_information(report_folder):
+def get_report_file(report_folder, file_name, area_name=None):
+    if area_name is not None:
+        base, ext = os.path.splitext(file_name)
+        file_name = '{}_{}{}'.format(base, area_name, ext)
+    return os.path.join(report_folder, file_name)
+
+
+def get_area_ranges(values):
+    if len(values) % 3 != 0:
+        raise RuntimeError('Area ranges should be triples of name, min and max area')
+    area_ranges = list()
+    for name, low, high in zip(values[0::3], values[1::3], values[2::3]):
+        low, high = eval(low), eval(high)
+        if high == -1:
+            high = 1e5**2
+        area_ranges.append((name, low, high))
+    return area_ranges
+
+
+def get_existing_information(report_folder, area_name=None):
     existing_epochs, existing_metrics = list(), list()
-    with open(os.path.join(report_folder, 'metrics.csv'), 'r') as f:
+    with open(get_report_file(report_folder, 'metrics.csv', area_name=area_name), 'r') as f:
         existing_information = csv.reader(f, delimiter=' ')
         for new_information in existing_information:
             existing_epochs.append(int(new_information[0]))
@@ -65,51 +123,284 @@ def get_models_files(models_folder, existing_epochs):
     return models_files, epochs
 
 
-def run_models(config_file, models_files, epochs, report_folder, images_folder, annotations_file, repredict=True):
-    for model_file, epoch in tqdm(list(zip(models_files, epochs))):
-        out_file = os.path.join(report_folder, 'predictions', 'epoch_{}.json'.format(epoch))
-        if os.path.exists(out_file) and not repredict:
+def get_predictions_file(report_folder, epoch, predictions_format='json'):
+    return os.path.join(report_folder, 'predictions', 'epoch_{}.{}'.format(epoch, predictions_format))
+
+
+class CheckpointsNetwork:
+    """
+    Network of config_file loaded once for all checkpoints, weights of next checkpoints are loaded into it.
+    Weights are loaded only by get, which is given to predict as the network function, so checkpoints
+    with all images in the results cache are not loaded at all
+    """
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.network = None
+
+    def get(self, model_file):
+        if self.network is None:
+            self.network = load_network(self.config_file, None, model_file)
+        else:
+            reload_network_weights(self.network, model_file)
+        return self.network
+
+    def close(self):
+        if self.network is not None:
+            free_network_ptr(self.network)
+            self.network = None
+
+
+def run_models(config_file, models_files, epochs, report_folder, images_folder, annotations_file, repredict=True,
+               cache_folder=None, cache_size=1024, tensor_cache=None, predictions_format='json', ground_truth=None):
+    """
+    The network is loaded once, weights of next checkpoints are loaded into it when they are to be predicted.
+    With ground_truth predicted epochs are evaluated while their images are predicted,
+    returns dict of their metrics and classes as returned by evaluate_epoch
+    """
+    predict_to = 'coco' if predictions_format == 'json' else predictions_format
+    evaluated = dict()
+    network = CheckpointsNetwork(config_file)
+    try:
+        for model_file, epoch in tqdm(list(zip(models_files, epochs))):
+            out_file = get_predictions_file(report_folder, epoch, predictions_format=predictions_format)
+            if os.path.exists(out_file) and not repredict:
+                continue
+            evaluator = None if ground_truth is None else CocoEvaluator(ground_truth)
+            predict(config_file, model_file, images_folder, out_file=out_file, predict_to=predict_to,
+                    detections_only=True, images_file=annotations_file, classes_file=annotations_file, threshold=0.01,
+                    max_dets=100, cache_folder=cache_folder, cache_size=cache_size, tensor_cache=tensor_cache,
+                    network=functools.partial(network.get, model_file), evaluator=evaluator)
+            if evaluator is not None:
+                # kostil' #
+                if evaluator.detections_num == 0:
+                    evaluated[epoch] = (None, None)
+                    continue
+                ###########
+                evaluated[epoch] = get_epoch_metrics(evaluator.get_results())
+    finally:
+        network.close()
+    return evaluated
+
+
+def get_stratified_order(ground_truth, seed=0):
+    """
+    Order of ground truth images every prefix of which is a stratified sample of them.
+    Stratum of an image is its rarest category, images without boxes are a separate stratum.
+    Images of a stratum are shuffled and spread evenly over the order with a random offset
+    """
+    rng = np.random.default_rng(seed)
+    images_num, categories_num = len(ground_truth.images_ids), len(ground_truth.categories_ids)
+    images, categories = ground_truth.keys // categories_num, ground_truth.keys % categories_num
+    boxes_num = np.bincount(categories, minlength=categories_num)
+    strata = np.full(images_num, categories_num)
+    np.minimum.at(strata, images, np.argsort(np.argsort(boxes_num, kind='stable'))[categories])
+    positions = np.empty(images_num)
+    for stratum in np.unique(strata):
+        indexes = rng.permutation(np.flatnonzero(strata == stratum))
+        positions[indexes] = (np.arange(len(indexes)) + rng.random()) / len(indexes)
+    return np.argsort(positions, kind='stable')
+
+
+def get_screening_sizes(images_num, start=0.1, keep=0.5):
+    """
+    Sizes of nested subsets of images growing by 1 / keep from start fraction of images to all images
+    """
+    if not (0 < start <= 1):
+        raise RuntimeError('Screening start should be in (0, 1]')
+    if not (0 < keep < 1):
+        raise RuntimeError('Screening keep should be in (0, 1)')
+    sizes = [max(1, math.ceil(images_num * start))]
+    while sizes[-1] < images_num:
+        sizes.append(min(images_num, math.ceil(sizes[-1] / keep)))
+    return sizes
+
+
+def save_screening_images(annotations_dict, images_indexes, images_file):
+    with open(images_file, 'w') as f:
+        json.dump({'images': [annotations_dict['images'][i] for i in images_indexes],
+                   'annotations': list(), 'categories': annotations_dict['categories']}, f)
+
+
+def screen_models(config_file, models_files, epochs, report_folder, images_folder, annotations_file,
+                  annotations_dict, ground_truth, start=0.1, keep=0.5, final=3, bootstrap=30, seed=0,
+                  cache_folder=None, cache_size=1024, tensor_cache=None):
+    """
+    Successive halving of checkpoints. Checkpoints are evaluated on nested stratified subsets of images,
+    only images added to a subset are predicted. After every subset the best keep fraction of checkpoints
+    (at least final) are kept, and only the best final of them are evaluated on all images
+    (all checkpoints if the first subset is all images).
+    Returns rows (epoch, images, mAP, low, high) with 95% bootstrap confidence intervals of every evaluation
+    and dict of metrics and classes of checkpoints evaluated on all images as returned by evaluate_epoch
+    """
+    if final < 1:
+        raise RuntimeError('Screening final should be at least 1')
+    order = get_stratified_order(ground_truth, seed=seed)
+    sizes = get_screening_sizes(len(order), start=start, keep=keep)
+    screening_folder = os.path.join(report_folder, 'screening')
+    os.makedirs(screening_folder, exist_ok=True)
+    area = ground_truth.area_ranges[0][0]
+    models_files = dict(zip(epochs, models_files))
+    evaluators = {epoch: CocoEvaluator(ground_truth) for epoch in sorted(epochs)}
+    rows, evaluated = list(), dict()
+    network = CheckpointsNetwork(config_file)
+    try:
+        for level, size in enumerate(sizes):
+            images_file = os.path.join(screening_folder, 'images_{}.json'.format(level))
+            save_screening_images(annotations_dict, order[sizes[level - 1] if level > 0 else 0:size].tolist(),
+                                  images_file)
+            mAPs = dict()
+            for epoch in tqdm(list(evaluators.keys()), desc='{} images'.format(size)):
+                evaluator = evaluators[epoch]
+                predict(config_file, models_files[epoch], images_folder, detections_only=True,
+                        images_file=images_file, classes_file=annotations_file, threshold=0.01, max_dets=100,
+                        cache_folder=cache_folder, cache_size=cache_size, tensor_cache=tensor_cache,
+                        network=functools.partial(network.get, models_files[epoch]), evaluator=evaluator,
+                        return_predictions=False)
+                mAPs[epoch] = extract_mAP(evaluator.get_results(), area=area)
+                bootstrap_mAPs = evaluator.get_bootstrap_mAPs(bootstrap, seed=seed, area=area)
+                low, high = np.percentile(bootstrap_mAPs, [2.5, 97.5]).tolist() if bootstrap_mAPs else (0, 0)
+                rows.append([epoch, size, mAPs[epoch], low, high])
+            if size == sizes[-1]:
+                break
+            if sizes[level + 1] == sizes[-1]:
+                kept_num = final
+            else:
+                kept_num = max(final, math.ceil(len(mAPs) * keep))
+            kept = sorted(mAPs.keys(), key=lambda epoch: -mAPs[epoch])[:kept_num]
+            evaluators = {epoch: evaluators[epoch] for epoch in sorted(kept)}
+    finally:
+        network.close()
+    for epoch, evaluator in evaluators.items():
+        # kostil' #
+        if evaluator.detections_num == 0:
+            evaluated[epoch] = (None, None)
             continue
-        predict(config_file, model_file, images_folder, out_file=out_file, predict_to='coco', detections_only=True,
-                images_file=annotations_file, classes_file=annotations_file, threshold=0.01, max_dets=100)
+        ###########
+        evaluated[epoch] = get_epoch_metrics(evaluator.get_results())
+    return rows, evaluated
+
 
+def save_screening(rows, report_folder):
+    with open(os.path.join(report_folder, 'screening.csv'), 'w') as f:
+        writer = csv.writer(f, delimiter=' ')
+        for row in rows:
+            writer.writerow(row)
 
-def calculate_metrics(epochs, report_folder, annotations_file, area, shape=(None, None)):
+
+def load_ground_truth(annotations_file, area, shape=(None, None), area_ranges=DEFAULT_AREA_RANGES):
+    """
+    Ground truth filtered by area and shape as COCO dict and prepared for evaluation
+    """
+    annotations_dict = load_annotations_index(annotations_file).to_coco()
+    leave_boxes(annotations_dict, area, width=shape[0], height=shape[1])
+    return annotations_dict, GroundTruth(build_index_columns(annotations_dict), area_ranges=area_ranges)
+
+
+def calculate_metrics(epochs, report_folder, annotations_dict, ground_truth, area, shape=(None, None),
+                      predictions_format='json', processes=1, evaluated=None):
+    """
+    Epochs which are not in evaluated are evaluated from their predictions files. With processes > 1
+    they are evaluated in a process pool, workers get the ground truth once when they start.
+    Metrics are returned in the order of epochs, metrics of an epoch are a list with metrics of every area range
+    """
+    if evaluated is None:
+        evaluated = dict()
     metrics = list()
     # kostil' #
     indexes_to_correct = list()
     ###########
-    with open(annotations_file, 'r') as f:
-        annotations_dict = json.load(f)
-    leave_boxes(annotations_dict, area, width=shape[0], height=shape[1])
-
-    for epoch in tqdm(epochs):
-        detections_file = os.path.join(report_folder, 'predictions/epoch_{}.json'.format(epoch))
-        with open(detections_file, 'r') as f:
-            detections_dict = json.load(f)
-        # kostil' #
-        if detections_dict == list():
-            metrics.append(None)
-            indexes_to_correct.append(len(metrics)-1)
-            continue
-        ###########
-        detections_dict_with_images = {'images': annotations_dict['images'], 'annotations': detections_dict}
-        leave_boxes(detections_dict_with_images, area, width=shape[0], height=shape[1])
-        detections_dict = detections_dict_with_images['annotations']
-        results = evaluate_detections(annotations_dict, detections_dict)
-        classes = get_classes(results)
-        metric = [extract_mAP(results)]
-        metric += extract_AP(results, classes)
-        metrics.append(metric)
+    detections_files = [get_predictions_file(report_folder, epoch, predictions_format=predictions_format)
+                        for epoch in epochs if epoch not in evaluated]
+    if (processes > 1) and detections_files:
+        pool = multiprocessing.Pool(min(processes, len(detections_files)), initializer=init_metrics_worker,
+                                    initargs=(annotations_dict, ground_truth, area, shape))
+        results = pool.imap(evaluate_epoch_in_worker, detections_files)
+    else:
+        pool = None
+        results = (evaluate_epoch(annotations_dict, ground_truth, detections_file, area, shape=shape)
+                   for detections_file in detections_files)
+    try:
+        for epoch in tqdm(epochs):
+            metric, epoch_classes = evaluated[epoch] if epoch in evaluated else next(results)
+            # kostil' #
+            if metric is None:
+                metrics.append(None)
+                indexes_to_correct.append(len(metrics)-1)
+                continue
+            ###########
+            classes = epoch_classes
+            metrics.append(metric)
+    finally:
+        if pool is not None:
+            pool.terminate()
     # kostil' #
     for index in indexes_to_correct:
-        metrics[index] = [0] * (len(classes)+1)
+        metrics[index] = [[0] * (len(classes)+1) for _ in ground_truth.area_ranges]
     ###########
     return metrics, classes
 
 
-def save_metrics(epochs, metrics, classes, report_folder):
-    with open(os.path.join(report_folder, 'metrics.csv'), 'w') as f:
+def get_epoch_metrics(results):
+    classes = get_classes(results)
+    metrics = list()
+    for name in results['areas']:
+        metrics.append([extract_mAP(results, area=name)] + extract_AP(results, classes, area=name))
+    return metrics, classes
+
+
+def keeps_all_boxes(area, shape=(None, None)):
+    """
+    Whether leave_boxes with area and shape keeps all boxes
+    """
+    return (tuple(area) == (0**2, 1e5**2)) and (tuple(shape) == (None, None))
+
+
+def load_detections_columns(annotations_dict, detections_file, area, shape=(None, None)):
+    """
+    Detections columns (image_id, category_id, bbox, score) of a predictions file filtered by area and shape,
+    None if there are no detections. Without area and shape limits columns of npz files are taken
+    from its arrays as they are, otherwise detections are filtered by leave_boxes as the ground truth
+    """
+    if detections_file.endswith('.npz') and keeps_all_boxes(area, shape):
+        detections = load_detections(detections_file)
+        if len(detections) == 0:
+            return None
+        return {'image_id': detections.image_id, 'category_id': detections.category_id,
+                'bbox': detections.bbox, 'score': detections.score}
+    detections_dict = load_coco_annotations(detections_file)
+    if detections_dict == list():
+        return None
+    detections_dict_with_images = {'images': annotations_dict['images'], 'annotations': detections_dict}
+    leave_boxes(detections_dict_with_images, area, width=shape[0], height=shape[1])
+    return get_detections_columns(detections_dict_with_images['annotations'])
+
+
+def evaluate_epoch(annotations_dict, ground_truth, detections_file, area, shape=(None, None)):
+    """
+    Returns metrics (mAP followed by APs) of every area range and classes of an epoch,
+    or None, None if there are no detections. All area ranges are evaluated in one matching pass
+    """
+    detections_columns = load_detections_columns(annotations_dict, detections_file, area, shape=shape)
+    if detections_columns is None:
+        return None, None
+    return get_epoch_metrics(ground_truth.evaluate(detections_columns))
+
+
+metrics_worker_args = None
+
+
+def init_metrics_worker(annotations_dict, ground_truth, area, shape):
+    global metrics_worker_args
+    metrics_worker_args = (annotations_dict, ground_truth, area, shape)
+
+
+def evaluate_epoch_in_worker(detections_file):
+    annotations_dict, ground_truth, area, shape = metrics_worker_args
+    return evaluate_epoch(annotations_dict, ground_truth, detections_file, area, shape=shape)
+
+
+def save_metrics(epochs, metrics, classes, report_folder, area_name=None):
+    with open(get_report_file(report_folder, 'metrics.csv', area_name=area_name), 'w') as f:
         writer = csv.writer(f, delimiter=' ')
         for epoch, metric in zip(epochs, metrics):
             writer.writerow([epoch] + metric)
@@ -125,30 +416,69 @@ def save_metrics(epochs, metrics, classes, report_folder):
         APs.append(metric[1:])
     plt.plot(epochs, mAP)
     plt.grid()
-    plt.savefig(os.path.join(report_folder, 'mAP.png'))
+    plt.savefig(get_report_file(report_folder, 'mAP.png', area_name=area_name))
     plt.close()
     plt.plot(epochs, APs)
     plt.grid()
-    plt.savefig(os.path.join(report_folder, 'APs.png'))
+    plt.savefig(get_report_file(report_folder, 'APs.png', area_name=area_name))
     plt.close()
 
 
 def report(config_file, models_folder, report_folder, images_folder, annotations_file,
-           area=(0**2, 1e5**2), shape=(None, None), add=False, repredict=True):
+           area=(0**2, 1e5**2), shape=(None, None), add=False, repredict=True, cache_folder=None, cache_size=1024,
+           tensor_cache=None, predictions_format='json', processes=1, area_ranges=None, screening=False,
+           screening_start=0.1, screening_keep=0.5, screening_final=3, screening_bootstrap=30, screening_seed=0):
+    """
+    With area_ranges (name, min area, max area) metrics of every range are saved to metrics_<name>.csv,
+    otherwise metrics of all boxes are saved to metrics.csv.
+    With screening checkpoints are screened by successive halving (see screen_models) and only metrics
+    of checkpoints evaluated on all images are saved, predictions files are not written
+    """
     if area[1] == -1:
         area = (area[0], 1e5**2)
+    if screening and (add or not keeps_all_boxes(area, shape)):
+        raise RuntimeError('Screening can not be used with add, area and shape')
+    if area_ranges is None:
+        area_ranges, areas_names = DEFAULT_AREA_RANGES, [None]
+    else:
+        areas_names = [name for name, _, _ in area_ranges]
     if add:
-        existing_epochs, existing_metrics = get_existing_information(report_folder)
+        existing_information = [get_existing_information(report_folder, area_name=name) for name in areas_names]
+        existing_epochs = existing_information[0][0]
+        existing_metrics = [metrics for _, metrics in existing_information]
     else:
-        existing_epochs, existing_metrics = list(), list()
+        existing_epochs, existing_metrics = list(), [list() for _ in areas_names]
     create_folders(report_folder)
     models_files, epochs = get_models_files(models_folder, existing_epochs)
-    run_models(config_file, models_files, epochs, report_folder, images_folder, annotations_file, repredict=repredict)
-    metrics, classes = calculate_metrics(epochs, report_folder, annotations_file, area, shape=shape)
+    annotations_dict, ground_truth = load_ground_truth(annotations_file, area, shape=shape, area_ranges=area_ranges)
+    if screening:
+        rows, evaluated = screen_models(config_file, models_files, epochs, report_folder, images_folder,
+                                        annotations_file, annotations_dict, ground_truth, start=screening_start,
+                                        keep=screening_keep, final=screening_final, bootstrap=screening_bootstrap,
+                                        seed=screening_seed, cache_folder=cache_folder, cache_size=cache_size,
+                                        tensor_cache=tensor_cache)
+        save_screening(rows, report_folder)
+        epochs = sorted(evaluated.keys())
+        metrics, classes = calculate_metrics(epochs, report_folder, annotations_dict, ground_truth, area,
+                                             evaluated=evaluated)
+        for i, area_name in enumerate(areas_names):
+            save_metrics(epochs, [metric[i] for metric in metrics], classes, report_folder, area_name=area_name)
+        return
+    # without area and shape limits leave_boxes keeps all detections,
+    # so epochs are evaluated while they are predicted without reading predictions files back
+    evaluate_online = keeps_all_boxes(area, shape)
+    evaluated = run_models(config_file, models_files, epochs, report_folder, images_folder, annotations_file,
+                           repredict=repredict, cache_folder=cache_folder, cache_size=cache_size,
+                           tensor_cache=tensor_cache, predictions_format=predictions_format,
+                           ground_truth=ground_truth if evaluate_online else None)
+    metrics, classes = calculate_metrics(epochs, report_folder, annotations_dict, ground_truth, area, shape=shape,
+                                         predictions_format=predictions_format, processes=processes,
+                                         evaluated=evaluated)
     epochs += existing_epochs
-    metrics += existing_metrics
-    epochs, metrics = zip(*sorted(zip(epochs, metrics)))
-    save_metrics(epochs, metrics, classes, report_folder)
+    for i, area_name in enumerate(areas_names):
+        area_metrics = [metric[i] for metric in metrics] + existing_metrics[i]
+        area_epochs, area_metrics = zip(*sorted(zip(epochs, area_metrics)))
+        save_metrics(area_epochs, area_metrics, classes, report_folder, area_name=area_name)
 
 
 def complete_args(kwargs):
@@ -170,6 +500,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
     os.environ["CUDA_VISIBLE_DEVICES"] = str(args.gpu)
     args.area = list(map(eval, args.area))
+    if args.area_ranges is not None:
+        args.area_ranges = get_area_ranges(args.area_ranges)
     kwargs = vars(args)
     kwargs.pop('gpu')
     if 'name' in kwargs.keys():
@@ -1256,6 +1256,7 @@ void fuse_conv_batchnorm(network net)
 
                 free_convolutional_batchnorm(l);
                 l->batch_normalize = 0;
+                l->fused_batch_normalize = 1;
 #ifdef GPU
                 if (gpu_index >= 0) {
                     push_convolutional_layer(*l);
@@ -1307,6 +1308,7 @@ void fuse_conv_batchnorm(network net)
                 }
             }
 
+            l->fused_weights_normalization = l->weights_normalization;
             l->weights_normalization = NO_NORMALIZATION;
 
 #ifdef GPU
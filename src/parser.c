@@ -2203,6 +2203,37 @@ void load_weights(network *net, char *filename)
     load_weights_upto(net, filename, net->n);
 }
 
+// load weights of another checkpoint into a network loaded by load_network_custom:
+// batchnorm and weights normalization fused on loading are restored for loading and fused again
+void reload_weights(network *net, char *filename)
+{
+    int i, j;
+    for (j = 0; j < net->n; ++j) {
+        layer *l = &net->layers[j];
+        if (l->type == CONVOLUTIONAL && l->fused_batch_normalize) {
+            l->scales = (float*)xcalloc(l->n, sizeof(float));
+            for (i = 0; i < l->n; ++i) l->scales[i] = 1;
+            l->rolling_mean = (float*)xcalloc(l->n, sizeof(float));
+            l->rolling_variance = (float*)xcalloc(l->n, sizeof(float));
+#ifdef GPU
+            if (gpu_index >= 0) {
+                l->scales_gpu = cuda_make_array(l->scales, l->n);
+                l->rolling_mean_gpu = cuda_make_array(l->rolling_mean, l->n);
+                l->rolling_variance_gpu = cuda_make_array(l->rolling_variance, l->n);
+            }
+#endif
+            l->batch_normalize = 1;
+            l->fused_batch_normalize = 0;
+        }
+        if (l->type == SHORTCUT && l->fused_weights_normalization) {
+            l->weights_normalization = l->fused_weights_normalization;
+            l->fused_weights_normalization = NO_NORMALIZATION;
+        }
+    }
+    load_weights(net, filename);
+    fuse_conv_batchnorm(*net);
+}
+
 // load network & force - set batch size
 network *load_network_custom(char *cfg, char *weights, int clear, int batch)
 {
@@ -12,6 +12,7 @@ void save_weights(network net, char *filename);
 void save_weights_upto(network net, char *filename, int cutoff);
 void save_weights_double(network net, char *filename);
 void load_weights(network *net, char *filename);
+void reload_weights(network *net, char *filename);
 void load_weights_upto(network *net, char *filename, int cutoff);
 
 #ifdef __cplusplus
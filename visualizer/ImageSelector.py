@@ -3,8 +3,8 @@ from PyQt5.QtGui import QPixmap, QIntValidator
 from PyQt5.QtCore import Qt, pyqtSignal
 import os
 import os.path as osp
-import json
 from time import time
+from annotations_index import load_annotations_index
 
 
 class ImageSelector(QGroupBox):
@@ -36,11 +36,8 @@ class ImageSelector(QGroupBox):
         self.images_files = list(map(lambda x: osp.join(self.images_folder, x), images_files))
 
     def load_images_from_json(self):
-        with open(self.images_file, 'r') as f:
-            json_dict = json.load(f)
-        self.images_files = list()
-        for image in json_dict['images']:
-            self.images_files.append(osp.join(self.images_folder, image['file_name']))
+        index = load_annotations_index(self.images_file)
+        self.images_files = [osp.join(self.images_folder, image_name) for image_name in index.images_names.tolist()]
 
     def get_current_image_file(self):
         return self.images_files[self.current_image_idx]
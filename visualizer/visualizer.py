@@ -7,6 +7,7 @@ from InputSizeSelector import InputSizeSelector
 from ImageScaleSelector import ImageScaleSelector
 from Viewer import Viewer
 from Detector import Detector
+from darknet import enable_stage_timing, disable_stage_timing
 import os
 import argparse
 
@@ -22,6 +23,7 @@ def build_parser():
     parser.add_argument('-win-h', '--window-height', type=int, default=500)
     parser.add_argument('-in-w', '--input-base-width', type=int, default=1024)
     parser.add_argument('-in-h', '--input-base-height', type=int, default=576)
+    parser.add_argument('-timing', '--timing', action='store_true', help='Print time spent in detection stages on exit')
     parser.add_argument('-gpu', '--gpu', type=int, default=0)
     return parser
 
@@ -66,7 +68,12 @@ if __name__ == '__main__':
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
     kwargs = vars(args)
     kwargs.pop('gpu')
+    timing = kwargs.pop('timing')
+    if timing:
+        enable_stage_timing()
     app = QApplication([])
     vis = Visualizer(**kwargs)
     vis.show()
     app.exec_()
+    if timing:
+        print(disable_stage_timing().report())